@@ -1,11 +1,321 @@
+import json
+import os
+import shutil
 import pendulum
 from airflow.decorators import dag, task
 import pandas as pd
 import numpy as np
 from pathlib import Path
 from datetime import datetime
+import pyarrow as pa
+import pyarrow.dataset as ds
+from rec_sys_common.loader import load_events
+from rec_sys_common.negatives import generate_negative_samples
+from rec_sys_common.features import FeatureStore
+from rec_sys_common.metrics import beyond_accuracy_metrics, recommendation_matrix
+from rec_sys_common.registry import ArtifactError, open_artifact, prune_versions
+from rec_sys_common.segments import SegmentTops, age_groups
     
 DATA_DIR = Path("/opt/airflow/data")  # общая папка в контейнере
+ARTIFACTS_DIR = DATA_DIR / "artifacts"  # промежуточные parquet-датасеты между тасками
+CACHE_DIR = DATA_DIR / "cache"  # бинарный кеш исходного xlsx
+MODELS_DIR = DATA_DIR / "models"  # реестр артефактов моделей и признаков (rec_sys_common/registry.py)
+MODEL_VERSIONS_KEEP = 3  # сколько версий каждого артефакта реестра хранить (LATEST не удаляется)
+ROWS_PER_FILE = 1_000_000  # размер одного parquet-файла в датасете
+
+# Колонки, которые не нужны ни одной таске — не читаем их из parquet
+UNUSED_COLUMNS = ["esb_ehr_id", "patientnet_ehr_id", "medialog_ehr_id"]
+
+
+def write_artifact(df: pd.DataFrame, path: Path) -> dict:
+    """
+    Сохраняет DataFrame как parquet-датасет (набор part-*.parquet) и возвращает
+    то, что уходит в XCom: путь и количество строк.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(
+        table, path, format="parquet",
+        basename_template="part-{i}.parquet",
+        max_rows_per_file=ROWS_PER_FILE,
+        max_rows_per_group=min(ROWS_PER_FILE, 128 * 1024),
+        existing_data_behavior="delete_matching",
+    )
+    return {"path": str(path), "rows": table.num_rows}
+
+
+def read_artifact(artifact: dict, columns: list = None) -> pd.DataFrame:
+    """
+    Читает parquet-датасет из XCom-артефакта, только нужные колонки (memory-map).
+    """
+    return pd.read_parquet(artifact["path"], columns=columns, memory_map=True)
+
+
+def artifact_columns(artifact: dict) -> list:
+    """Список колонок датасета без чтения данных"""
+    return ds.dataset(artifact["path"], format="parquet").schema.names
+
+
+# Границы фильтра пользователей по числу взаимодействий
+MIN_INTERACTIONS = 4
+MAX_INTERACTIONS = 50
+
+# Признаки для ранжирующей модели (как в rec_sys_catboost)
+ARTICLE_FEATURES = ["rubric_title", "tags", "formats", "views"]
+RANKING_FEATURES = ["gender", "age"] + ARTICLE_FEATURES
+RANKING_CAT_FEATURES = ["gender", "rubric_title", "tags", "formats"]
+
+# Маппинг для читаемости
+GENDER_MAP = {1: "Женщины", 2: "Мужчины"}
+AGE_MAP = {0: "0–17", 1: "18–29", 2: "30–44", 3: "45–59", 4: "60+"}
+
+
+def clean_events(df: pd.DataFrame) -> pd.DataFrame:
+    """Переименование колонок, фильтр тегов, удаление служебных колонок"""
+    df = df.rename(columns={"пол":"gender", "возраст":"age"})
+    df = df[df['tags'] != 'Секс']
+    return df.drop(columns=["action_type"] + UNUSED_COLUMNS, errors="ignore")
+
+
+def readable_top(grouped: pd.DataFrame, top_n: int) -> pd.DataFrame:
+    """
+    Топ-N статей в каждой группе (gender, age_group) в читаемом виде.
+
+    grouped: клики по (gender, age_group, article_id, title, url) в колонке clicks,
+    отсортированные по ключам группировки
+    """
+    grouped = grouped.copy()
+
+    # Берём топ-N для каждой группы
+    grouped["rank"] = grouped.groupby(["gender", "age_group"])["clicks"] \
+        .rank(method="first", ascending=False)
+
+    top_df = grouped[grouped["rank"] <= top_n].copy()
+
+    # Приводим к читаемому виду
+    top_df["gender"] = top_df["gender"].map(GENDER_MAP)
+    top_df["age_group"] = top_df["age_group"].map(AGE_MAP)
+    top_df = top_df[["gender", "age_group", "rank", "title", "url", "clicks"]]
+
+    return (
+        top_df[['gender', 'age_group', 'rank', 'title', 'url']]
+        .sort_values(['gender', 'age_group', 'rank'])
+    )
+
+
+def save_readable_top(final: pd.DataFrame):
+    timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S")
+    out_csv = DATA_DIR / "processed" / f"top_articles_readable ({timestamp}).csv"
+    final.to_csv(out_csv, index=False)
+
+
+def top_metrics(segment_clicks: pd.DataFrame, catalog, top_n: int) -> dict:
+    """
+    Покрытие каталога, Gini показов и новизна сегментных топов
+    (rec_sys_common/metrics.py) — считаются на каждом запуске.
+
+    segment_clicks: клики по (gender, age_group, article_id) в колонке clicks
+    catalog: все article_id каталога
+    Популярность для новизны — доля кликов статьи: кликнувших пользователей
+    в счетчиках нет.
+    """
+    catalog = pd.Index(pd.unique(np.asarray(catalog)))
+    ranked = segment_clicks.sort_values(["gender", "age_group", "clicks"], ascending=[True, True, False])
+    segments = ranked.groupby(["gender", "age_group"])
+    _, rows = recommendation_matrix(
+        pd.DataFrame({"ehr_id": segments.ngroup(), "article_id": ranked["article_id"],
+                      "rank": segments.cumcount()}), catalog, k=top_n)
+    popularity = np.bincount(catalog.get_indexer(segment_clicks["article_id"]),
+                             weights=segment_clicks["clicks"], minlength=len(catalog))
+    return beyond_accuracy_metrics(rows, len(catalog), item_popularity=popularity,
+                                   n_users=max(int(popularity.sum()), 1))
+
+
+def log_top_metrics(metrics: dict):
+    """Строка в processed/top_metrics.jsonl — история метрик по запускам"""
+    metrics = dict(metrics, timestamp=datetime.now().isoformat(timespec="seconds"))
+    with open(DATA_DIR / "processed" / "top_metrics.jsonl", "a") as f:
+        f.write(json.dumps(metrics) + "\n")
+
+
+# ---------------------------------------------------------------------------
+# Инкрементальный режим: состояние между запусками
+#
+# STATE_DIR/
+#   CURRENT.json              — watermark по created_at, граница и актуальная версия
+#   versions/<ts>/            — счетчики: user_counts, segment_clicks, articles
+#   events/part-<wm>.parquet  — очищенные события, по файлу на запуск
+# ---------------------------------------------------------------------------
+STATE_DIR = DATA_DIR / "state"
+EVENTS_DIR = STATE_DIR / "events"
+STATE_VERSIONS_KEEP = 3
+
+SEGMENT_KEYS = ["gender", "age_group", "article_id"]
+STATE_SCHEMAS = {
+    "user_counts": ["ehr_id", "interactions"],
+    "segment_clicks": SEGMENT_KEYS + ["clicks"],
+    "articles": ["article_id", "title", "url"],
+}
+
+
+# Ключ события для границы watermark (created_at на границе равен самому watermark)
+BOUNDARY_KEYS = ["ehr_id", "article_id"]
+
+
+def read_state() -> dict:
+    """Текущий watermark, граница и путь к версии счетчиков (None до первого запуска)"""
+    current = STATE_DIR / "CURRENT.json"
+    if not current.exists():
+        return {"watermark": None, "boundary": [], "version": None}
+    return dict({"boundary": []}, **json.loads(current.read_text()))
+
+
+def drop_applied(df: pd.DataFrame, watermark, boundary: list) -> pd.DataFrame:
+    """
+    События, еще не учтенные до watermark.
+
+    Выгрузка отбирается по created_at >= watermark: события с тем же
+    временем, что и watermark, могут прийти в следующей выгрузке. Уже
+    учтенные события на самой границе (boundary — их ключи BOUNDARY_KEYS)
+    вычитаются с кратностью, поэтому повторный клик в ту же секунду не теряется.
+    """
+    if watermark is None:
+        return df
+    watermark = pd.Timestamp(watermark)
+    df = df[df["created_at"] >= watermark]
+    at_watermark = (df["created_at"] == watermark).to_numpy()
+    if not boundary or not at_watermark.any():
+        return df
+    edge = df.loc[at_watermark, BOUNDARY_KEYS].fillna(-1).astype("int64")
+    applied = pd.DataFrame(boundary, columns=BOUNDARY_KEYS).groupby(BOUNDARY_KEYS).size()
+    occurrence = edge.groupby(BOUNDARY_KEYS).cumcount().to_numpy()
+    already = applied.reindex(pd.MultiIndex.from_frame(edge), fill_value=0).to_numpy()
+    keep = np.ones(len(df), dtype=bool)
+    keep[np.flatnonzero(at_watermark)] = occurrence >= already
+    return df[keep]
+
+
+def next_boundary(df: pd.DataFrame, watermark, boundary: list):
+    """
+    Новый watermark (максимум created_at) и ключи учтенных на нем событий.
+
+    Returns:
+    (watermark iso или прежний, список [ehr_id, article_id])
+    """
+    if len(df) == 0:
+        return watermark, boundary
+    new_watermark = df["created_at"].max()
+    edge = df.loc[df["created_at"] == new_watermark, BOUNDARY_KEYS].fillna(-1).astype("int64")
+    keys = edge.to_numpy().tolist()
+    if watermark is not None and new_watermark == pd.Timestamp(watermark):
+        keys = list(boundary) + keys
+    return new_watermark.isoformat(), keys
+
+
+def load_state_table(state: dict, name: str) -> pd.DataFrame:
+    if state["version"] is None:
+        return pd.DataFrame(columns=STATE_SCHEMAS[name])
+    return pd.read_parquet(Path(state["version"]) / f"{name}.parquet")
+
+
+def commit_state(watermark: str, tables: dict, boundary: list = None) -> dict:
+    """
+    Пишет новую версию счетчиков и атомарно переключает на нее CURRENT.json.
+    Упавший запуск оставляет прежнюю версию и watermark нетронутыми.
+    """
+    timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S.%f")
+    version = STATE_DIR / "versions" / timestamp
+    version.mkdir(parents=True, exist_ok=True)
+    for name, table in tables.items():
+        table.to_parquet(version / f"{name}.parquet", index=False)
+
+    state = {"watermark": watermark, "boundary": boundary or [], "version": str(version)}
+    tmp = STATE_DIR / "CURRENT.json.tmp"
+    tmp.write_text(json.dumps(state))
+    os.replace(tmp, STATE_DIR / "CURRENT.json")
+
+    for old in sorted((STATE_DIR / "versions").iterdir())[:-STATE_VERSIONS_KEEP]:
+        shutil.rmtree(old, ignore_errors=True)
+    return state
+
+
+def events_part(watermark) -> Path:
+    # Имя по нижней границе: перезапуск после сбоя перезапишет тот же файл
+    name = "initial" if watermark is None else pd.Timestamp(watermark).strftime("%Y%m%dT%H%M%S%f")
+    return EVENTS_DIR / f"part-{name}.parquet"
+
+
+def read_user_history(users, exclude: Path) -> pd.DataFrame:
+    """События выбранных пользователей из уже накопленной истории (кроме exclude)"""
+    columns = ["ehr_id", "gender", "age_group", "article_id"]
+    files = [str(f) for f in sorted(EVENTS_DIR.glob("part-*.parquet")) if f != exclude]
+    if not files or len(users) == 0:
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(files, format="parquet")
+    table = dataset.to_table(columns=columns, filter=ds.field("ehr_id").isin(list(users)))
+    return table.to_pandas()
+
+
+def segment_clicks_delta(df: pd.DataFrame, sign: int = 1) -> pd.DataFrame:
+    # Клики с неизвестным возрастом (age_group = -1) в сегменты не идут
+    df = df[df["age_group"] >= 0]
+    return df.groupby(SEGMENT_KEYS).size().mul(sign).rename("clicks").reset_index()
+
+
+def apply_delta(delta: pd.DataFrame, state: dict, delta_part: Path) -> dict:
+    """
+    Обновляет счетчики по новым событиям.
+
+    Фильтр MIN_INTERACTIONS..MAX_INTERACTIONS поддерживается по дельтам:
+    - пользователи в диапазоне: в топы идут только их новые клики;
+    - вошедшие в диапазон: добавляется вся их прошлая история;
+    - вышедшие из диапазона: их прошлая история вычитается.
+    Читается только история пользователей, сменивших статус.
+    """
+    delta = delta.copy()
+    delta["age_group"] = age_groups(delta["age"])
+
+    user_counts = load_state_table(state, "user_counts").set_index("ehr_id")["interactions"]
+    old_counts = user_counts.reindex(delta["ehr_id"].unique(), fill_value=0)
+    new_counts = old_counts.add(delta.groupby("ehr_id").size(), fill_value=0)
+    user_counts = new_counts.combine_first(user_counts).astype("int64")
+
+    was_in = old_counts.between(MIN_INTERACTIONS, MAX_INTERACTIONS)
+    now_in = new_counts.between(MIN_INTERACTIONS, MAX_INTERACTIONS)
+    entered = now_in.index[now_in & ~was_in]
+    left = now_in.index[was_in & ~now_in]
+
+    history = read_user_history(entered.union(left), exclude=delta_part)
+    changes = [
+        load_state_table(state, "segment_clicks"),
+        segment_clicks_delta(delta[delta["ehr_id"].isin(now_in.index[now_in])]),
+        segment_clicks_delta(history[history["ehr_id"].isin(entered)]),
+        segment_clicks_delta(history[history["ehr_id"].isin(left)], sign=-1),
+    ]
+    changes = [c for c in changes if len(c)] or [pd.DataFrame(columns=STATE_SCHEMAS["segment_clicks"])]
+    segment_clicks = (
+        pd.concat(changes, ignore_index=True)
+        .groupby(SEGMENT_KEYS)["clicks"].sum()
+        .reset_index()
+    )
+    segment_clicks = segment_clicks[segment_clicks["clicks"] > 0]
+
+    articles = (
+        pd.concat([load_state_table(state, "articles"),
+                   delta[["article_id", "title", "url"]]], ignore_index=True)
+        .drop_duplicates("article_id", keep="last")
+    )
+
+    # История сохраняется до коммита счетчиков, под именем по старому watermark
+    EVENTS_DIR.mkdir(parents=True, exist_ok=True)
+    delta[["ehr_id", "gender", "age_group", "article_id", "created_at"]] \
+        .to_parquet(delta_part, index=False)
+
+    return {
+        "user_counts": user_counts.rename("interactions").rename_axis("ehr_id").reset_index(),
+        "segment_clicks": segment_clicks,
+        "articles": articles,
+    }
+
 
 @dag(
     schedule='@once',
@@ -18,24 +328,23 @@ def recsys_etl_pipeline():
     @task()
     def extract():
         path = DATA_DIR / "raw" / "cuprum_events.xlsx"
-        df = pd.read_excel(path, sheet_name="Лист4")
-        return df.to_json()
+        df = load_events(path, sheet_name="Лист4", cache_dir=CACHE_DIR)
+        # Все артефакты одного запуска лежат в своей папке
+        timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S")
+        return write_artifact(df, ARTIFACTS_DIR / timestamp / "raw")
         
     @task()
-    def transform(raw_json: str):
-        df = pd.read_json(raw_json)
-        df.rename(columns={"пол":"gender", "возраст":"age"}, inplace=True)
-        df = df[df['tags'] != 'Секс']
-        df[df['action_type'] == 'CLICKED']
-        df.drop(columns=["esb_ehr_id","patientnet_ehr_id", "medialog_ehr_id","action_type"], inplace=True)
+    def transform(raw: dict):
+        columns = [c for c in artifact_columns(raw) if c not in UNUSED_COLUMNS]
+        df = clean_events(read_artifact(raw, columns=columns))
         df = filter_for_iteration_range(df)
-        return df.to_json()
+        return write_artifact(df, Path(raw["path"]).parent / "clean")
     
     @task()
-    def load(raw_json: str):
+    def load(clean: dict):
         timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S")
         out_path = DATA_DIR / "processed" / f"clicks_clean ({timestamp}).csv"
-        df = pd.read_json(raw_json)
+        df = read_artifact(clean)
         df.to_csv(out_path, index=False)
     
     #def transform(data: pd.DataFrame):
@@ -43,49 +352,39 @@ def recsys_etl_pipeline():
     #    step2 = fill_missing_values(step1)
     #    return step2
 
-    def filter_for_iteration_range(df, min=4, max=50):
+    def filter_for_iteration_range(df, min=MIN_INTERACTIONS, max=MAX_INTERACTIONS):
         interaction_counts = df.groupby('ehr_id')['article_id'].count()
         users_in_range = set(interaction_counts[(interaction_counts >= min) & (interaction_counts <= max)].index)
         df_filtered = df[df['ehr_id'].isin(users_in_range)]
         return df_filtered
 
-    # негерируем негативные сэмлы для работы модели
-    def generate_negative_samples(df, all_articles, n_negatives=3):
-        negatives = []
-
-        for user_id, group in df.groupby('ehr_id'):
-            clicked = set(group['article_id'])
-            not_clicked = list(all_articles - clicked)
-            sampled = np.random.choice(not_clicked, size=n_negatives, replace=False)
-
-            for art in sampled:
-                negatives.append({
-                    "ehr_id": user_id,
-                    "article_id": art,
-                    "label": 0
-                })
-        return pd.DataFrame(negatives)
-    
     @task()
-    def build_top(raw_json: str, top_n: int = 10):
+    def build_ranking_samples(clean: dict, n_negatives: int = 20):
         """
-        Строит топ статей по полу и возрастным группам и сохраняет в csv/pkl.
+        Обучающая выборка для CatBoostRanker: клики (label=1) и негативы (label=0)
+        с признаками пользователя и статьи.
         """
-        df = pd.read_json(raw_json)
+        df = read_artifact(clean, columns=["ehr_id", "article_id"] + RANKING_FEATURES)
+        df = df.dropna(subset=RANKING_CAT_FEATURES)
 
-        # Маппинг для читаемости
-        gender_map = {1: "Женщины", 2: "Мужчины"}
-        age_map = {0: "0–17", 1: "18–29", 2: "30–44", 3: "45–59", 4: "60+"}
+        user_features = df.drop_duplicates("ehr_id")[["ehr_id", "gender", "age"]]
+        article_features = df.drop_duplicates("article_id")[["article_id"] + ARTICLE_FEATURES]
+        negatives = generate_negative_samples(df, n_negatives=n_negatives,
+                                              user_features=user_features,
+                                              article_features=article_features)
 
-        # Функция для группировки возраста
-        def age_group(age):
-            if age < 18: return 0
-            elif age < 30: return 1
-            elif age < 45: return 2
-            elif age < 60: return 3
-            else: return 4
-
-        df["age_group"] = df["age"].apply(age_group)
+        positives = df.assign(label=1)[negatives.columns]
+        samples = pd.concat([positives, negatives], ignore_index=True).sort_values("ehr_id", kind="stable")
+        return write_artifact(samples, Path(clean["path"]).parent / "ranking")
+    
+    @task()
+    def build_top(clean: dict, top_n: int = 10):
+        """
+        Строит топ статей по полу и возрастным группам и сохраняет в csv
+        и плотной таблицей SegmentTops в реестр (для сервиса).
+        """
+        df = read_artifact(clean, columns=["gender", "age", "article_id", "title", "url"])
+        df["age_group"] = age_groups(df["age"])
 
         # Считаем количество кликов
         grouped = (
@@ -93,32 +392,17 @@ def recsys_etl_pipeline():
             .size()
             .reset_index(name="clicks")
         )
-
-        # Берём топ-N для каждой группы
-        grouped["rank"] = grouped.groupby(["gender", "age_group"])["clicks"] \
-            .rank(method="first", ascending=False)
-
-        top_df = grouped[grouped["rank"] <= top_n].copy()
-
-        # Приводим к читаемому виду
-        top_df["gender"] = top_df["gender"].map(gender_map)
-        top_df["age_group"] = top_df["age_group"].map(age_map)
-        top_df = top_df[["gender", "age_group", "rank", "title", "url", "clicks"]]
-
-        final = (
-            top_df[['gender', 'age_group', 'rank', 'title', 'url']]
-            .sort_values(['gender', 'age_group', 'rank'])
-        )
+        # Клики с неизвестным возрастом — только в топы пола и общий
+        segments = grouped[grouped["age_group"] >= 0]
+        final = readable_top(segments, top_n)
         
         # Сохраняем
-        timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S")
-        out_csv = DATA_DIR / "processed" / f"top_articles_readable ({timestamp}).csv"
-        out_pkl = DATA_DIR / "processed" / f"top_articles_readable ({timestamp}).pkl"
-
-        final.to_csv(out_csv, index=False)
-        #final.to_pickle(out_pkl)
+        save_readable_top(final)
+        SegmentTops.from_counts(grouped, k=top_n).save(MODELS_DIR)
+        prune_versions(MODELS_DIR, "segment_tops", MODEL_VERSIONS_KEEP)
+        log_top_metrics(top_metrics(segments, grouped["article_id"], top_n))
 
-        return final.to_json()
+        return write_artifact(final, Path(clean["path"]).parent / "top")
     
     def remove_duplicates(data):
         feature_cols = data.columns.drop('customer_id').tolist()
@@ -141,5 +425,111 @@ def recsys_etl_pipeline():
     clean = transform(raw)
     load(clean)
     build_top(clean, top_n = 20)
+    build_ranking_samples(clean, n_negatives = 20)
     
-recsys_etl_pipeline()
\ No newline at end of file
+recsys_etl_pipeline()
+
+
+@dag(
+    schedule='@daily',
+    start_date=pendulum.datetime(2025, 1, 1, tz="UTC"),
+    catchup=False,
+    max_active_runs=1,
+    tags=["SGM"],
+    dag_id = 'v3_incremental'
+)
+def recsys_etl_incremental():
+    """
+    Инкрементальная версия v3: забирает только события новее watermark
+    по created_at и обновляет счетчики по дельтам. Первый запуск
+    (без состояния) обрабатывает всю историю.
+
+    Ограничение: источник — одна полная выгрузка xlsx. Кеш load_events
+    привязан к хешу всего файла, поэтому каждая новая выгрузка один раз
+    целиком проходит read_excel и типизацию, и только потом фильтр по
+    watermark. Пропорциональны новым данным пересчет счетчиков и признаков,
+    но не разбор выгрузки — для этого нужны выгрузки по дням.
+    """
+
+    @task()
+    def extract_new():
+        state = read_state()
+        path = DATA_DIR / "raw" / "cuprum_events.xlsx"
+        # Новые события отбираются при чтении кеша; >=, чтобы не потерять
+        # поздно выгруженные события с временем watermark, учтенные — вычитаются
+        filters = None
+        if state["watermark"] is not None:
+            filters = [("created_at", ">=", pd.Timestamp(state["watermark"]))]
+        df = load_events(path, sheet_name="Лист4", filters=filters, cache_dir=CACHE_DIR)
+        df = drop_applied(clean_events(df), state["watermark"], state["boundary"])
+
+        timestamp = datetime.now().strftime("%Y.%m.%d %H-%M-%S")
+        artifact = write_artifact(df, ARTIFACTS_DIR / timestamp / "delta")
+        artifact["watermark"], artifact["boundary"] = next_boundary(df, state["watermark"], state["boundary"])
+        return artifact
+
+    @task()
+    def update_state(delta: dict):
+        state = read_state()
+        if delta["rows"] == 0:
+            return state
+        tables = apply_delta(read_artifact(delta), state, events_part(state["watermark"]))
+        return commit_state(delta["watermark"], tables, delta["boundary"])
+
+    @task()
+    def update_features(delta: dict):
+        """
+        Хранилище признаков CatBoost: последняя версия из реестра дополняется
+        новыми событиями и публикуется новой версией. Watermark и граница
+        хранилища пишутся в манифест, и из дельты берутся только еще не
+        учтенные в нем события (drop_applied): дельта считается от watermark
+        состояния, который может отставать (упал update_state), поэтому
+        клики не учитываются дважды.
+        """
+        if delta["rows"] == 0:
+            return None
+        events = read_artifact(delta)
+        watermark, boundary = None, []
+        try:
+            path, manifest = open_artifact(MODELS_DIR / "features", kind="features")
+        except ArtifactError:
+            store = FeatureStore()
+        else:
+            watermark, boundary = manifest["meta"].get("watermark"), manifest["meta"].get("boundary", [])
+            events = drop_applied(events, watermark, boundary)
+            if events.empty:
+                return str(path)  # дельта уже применена
+            store = FeatureStore.load(path)
+        store.update(events)
+        watermark, boundary = next_boundary(events, watermark, boundary)
+        path = store.save(MODELS_DIR, name="features", meta={"watermark": watermark, "boundary": boundary})
+        prune_versions(MODELS_DIR, "features", MODEL_VERSIONS_KEEP)
+        return str(path)
+
+    @task()
+    def build_top(state: dict, top_n: int = 10):
+        """
+        Топ статей по полу и возрастным группам из накопленных счетчиков.
+        """
+        if state["version"] is None:
+            return None
+        segment_clicks = load_state_table(state, "segment_clicks")
+        articles = load_state_table(state, "articles")
+        grouped = (
+            segment_clicks.merge(articles, on="article_id", how="left")
+            .sort_values(SEGMENT_KEYS)
+        )
+        final = readable_top(grouped, top_n)
+        save_readable_top(final)
+        SegmentTops.from_counts(segment_clicks, k=top_n).save(MODELS_DIR, meta={"state": Path(state["version"]).name})
+        prune_versions(MODELS_DIR, "segment_tops", MODEL_VERSIONS_KEEP)
+        log_top_metrics(dict(top_metrics(segment_clicks, articles["article_id"], top_n),
+                             version=Path(state["version"]).name))
+        return write_artifact(final, Path(state["version"]) / "top")
+
+    delta = extract_new()
+    state = update_state(delta)
+    build_top(state, top_n = 20)
+    update_features(delta)
+
+recsys_etl_incremental()
\ No newline at end of file
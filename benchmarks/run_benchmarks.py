@@ -0,0 +1,550 @@
+"""
+Офлайн-бенчмарк всех рекомендателей на одном временном сплите.
+
+Для каждой модели: время обучения, пропускная способность пакетного
+инференса (пользователей/с), p50/p99 задержки одиночного запроса,
+пиковый RSS и метрики качества. Каждая модель запускается в отдельном
+процессе (spawn), чтобы пиковая память не смешивалась. Результат — JSON.
+
+Примеры:
+    python benchmarks/run_benchmarks.py --data cuprum_3.xlsx
+    python benchmarks/run_benchmarks.py --synthetic --scale 10 --models top,tfidf,als
+    python benchmarks/run_benchmarks.py --synthetic --compare benchmarks/results/prev.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in [ROOT, ROOT / "top", ROOT / "rec_sys_tf_idf", ROOT / "rec_sys_als", ROOT / "benchmarks"]:
+    sys.path.append(str(path))
+
+from rec_sys_common.metrics import ranking_metrics, topn_metrics
+from rec_sys_common.negatives import sample_negatives
+from rec_sys_common.segments import age_groups
+
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+MODELS = ["top", "tfidf", "als", "catboost", "ann"]
+TEST_QUANTILE = 0.8
+LATENCY_SAMPLE = 1000
+
+# Гиперпараметры — как в ноутбуках
+ALS_PARAMS = dict(factors=50, regularization=0.01, iterations=20)
+CATBOOST_PARAMS = dict(iterations=300, learning_rate=0.1, depth=6, verbose=0)
+CATBOOST_FEATURES = ['gender', 'age', 'rubric_title', 'tags', 'formats', 'views']
+CATBOOST_CAT_FEATURES = ['gender', 'rubric_title', 'tags', 'formats']
+N_NEGATIVES = 20
+ANN_PROBES = [1, 4, 8, 16, 32]
+
+
+# ---------------------------------------------------------------------------
+# Данные и сплит
+# ---------------------------------------------------------------------------
+
+def load_real_events(path) -> pd.DataFrame:
+    """Выгрузка событий в той же очистке, что в ноутбуках: только клики, пользователи с 4–50 кликами"""
+    from rec_sys_common.loader import load_events
+    df = load_events(path, sheet_name="Лист4", categorical=False,
+                     filters=[("action_type", "==", "CLICKED")])
+    df = df.rename(columns={"пол": "gender", "возраст": "age"})
+    df = df.drop(columns=["esb_ehr_id", "patientnet_ehr_id", "medialog_ehr_id"], errors="ignore")
+    counts = df.groupby('ehr_id')['article_id'].transform('size')
+    return df[(counts >= 4) & (counts <= 50)]
+
+
+def temporal_split(events: pd.DataFrame, quantile: float = TEST_QUANTILE):
+    """
+    Единый временной сплит: train — события до квантиля created_at, test — после.
+
+    Оцениваются пользователи теста, которые есть в train; в truth — только
+    статьи, которых пользователь не видел в train.
+    """
+    events = events.dropna(subset=["ehr_id", "article_id"])
+    cutoff = events["created_at"].quantile(quantile)
+    train = events[events["created_at"] <= cutoff]
+    test = events[events["created_at"] > cutoff]
+
+    truth = test[test["ehr_id"].isin(train["ehr_id"].unique())][["ehr_id", "article_id"]].drop_duplicates()
+    seen = train[["ehr_id", "article_id"]].drop_duplicates().assign(seen=True)
+    truth = truth.merge(seen, on=["ehr_id", "article_id"], how="left")
+    truth = truth[truth["seen"].isna()].drop(columns="seen")
+    return train, test, truth, cutoff
+
+
+# ---------------------------------------------------------------------------
+# Замеры
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb() -> float:
+    # Linux: VmHWM сбрасывается при exec, а ru_maxrss наследуется от родителя
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux — КБ, macOS — байты
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def latency_ms(fn, requests) -> dict:
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for request in requests:
+            start = time.perf_counter()
+            fn(*request)
+            timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    return {"p50": round(float(np.percentile(timings, 50)), 4),
+            "p99": round(float(np.percentile(timings, 99)), 4),
+            "requests": len(timings)}
+
+
+def metrics_dict(metrics: pd.DataFrame) -> dict:
+    return {str(k): {m: round(float(v), 6) for m, v in row.items()} for k, row in metrics.iterrows()}
+
+
+def result(fit_s, recs, batch_s, n_users, latency, truth, ks, **extra) -> dict:
+    return {
+        "fit_s": round(fit_s, 4),
+        "batch": {"users": n_users, "seconds": round(batch_s, 4),
+                  "users_per_s": round(n_users / batch_s, 1) if batch_s > 0 else None},
+        "latency_ms": latency,
+        "metrics": metrics_dict(topn_metrics(recs, truth, ks)) if recs is not None else None,
+        **extra,
+    }
+
+
+def sample_users(users, rng, size=LATENCY_SAMPLE):
+    users = np.asarray(users)
+    return users[rng.choice(len(users), size=min(size, len(users)), replace=False)]
+
+
+# ---------------------------------------------------------------------------
+# Модели
+# ---------------------------------------------------------------------------
+
+def bench_top(train, truth, params) -> dict:
+    """Сегментный топ, общий топ и рандом из top/random_vs_top.py"""
+    from random_vs_top import prepare_recommendation_systems, recommend_by_segment
+
+    n, ks = params["n"], params["ks"]
+    rng = np.random.default_rng(params["seed"])
+    train = train.assign(age_group=age_groups(train["age"]))
+    rec_systems, fit_s = timed(prepare_recommendation_systems, train, n_top=n)
+
+    users = train.drop_duplicates("ehr_id", keep="last").set_index("ehr_id").loc[truth["ehr_id"].unique()]
+
+    def segment_frame():
+        segment_recs = pd.DataFrame(
+            [(g, a, article_id, rank)
+             for (g, a), ids in rec_systems["segment_tops"].items()
+             for rank, article_id in enumerate(ids[:n], start=1)],
+            columns=["gender", "age_group", "article_id", "rank"])
+        return users[["gender", "age_group"]].reset_index().merge(segment_recs, on=["gender", "age_group"])
+
+    recs, batch_s = timed(segment_frame)
+    requests = [(users.at[u, "gender"], users.at[u, "age"], rec_systems, n)
+                for u in sample_users(users.index, rng)]
+    segment = result(fit_s, recs, batch_s, len(users), latency_ms(recommend_by_segment, requests), truth, ks)
+
+    global_recs = pd.DataFrame({
+        "ehr_id": np.repeat(users.index.to_numpy(), len(rec_systems["global_top"][:n])),
+        "article_id": np.tile(rec_systems["global_top"][:n], len(users)),
+        "rank": np.tile(np.arange(1, len(rec_systems["global_top"][:n]) + 1), len(users)),
+    })
+    # Рандом: n разных статей на пользователя — сэмплер негативов с пустой матрицей кликов
+    all_articles = np.asarray(rec_systems["all_articles"])
+    user_rows, article_rows = sample_negatives(
+        sparse.csr_matrix((len(users), len(all_articles)), dtype=bool), n, seed=params["seed"])
+    # Сэмплер отдает статьи пользователя по возрастанию номера: порядок внутри пользователя перемешивается
+    order = np.lexsort((rng.random(len(user_rows)), user_rows))
+    user_rows, article_rows = user_rows[order], article_rows[order]
+    starts = np.searchsorted(user_rows, user_rows, side="left")
+    random_recs = pd.DataFrame({"ehr_id": users.index.to_numpy()[user_rows],
+                                "article_id": all_articles[article_rows],
+                                "rank": np.arange(len(user_rows)) - starts + 1})
+    return {
+        "segment_top": segment,
+        "global_top": {"metrics": metrics_dict(topn_metrics(global_recs, truth, ks))},
+        "random": {"metrics": metrics_dict(topn_metrics(random_recs, truth, ks))},
+    }
+
+
+def bench_tfidf(train, truth, params) -> dict:
+    from content_recommender import ContentRecommenderSystem
+
+    n, ks = params["n"], params["ks"]
+    rng = np.random.default_rng(params["seed"])
+    recommender, fit_s = timed(ContentRecommenderSystem, train, n_neighbors=params["tfidf_neighbors"])
+
+    users = truth["ehr_id"].unique()
+
+    def batch():
+        chunks = []
+        for start in range(0, len(users), params["batch_size"]):
+            block = users[start:start + params["batch_size"]]
+            rows, scores = recommender.recommend_batch(block, n)
+            valid = rows >= 0
+            chunks.append(pd.DataFrame({
+                "ehr_id": np.repeat(block, valid.sum(axis=1)),
+                "article_id": recommender.article_ids[rows[valid]],
+                "rank": np.broadcast_to(np.arange(1, rows.shape[1] + 1), rows.shape)[valid],
+            }))
+        return pd.concat(chunks, ignore_index=True)
+
+    recs, batch_s = timed(batch)
+    requests = [(u, n) for u in sample_users(users, rng)]
+    results = {"tfidf": result(fit_s, recs, batch_s, len(users), latency_ms(recommender.score_user, requests),
+                               truth, ks, n_neighbors=params["tfidf_neighbors"])}
+    if params["tfidf_neighbors"] is not None:
+        results["tfidf_incremental"] = bench_tfidf_incremental(train, params)
+    return results
+
+
+def bench_tfidf_incremental(train, params, share: float = 0.1) -> dict:
+    """
+    add_articles против пересчета: индекс строится без share самых новых
+    статей, они добавляются инкрементально, и соседи сверяются с полным
+    build_neighbors. Заодно проверяется, что refit не делит каталог с
+    исходной системой.
+    """
+    from content_recommender import ARTICLE_COLUMNS, ContentRecommenderSystem
+
+    catalog = train[ARTICLE_COLUMNS].drop_duplicates("article_id").sort_values(["published_date", "article_id"])
+    new = catalog.tail(max(1, int(len(catalog) * share)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        recommender = ContentRecommenderSystem(train[~train["article_id"].isin(new["article_id"])],
+                                               n_neighbors=params["tfidf_neighbors"])
+        refitted = recommender.refit()
+        n_refitted = len(refitted.articles)
+    _, add_s = timed(recommender.add_articles, new)
+    return {
+        "articles": len(new),
+        "add_s": round(add_s, 4),
+        "ms_per_article": round(add_s * 1000 / len(new), 4),
+        "mismatched_rows": recommender.neighbors_mismatch(),
+        "refit_isolated": len(refitted.articles) == n_refitted and len(refitted.article_row) == n_refitted,
+    }
+
+
+def bench_als(train, truth, params) -> dict:
+    try:
+        from implicit.als import AlternatingLeastSquares
+    except ImportError:
+        return {"als": {"skipped": "implicit не установлен"}}
+    from scipy.sparse import coo_matrix
+    from als_batch import recommend_als_frame
+    from als_recommender import ALSRecommender
+
+    n, ks = params["n"], params["ks"]
+    rng = np.random.default_rng(params["seed"])
+
+    def fit():
+        clicks = train.groupby(["ehr_id", "article_id"]).size().reset_index(name="weight")
+        user_ids = clicks["ehr_id"].unique()
+        item_ids = clicks["article_id"].unique()
+        user_map = {u: i for i, u in enumerate(user_ids.tolist())}
+        rows = clicks["ehr_id"].map(user_map)
+        cols = pd.Index(item_ids).get_indexer(clicks["article_id"])
+        interactions = coo_matrix((clicks["weight"], (rows, cols)),
+                                  shape=(len(user_ids), len(item_ids))).tocsr()
+        model = AlternatingLeastSquares(random_state=params["seed"], **ALS_PARAMS)
+        model.fit(interactions, show_progress=False)
+        return model, interactions, user_ids, item_ids, user_map
+
+    (model, interactions, user_ids, item_ids, user_map), fit_s = timed(fit)
+    users = truth["ehr_id"].unique()
+    recs, batch_s = timed(recommend_als_frame, model, interactions, user_map, item_ids, users, n,
+                          params["batch_size"])
+    recommender = ALSRecommender(model, interactions, user_ids, item_ids, train)
+    requests = [(u, n) for u in sample_users(users, rng)]
+    return {"als": result(fit_s, recs, batch_s, len(users), latency_ms(recommender.recommend, requests),
+                          truth, ks, params=ALS_PARAMS)}
+
+
+def bench_catboost(train, test, params) -> dict:
+    """
+    CatBoostRanker ранжирует кандидатов: качество — на тестовых кликах
+    плюс N_NEGATIVES сэмплированных негативов на пользователя (как в ноутбуке),
+    поэтому метрики не сравнимы напрямую с top-N по всему каталогу.
+    """
+    try:
+        from catboost import CatBoostRanker, Pool
+    except ImportError:
+        return {"catboost": {"skipped": "catboost не установлен"}}
+    from rec_sys_common.negatives import generate_negative_samples
+
+    ks = params["ks"]
+    rng = np.random.default_rng(params["seed"])
+    events = pd.concat([train, test]).dropna(subset=CATBOOST_CAT_FEATURES)
+    article_features = events.drop_duplicates("article_id")[["article_id", "rubric_title", "tags", "formats", "views"]]
+    user_features = events.drop_duplicates("ehr_id")[["ehr_id", "gender", "age"]]
+
+    def candidates(df):
+        df = df.dropna(subset=CATBOOST_CAT_FEATURES)
+        negatives = generate_negative_samples(df, article_features["article_id"], N_NEGATIVES,
+                                              user_features=user_features, article_features=article_features,
+                                              seed=params["seed"])
+        full = pd.concat([df.assign(label=1)[negatives.columns], negatives], ignore_index=True)
+        full = full.sort_values("ehr_id", kind="stable").reset_index(drop=True)
+        for col in CATBOOST_CAT_FEATURES:
+            full[col] = full[col].astype(str)
+        return full
+
+    train_full = candidates(train)
+    test_full = candidates(test[test["ehr_id"].isin(train["ehr_id"].unique())])
+
+    def fit():
+        model = CatBoostRanker(random_seed=params["seed"], **CATBOOST_PARAMS)
+        model.fit(Pool(train_full[CATBOOST_FEATURES], label=train_full["label"],
+                       group_id=train_full["ehr_id"], cat_features=CATBOOST_CAT_FEATURES))
+        return model
+
+    model, fit_s = timed(fit)
+    pool = Pool(test_full[CATBOOST_FEATURES], cat_features=CATBOOST_CAT_FEATURES)
+    scores, batch_s = timed(model.predict, pool)
+    metrics = metrics_dict(ranking_metrics(test_full["ehr_id"], scores, test_full["label"], ks))
+
+    groups = dict(list(test_full.groupby("ehr_id")[CATBOOST_FEATURES]))
+    requests = [(groups[u],) for u in sample_users(list(groups), rng)]
+    n_users = test_full["ehr_id"].nunique()
+    return {"catboost": {
+        "fit_s": round(fit_s, 4),
+        "batch": {"users": n_users, "rows": len(test_full), "seconds": round(batch_s, 4),
+                  "users_per_s": round(n_users / batch_s, 1) if batch_s > 0 else None},
+        "latency_ms": latency_ms(model.predict, requests),
+        "metrics": metrics,
+        "candidates": f"test clicks + {N_NEGATIVES} negatives per user",
+    }}
+
+
+def bench_ann_index(vectors, ids, queries, exclude, k) -> dict:
+    """Recall@k IVF относительно точного поиска и пропускная способность по n_probe"""
+    from rec_sys_common.ann import ExactIndex, IVFIndex, recall_at_k
+
+    exact = ExactIndex(vectors, ids)
+    index, build_s = timed(IVFIndex, vectors, ids)
+    _, exact_s = timed(exact.search, queries, k, exclude)
+    n_queries = queries.shape[0]
+    probes = {}
+    for n_probe in ANN_PROBES:
+        index.n_probe = n_probe
+        _, search_s = timed(index.search, queries, k, exclude)
+        probes[n_probe] = {"recall": round(recall_at_k(index, queries, k, exclude, exact), 4),
+                           "queries_per_s": round(n_queries / max(search_s, 1e-9), 1)}
+    return {"items": len(exact), "queries": n_queries, "n_lists": len(index.centroids), "build_s": round(build_s, 3),
+            "exact_queries_per_s": round(n_queries / max(exact_s, 1e-9), 1), "n_probe": probes}
+
+
+def bench_ann(train, truth, params) -> dict:
+    """
+    ANN индексы (rec_sys_common/ann.py): recall@n против точного поиска.
+    TF-IDF — статья к статье по L2-нормированным строкам, ALS — пользователь
+    к статье по факторам с исключением просмотренного.
+    """
+    from content_recommender import make_vectorizer
+
+    n = params["n"]
+    rng = np.random.default_rng(params["seed"])
+    articles = train.drop_duplicates("article_id")
+    content = (articles["title"].fillna("") + " " + articles["tags"].fillna("").astype(str).str.replace(",", " ")
+               + " " + articles["rubric_title"].fillna(""))
+    tfidf = make_vectorizer().fit_transform(content).astype(np.float32)
+    rows = np.sort(rng.choice(tfidf.shape[0], min(tfidf.shape[0], LATENCY_SAMPLE), replace=False))
+    own = sparse.csr_matrix((np.ones(len(rows)), rows, np.arange(len(rows) + 1)), shape=(len(rows), tfidf.shape[0]))
+    results = {"ann_tfidf": bench_ann_index(tfidf, articles["article_id"].to_numpy(), tfidf[rows], own, n)}
+
+    try:
+        from implicit.als import AlternatingLeastSquares
+    except ImportError:
+        results["ann_als"] = {"skipped": "implicit не установлен"}
+        return results
+    from als_batch import als_factors
+
+    clicks = train.groupby(["ehr_id", "article_id"]).size().reset_index(name="weight")
+    user_codes, user_ids = pd.factorize(clicks["ehr_id"])
+    item_codes, item_ids = pd.factorize(clicks["article_id"])
+    interactions = sparse.csr_matrix((clicks["weight"], (user_codes, item_codes)),
+                                     shape=(len(user_ids), len(item_ids)))
+    model = AlternatingLeastSquares(random_state=params["seed"], **ALS_PARAMS)
+    model.fit(interactions, show_progress=False)
+    user_factors, item_factors = als_factors(model)
+    users = np.sort(rng.choice(len(user_ids), min(len(user_ids), LATENCY_SAMPLE), replace=False))
+    results["ann_als"] = bench_ann_index(item_factors, np.asarray(item_ids), user_factors[users],
+                                         interactions[users], n)
+    return results
+
+
+def run_model(name: str, split_dir: str, params: dict) -> dict:
+    """Точка входа дочернего процесса: один бенчмарк и его пиковый RSS"""
+    split_dir = Path(split_dir)
+    train = pd.read_parquet(split_dir / "train.parquet")
+    truth = pd.read_parquet(split_dir / "truth.parquet")
+    if name == "top":
+        results = bench_top(train, truth, params)
+    elif name == "tfidf":
+        results = bench_tfidf(train, truth, params)
+    elif name == "als":
+        results = bench_als(train, truth, params)
+    elif name == "catboost":
+        results = bench_catboost(train, pd.read_parquet(split_dir / "test.parquet"), params)
+    elif name == "ann":
+        results = bench_ann(train, truth, params)
+    else:
+        raise ValueError(f"неизвестная модель {name}")
+
+    rss = peak_rss_mb()
+    for model_result in results.values():
+        if "batch" in model_result:
+            model_result["peak_rss_mb"] = rss
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Запуск и сравнение
+# ---------------------------------------------------------------------------
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_runs(previous: dict, current: dict):
+    """Печать изменений ключевых показателей относительно прошлого прогона"""
+    watched = [("fit_s", ("fit_s",)), ("users/s", ("batch", "users_per_s")),
+               ("p99 ms", ("latency_ms", "p99")), ("RSS MB", ("peak_rss_mb",))]
+    print("\nСравнение с", previous["run"].get("timestamp"), previous["run"].get("commit"))
+    for name, cur in current["models"].items():
+        prev = previous["models"].get(name)
+        if not prev or "skipped" in cur or "error" in cur:
+            continue
+        line = []
+        for label, keys in watched:
+            a, b = prev, cur
+            for key in keys:
+                a = a.get(key) if isinstance(a, dict) else None
+                b = b.get(key) if isinstance(b, dict) else None
+            if a and b:
+                line.append(f"{label} {b / a - 1:+.1%}")
+        for k, values in (cur.get("metrics") or {}).items():
+            old = (prev.get("metrics") or {}).get(k, {})
+            for metric in ("NDCG", "HitRate"):
+                if metric in old:
+                    line.append(f"{metric}@{k} {values[metric] - old[metric]:+.4f}")
+        print(f"  {name:12s}", ", ".join(line))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк рекомендателей")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--data", default=str(ROOT / "cuprum_3.xlsx"), help="xlsx с событиями")
+    source.add_argument("--synthetic", action="store_true", help="синтетические данные")
+    parser.add_argument("--scale", type=float, default=1, help="масштаб синтетики (1, 10, 100)")
+    parser.add_argument("--models", default=",".join(MODELS), help="через запятую: " + ",".join(MODELS))
+    parser.add_argument("--n", type=int, default=10, help="длина выдачи")
+    parser.add_argument("--ks", default="5,10", help="K для метрик")
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--tfidf-neighbors", type=int, default=None,
+                        help="top-K соседей для TF-IDF (по умолчанию плотные матрицы)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="JSON с результатами")
+    parser.add_argument("--compare", default=None, help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        from synthetic import scaled_events
+        events = scaled_events(args.scale, seed=args.seed)
+        dataset = f"synthetic x{args.scale:g}"
+    else:
+        events = load_real_events(args.data)
+        dataset = str(args.data)
+    train, test, truth, cutoff = temporal_split(events)
+
+    params = {"n": args.n, "ks": [int(k) for k in args.ks.split(",")], "batch_size": args.batch_size,
+              "tfidf_neighbors": args.tfidf_neighbors, "seed": args.seed}
+    report = {
+        "run": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "dataset": dataset,
+            "params": params,
+            "split": {"cutoff": str(cutoff), "quantile": TEST_QUANTILE,
+                      "train_events": len(train), "test_events": len(test),
+                      "users": int(events["ehr_id"].nunique()), "articles": int(events["article_id"].nunique()),
+                      "eval_users": int(truth["ehr_id"].nunique())},
+        },
+        "models": {},
+    }
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as split_dir:
+        train.to_parquet(Path(split_dir) / "train.parquet", index=False)
+        test.to_parquet(Path(split_dir) / "test.parquet", index=False)
+        truth.to_parquet(Path(split_dir) / "truth.parquet", index=False)
+        del events, train, test
+
+        for name in args.models.split(","):
+            print(f"{name}...", flush=True)
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    report["models"].update(pool.submit(run_model, name, split_dir, params).result())
+                except Exception as e:  # в т.ч. процесс убит по памяти
+                    report["models"][name] = {"error": repr(e)}
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+    for name, model_result in report["models"].items():
+        if "metrics" in model_result and model_result["metrics"]:
+            k = str(max(params["ks"]))
+            m = model_result["metrics"][k]
+            line = f"{name:12s} NDCG@{k}={m['NDCG']:.4f} HitRate@{k}={m['HitRate']:.4f}"
+            if "batch" in model_result:
+                line += (f" fit={model_result['fit_s']}s users/s={model_result['batch']['users_per_s']}"
+                         f" p99={model_result['latency_ms']['p99']}ms RSS={model_result.get('peak_rss_mb')}MB")
+            print(line)
+        else:
+            print(f"{name:12s} {model_result}")
+    print(f"Результаты: {output}")
+
+    if args.compare:
+        compare_runs(json.loads(Path(args.compare).read_text()), report)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.segments import AGE_BOUNDS
+
+# Базовый масштаб (scale=1) — порядок размера рабочей выгрузки
+BASE_USERS = 20_000
+BASE_ARTICLES = 2_000
+BASE_EVENTS = 200_000
+
+RUBRICS = ["Кардиология", "Питание", "Детское здоровье", "Красота", "Неврология",
+           "Гастроэнтерология", "Эндокринология", "Иммунитет"]
+WORDS = ["сердце", "давление", "диета", "сон", "спорт", "витамины", "кожа", "зубы",
+         "иммунитет", "стресс", "беременность", "дети", "гормоны", "печень", "желудок",
+         "аллергия", "простуда", "грипп", "глаза", "спина", "холестерин", "сахар",
+         "мигрень", "суставы", "вес", "вакцинация", "анализы", "профилактика"]
+FORMATS = ["text", "video", "test"]
+
+
+def synthetic_articles(n_articles: int, rng: np.random.Generator) -> pd.DataFrame:
+    """Каталог статей с рубриками, тегами и заголовками из словаря рубрики"""
+    rubric = rng.integers(0, len(RUBRICS), n_articles)
+    # У каждой рубрики свой сдвиг по словарю, чтобы TF-IDF видел тематику
+    word_idx = (rubric[:, None] * 3 + rng.integers(0, 8, (n_articles, 6))) % len(WORDS)
+    words = np.array(WORDS, dtype=object)[word_idx]
+    return pd.DataFrame({
+        "article_id": np.arange(1, n_articles + 1, dtype=np.int64),
+        "title": [" ".join(w) for w in words[:, :4]],
+        "tags": [",".join(w) for w in words[:, 4:]],
+        "rubric_title": np.array(RUBRICS, dtype=object)[rubric],
+        "formats": rng.choice(FORMATS, n_articles, p=[0.7, 0.2, 0.1]),
+        "published_date": pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 540, n_articles), "D"),
+        "url": [f"https://example.org/articles/{i}" for i in range(1, n_articles + 1)],
+    })
+
+
+def synthetic_events(n_users: int = BASE_USERS,
+                     n_articles: int = BASE_ARTICLES,
+                     n_events: int = BASE_EVENTS,
+                     seed: int = 0) -> pd.DataFrame:
+    """
+    Синтетические клики в схеме очищенных событий (как после rename пол/возраст).
+
+    - популярность статей внутри рубрики — Zipf;
+    - у каждого сегмента (пол, возрастная группа) свое распределение по рубрикам,
+      поэтому сегментный топ информативнее общего;
+    - активность пользователей — логнормальная, с длинным хвостом;
+    - created_at равномерно за 2024 год.
+
+    Returns:
+    DataFrame ehr_id, article_id, action_type, created_at, gender, age,
+    title, tags, rubric_title, formats, views, published_date, url
+    """
+    rng = np.random.default_rng(seed)
+    articles = synthetic_articles(n_articles, rng)
+
+    # Пользователи
+    gender = rng.integers(1, 3, n_users)
+    age = np.clip(rng.normal(45, 16, n_users), 14, 90).astype(np.int64)
+    segment = (gender - 1) * (len(AGE_BOUNDS) + 1) + np.searchsorted(AGE_BOUNDS, age, side="right")
+    activity = rng.lognormal(0, 1, n_users)
+    users = rng.choice(n_users, size=n_events, p=activity / activity.sum())
+
+    # Предпочтения сегментов по рубрикам
+    n_segments = 2 * (len(AGE_BOUNDS) + 1)
+    preference = rng.dirichlet(np.full(len(RUBRICS), 0.5), n_segments)
+    cum_preference = np.cumsum(preference, axis=1)
+    event_rubric = (rng.random(n_events)[:, None] > cum_preference[segment[users]]).sum(axis=1)
+    event_rubric = np.minimum(event_rubric, len(RUBRICS) - 1)
+
+    # Статья внутри рубрики: ранг по Zipf
+    rubric_codes = pd.Categorical(articles["rubric_title"], categories=RUBRICS).codes
+    order = np.argsort(rubric_codes, kind="stable")
+    rubric_size = np.bincount(rubric_codes, minlength=len(RUBRICS))
+    rubric_start = np.concatenate([[0], np.cumsum(rubric_size)[:-1]])
+    # Пустые рубрики (маленький каталог) заменяем на самую большую
+    empty = rubric_size[event_rubric] == 0
+    event_rubric[empty] = np.argmax(rubric_size)
+    rank = (rng.zipf(1.4, n_events) - 1) % rubric_size[event_rubric]
+    article_row = order[rubric_start[event_rubric] + rank]
+
+    events = pd.DataFrame({
+        "ehr_id": 1_000_000 + users,
+        "article_row": article_row,
+        "action_type": "CLICKED",
+        "created_at": pd.Timestamp("2024-01-01")
+                      + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, n_events), "s"),
+        "gender": gender[users],
+        "age": age[users],
+    })
+    articles["views"] = np.bincount(article_row, minlength=n_articles) * 10 + rng.integers(0, 50, n_articles)
+
+    events = events.join(articles, on="article_row").drop(columns="article_row")
+    return events.sort_values("created_at", kind="stable").reset_index(drop=True)
+
+
+def scaled_events(scale: float = 1, seed: int = 0) -> pd.DataFrame:
+    """Синтетика в scale раз больше базовой (пользователи, каталог и клики)"""
+    return synthetic_events(
+        n_users=int(BASE_USERS * scale),
+        n_articles=int(BASE_ARTICLES * scale),
+        n_events=int(BASE_EVENTS * scale),
+        seed=seed,
+    )
@@ -0,0 +1,452 @@
+"""
+Подбор гиперпараметров ALS и CatBoostRanker (optuna) на временном сплите
+бенчмарка (run_benchmarks.temporal_split).
+
+Испытания оцениваются на валидации — последнем временном отрезке train
+(тот же temporal_split внутри train), тест бенчмарка в подборе не
+участвует: на нем оценивается только лучшая модель, переобученная на
+всем train.
+
+Данные готовятся один раз в родительском процессе: CSR матрицы и
+разметка валидации для ALS, квантованные пулы CatBoost (обучение и валидация).
+Воркеры открывают их только на чтение — массивы через mmap, пулы из
+quantized-файлов, — поэтому память не растет с числом воркеров и ничего
+не пересчитывается на каждое испытание.
+
+Испытания идут параллельно в процессах (spawn) с общим журналом optuna
+(JournalFileStorage). У каждого воркера явный бюджет потоков: OpenMP —
+threads, BLAS — 1 (implicit и CatBoost параллелят сами, вложенные потоки
+BLAS дают oversubscription), workers × threads не больше числа ядер.
+Слабые испытания останавливаются MedianPruner по промежуточному NDCG@k
+на валидации.
+
+Журнал, таблица испытаний и лучшие параметры сохраняются в
+benchmarks/results/tuning, лучшая модель переобучается на всем train,
+оценивается на тесте и публикуется в локальный реестр артефактов
+(rec_sys_common/registry.py).
+
+Примеры:
+    python benchmarks/tune.py --model als --trials 50 --workers 4
+    python benchmarks/tune.py --synthetic --model catboost --trials 20 --workers 2 --threads 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in [ROOT, ROOT / "rec_sys_als", ROOT / "benchmarks"]:
+    sys.path.append(str(path))
+
+from rec_sys_common import registry
+from rec_sys_common.batch import flatten_recommendations, top_n_excluding
+from rec_sys_common.metrics import topn_metrics
+from run_benchmarks import N_NEGATIVES, RESULTS_DIR, load_real_events, temporal_split
+
+TUNING_DIR = RESULTS_DIR / "tuning"
+MODELS = ["als", "catboost"]
+# Пользователей валидации для промежуточного NDCG ALS (фиксированная выборка)
+EVAL_USERS = 5000
+# Переменные окружения пулов потоков BLAS; OpenMP — отдельно (OMP_NUM_THREADS)
+BLAS_THREAD_ENV = ["OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+# ---------------------------------------------------------------------------
+# Общий кеш данных
+# ---------------------------------------------------------------------------
+
+def prepare_als_data(train: pd.DataFrame, truth: pd.DataFrame, directory: Path, seed: int,
+                     eval_users: int = EVAL_USERS):
+    """
+    Матрица кликов train (float32, индексы int32 — как ждет implicit без
+    копий) и разметка truth для выборки пользователей (eval_users=None — все).
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    clicks = train.groupby(["ehr_id", "article_id"]).size().reset_index(name="weight")
+    user_codes, user_ids = pd.factorize(clicks["ehr_id"])
+    item_codes, item_ids = pd.factorize(clicks["article_id"])
+    interactions = sparse.csr_matrix((clicks["weight"].to_numpy(np.float32), (user_codes, item_codes)),
+                                     shape=(len(user_ids), len(item_ids)))
+    interactions.indices = interactions.indices.astype(np.int32)
+    interactions.indptr = interactions.indptr.astype(np.int32)
+
+    rng = np.random.default_rng(seed)
+    rows = user_ids.get_indexer(truth["ehr_id"].unique())
+    if eval_users is not None:
+        rows = rng.choice(rows, min(eval_users, len(rows)), replace=False)
+    rows = np.sort(rows)
+    eval_truth = truth[truth["ehr_id"].isin(user_ids[rows])][["ehr_id", "article_id"]]
+
+    registry.save_csr(directory, "interactions", interactions)
+    registry.save_array(directory, "user_ids", user_ids.to_numpy())
+    registry.save_array(directory, "item_ids", item_ids.to_numpy())
+    registry.save_array(directory, "eval_rows", rows.astype(np.int64))
+    registry.save_table(directory, "truth", eval_truth.reset_index(drop=True))
+
+
+def load_als_data(directory: Path) -> dict:
+    return {
+        "interactions": registry.load_csr(directory, "interactions"),
+        "user_ids": registry.load_array(directory, "user_ids"),
+        "item_ids": registry.load_array(directory, "item_ids"),
+        "eval_rows": registry.load_array(directory, "eval_rows"),
+        "truth": registry.load_table(directory, "truth"),
+    }
+
+
+def candidate_frame(store, df: pd.DataFrame, articles, seed: int, clicked: bool):
+    """Клики df + N_NEGATIVES негативов на пользователя, признаки из FeatureStore, сортировка по группе"""
+    from rec_sys_common.features import RANKING_FEATURES
+    from rec_sys_common.negatives import generate_negative_samples
+
+    negatives = generate_negative_samples(df, articles, N_NEGATIVES, seed=seed)
+    full = pd.concat([df[["ehr_id", "article_id"]].assign(label=1), negatives[["ehr_id", "article_id", "label"]]],
+                     ignore_index=True).sort_values("ehr_id", kind="stable")
+    X = store.pair_frame(full["ehr_id"], full["article_id"], RANKING_FEATURES,
+                         clicked=(full["label"] == 1) if clicked else None)
+    return X, full["label"].to_numpy(), full["ehr_id"].to_numpy()
+
+
+def prepare_catboost_data(train: pd.DataFrame, test: pd.DataFrame, directory: Path, seed: int):
+    """
+    Квантованные пулы train и test (валидации или теста бенчмарка) — как в ноутбуке rec_sys_catboost:
+    признаки из FeatureStore по train, клик позитива вычитается из счетчиков.
+    Квантование (границы признаков) делается один раз, воркеры читают
+    готовые файлы.
+
+    Returns:
+    FeatureStore — публикуется вместе с лучшей моделью
+    """
+    from catboost import Pool
+    from rec_sys_common.features import CAT_FEATURES, FeatureStore
+
+    directory.mkdir(parents=True, exist_ok=True)
+    articles = pd.unique(pd.concat([train["article_id"], test["article_id"]]))
+    store = FeatureStore.from_events(train)
+    X, label, group = candidate_frame(store, train, articles, seed, clicked=True)
+    train_pool = Pool(X, label=label, group_id=group, cat_features=CAT_FEATURES)
+    train_pool.quantize()
+    train_pool.save(str(directory / "train.quantized"))
+    train_pool.save_quantization_borders(str(directory / "borders.tsv"))
+
+    # Новые статьи и пользователи теста — в store без счетчиков (клики теста — метки);
+    # eval_set квантуется теми же границами, что и train
+    store.update(test, count_events=False)
+    X, label, group = candidate_frame(store, test, articles, seed, clicked=False)
+    test_pool = Pool(X, label=label, group_id=group, cat_features=CAT_FEATURES)
+    test_pool.quantize(input_borders=str(directory / "borders.tsv"))
+    test_pool.save(str(directory / "test.quantized"))
+    return store
+
+
+def load_catboost_data(directory: Path) -> dict:
+    from catboost import Pool
+    return {"train": Pool(f"quantized://{directory / 'train.quantized'}"),
+            "test": Pool(f"quantized://{directory / 'test.quantized'}")}
+
+
+# ---------------------------------------------------------------------------
+# Испытания
+# ---------------------------------------------------------------------------
+
+def als_ndcg(user_factors, item_factors, data: dict, k: int, batch_size: int = 1024) -> float:
+    """NDCG@k ALS на выборке пользователей разметки с исключением просмотренного в train"""
+    rows = data["eval_rows"]
+    chunks = []
+    for start in range(0, len(rows), batch_size):
+        block = rows[start:start + batch_size]
+        scores = (user_factors[block] @ item_factors.T).astype(np.float64)
+        top, top_scores = top_n_excluding(scores, data["interactions"][block], k)
+        users, top, ranks, _ = flatten_recommendations(data["user_ids"][block], top, top_scores)
+        chunks.append(pd.DataFrame({"ehr_id": users, "article_id": data["item_ids"][top], "rank": ranks}))
+    recs = pd.concat(chunks, ignore_index=True)
+    return float(topn_metrics(recs, data["truth"], [k]).loc[k, "NDCG"])
+
+
+def suggest_als(trial) -> dict:
+    return dict(
+        factors=trial.suggest_int("factors", 16, 256, log=True),
+        regularization=trial.suggest_float("regularization", 1e-4, 1.0, log=True),
+        alpha=trial.suggest_float("alpha", 1.0, 100.0, log=True),
+        iterations=trial.suggest_int("iterations", 5, 50),
+    )
+
+
+def make_als(params: dict, threads: int, seed: int):
+    from implicit.als import AlternatingLeastSquares
+    return AlternatingLeastSquares(random_state=seed, num_threads=threads, **params)
+
+
+def als_objective(trial, data: dict, threads: int, seed: int, k: int, eval_every: int) -> float:
+    """
+    ALS с промежуточным NDCG@k каждые eval_every итераций: implicit вызывает
+    callback после каждой итерации, факторы модели уже обновлены на месте.
+    """
+    import optuna
+    from als_batch import als_factors
+
+    params = suggest_als(trial)
+    model = make_als(params, threads, seed)
+    scores = []
+
+    def callback(iteration, elapsed, loss):
+        step = iteration + 1
+        if step % eval_every and step != params["iterations"]:
+            return
+        scores.append(als_ndcg(*als_factors(model), data, k))
+        trial.report(scores[-1], step)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    model.fit(data["interactions"], show_progress=False, callback=callback)
+    return scores[-1]
+
+
+def suggest_catboost(trial) -> dict:
+    return dict(
+        loss_function=trial.suggest_categorical("loss_function", ["YetiRank", "PairLogit", "QueryRMSE"]),
+        iterations=trial.suggest_int("iterations", 100, 1000, step=50),
+        learning_rate=trial.suggest_float("learning_rate", 0.01, 0.3, log=True),
+        depth=trial.suggest_int("depth", 4, 10),
+        l2_leaf_reg=trial.suggest_float("l2_leaf_reg", 1.0, 30.0, log=True),
+    )
+
+
+def catboost_params(params: dict, threads: int, seed: int, k: int) -> dict:
+    # use_best_model=False: eval_set — это оценка испытания, лучшая итерация по нему — подглядывание;
+    # allow_writing_files=False: воркеры не делят catboost_info
+    return dict(params, eval_metric=f"NDCG:top={k}", use_best_model=False, thread_count=threads,
+                random_seed=seed, allow_writing_files=False, verbose=0)
+
+
+class CatBoostPruning:
+    """
+    Callback CatBoost: NDCG на eval_set каждые eval_every итераций в optuna.
+    Исключение из C++ цикла обучения не пробрасывается, поэтому обучение
+    останавливается возвратом False, а TrialPruned бросается после fit.
+    """
+
+    def __init__(self, trial, eval_every: int):
+        self.trial = trial
+        self.eval_every = eval_every
+        self.score = None
+        self.pruned = False
+
+    def after_iteration(self, info) -> bool:
+        if info.iteration % self.eval_every:
+            return True
+        metrics = info.metrics["validation"]
+        self.score = next(values[-1] for name, values in metrics.items() if name.startswith("NDCG"))
+        self.trial.report(self.score, info.iteration)
+        self.pruned = self.trial.should_prune()
+        return not self.pruned
+
+
+def catboost_objective(trial, data: dict, threads: int, seed: int, k: int, eval_every: int) -> float:
+    import optuna
+    from catboost import CatBoostRanker
+
+    params = suggest_catboost(trial)
+    pruning = CatBoostPruning(trial, eval_every)
+    model = CatBoostRanker(**catboost_params(params, threads, seed, k))
+    model.fit(data["train"], eval_set=data["test"], callbacks=[pruning])
+    if pruning.pruned:
+        raise optuna.TrialPruned()
+    return catboost_ndcg(model)
+
+
+def catboost_ndcg(model) -> float:
+    """NDCG на eval_set после последней итерации"""
+    validation = model.get_evals_result()["validation"]
+    return float(next(values[-1] for name, values in validation.items() if name.startswith("NDCG")))
+
+
+OBJECTIVES = {"als": (load_als_data, als_objective), "catboost": (load_catboost_data, catboost_objective)}
+
+
+# ---------------------------------------------------------------------------
+# Воркеры
+# ---------------------------------------------------------------------------
+
+def thread_budget(workers: int, threads: int = None) -> int:
+    """Потоков на воркер: заданное значение или поровну делим ядра"""
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    if workers * threads > (os.cpu_count() or 1):
+        print(f"Предупреждение: {workers} воркеров × {threads} потоков больше {os.cpu_count()} ядер")
+    return threads
+
+
+def set_thread_env(threads: int):
+    """
+    Окружение дочерних процессов. spawn-воркер импортирует numpy заново,
+    поэтому пулы потоков создаются уже с этими ограничениями.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    for name in BLAS_THREAD_ENV:
+        os.environ[name] = "1"
+
+
+def journal_storage(path: Path):
+    import optuna
+    return optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(str(path)))
+
+
+def make_pruner(eval_every: int):
+    import optuna
+    # Первые 5 испытаний доходят до конца; дальше — отсечение по медиане на том же шаге
+    return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=eval_every)
+
+
+def run_worker(worker: int, model: str, data_dir: str, storage_path: str, study_name: str,
+               n_trials: int, threads: int, params: dict) -> int:
+    """Точка входа воркера: свои n_trials испытаний в общем исследовании"""
+    import optuna
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    load, objective = OBJECTIVES[model]
+    data = load(Path(data_dir))
+    study = optuna.load_study(study_name=study_name, storage=journal_storage(Path(storage_path)),
+                              sampler=optuna.samplers.TPESampler(seed=params["seed"] + worker),
+                              pruner=make_pruner(params["eval_every"]))
+    study.optimize(lambda trial: objective(trial, data, threads, params["seed"], params["k"], params["eval_every"]),
+                   n_trials=n_trials, gc_after_trial=True)
+    return n_trials
+
+
+# ---------------------------------------------------------------------------
+# Лучшая модель
+# ---------------------------------------------------------------------------
+
+def publish_best(model: str, best_params: dict, data_dir: Path, store, artifacts, threads: int,
+                 params: dict, meta: dict):
+    """
+    Переобучение с лучшими параметрами на всем train (кеш теста бенчмарка),
+    оценка на тесте и публикация в реестр.
+
+    Returns:
+    (путь опубликованной версии, NDCG@k на тесте)
+    """
+    data = OBJECTIVES[model][0](data_dir)
+    key = f"test_ndcg@{params['k']}"
+    if model == "als":
+        from als_batch import als_factors, save_als_artifacts
+        als = make_als(best_params, threads, params["seed"])
+        als.fit(data["interactions"], show_progress=False)
+        meta[key] = als_ndcg(*als_factors(als), data, params["k"])
+        return str(save_als_artifacts(als, data["interactions"], data["user_ids"], data["item_ids"],
+                                      root=artifacts, name="als", meta=meta)), meta[key]
+
+    from catboost import CatBoostRanker
+    from rec_sys_common.features import CAT_FEATURES, RANKING_FEATURES
+    ranker = CatBoostRanker(**catboost_params(best_params, threads, params["seed"], params["k"]))
+    # eval_set без use_best_model и ранней остановки на обучение не влияет — только оценка
+    ranker.fit(data["train"], eval_set=data["test"])
+    meta[key] = catboost_ndcg(ranker)
+    store.save(artifacts, name="features")
+    return str(registry.save_catboost(artifacts, ranker, RANKING_FEATURES, CAT_FEATURES,
+                                      name="catboost_ranker", meta=meta)), meta[key]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Подбор гиперпараметров ALS и CatBoostRanker")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--data", default=str(ROOT / "cuprum_3.xlsx"), help="xlsx с событиями")
+    source.add_argument("--synthetic", action="store_true", help="синтетические данные")
+    parser.add_argument("--scale", type=float, default=1, help="масштаб синтетики")
+    parser.add_argument("--model", choices=MODELS, required=True)
+    parser.add_argument("--trials", type=int, default=40, help="всего испытаний")
+    parser.add_argument("--workers", type=int, default=2, help="параллельных процессов")
+    parser.add_argument("--threads", type=int, default=None, help="потоков на воркер (по умолчанию ядра / workers)")
+    parser.add_argument("--k", type=int, default=10, help="NDCG@k")
+    parser.add_argument("--eval-every", type=int, default=None,
+                        help="шаг промежуточного NDCG (по умолчанию 5 итераций ALS, 50 CatBoost)")
+    parser.add_argument("--study", default=None, help="имя исследования (повторный запуск продолжает его)")
+    parser.add_argument("--artifacts", default=str(TUNING_DIR / "artifacts"), help="реестр для лучшей модели")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    import optuna
+
+    if args.synthetic:
+        from synthetic import scaled_events
+        events = scaled_events(args.scale, seed=args.seed)
+    else:
+        events = load_real_events(args.data)
+    train, test, truth, cutoff = temporal_split(events)
+    # Валидация для испытаний — последний временной отрезок train; test только для лучшей модели
+    fit_train, valid, valid_truth, valid_cutoff = temporal_split(train)
+
+    threads = thread_budget(args.workers, args.threads)
+    params = {"seed": args.seed, "k": args.k,
+              "eval_every": args.eval_every or (5 if args.model == "als" else 50)}
+    study_name = args.study or f"{args.model}-{datetime.now():%Y%m%d-%H%M%S}"
+    TUNING_DIR.mkdir(parents=True, exist_ok=True)
+    storage_path = TUNING_DIR / f"{study_name}.journal"
+    study = optuna.create_study(study_name=study_name, storage=journal_storage(storage_path),
+                                direction="maximize", load_if_exists=True)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        valid_dir, test_dir = data_dir / "valid", data_dir / "test"
+        store = None
+        if args.model == "als":
+            prepare_als_data(fit_train, valid_truth, valid_dir, args.seed)
+        else:
+            prepare_catboost_data(fit_train, valid, valid_dir, args.seed)
+
+        set_thread_env(threads)
+        workers = min(args.workers, args.trials)
+        shares = [args.trials // workers + (i < args.trials % workers) for i in range(workers)]
+        print(f"Исследование {study_name}: {args.trials} испытаний, {workers} воркеров × {threads} потоков")
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(run_worker, i, args.model, str(valid_dir), str(storage_path), study_name,
+                                   share, threads, params) for i, share in enumerate(shares)]
+            for future in futures:
+                future.result()
+
+        study = optuna.load_study(study_name=study_name, storage=journal_storage(storage_path))
+        states = pd.Series([t.state.name for t in study.trials]).value_counts().to_dict()
+        best = study.best_trial
+        meta = {"study": study_name, f"valid_ndcg@{args.k}": best.value, "params": best.params}
+        # Финальная оценка — на всех пользователях теста
+        if args.model == "als":
+            prepare_als_data(train, truth, test_dir, args.seed, eval_users=None)
+        else:
+            store = prepare_catboost_data(train, test, test_dir, args.seed)
+        artifact, test_ndcg = publish_best(args.model, best.params, test_dir, store, args.artifacts,
+                                           max(1, os.cpu_count() or 1), params, meta)
+
+    study.trials_dataframe().to_csv(TUNING_DIR / f"{study_name}_trials.csv", index=False)
+    summary = {
+        "study": study_name,
+        "model": args.model,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "dataset": f"synthetic x{args.scale:g}" if args.synthetic else str(args.data),
+        "split": {"cutoff": str(cutoff), "valid_cutoff": str(valid_cutoff), "train_events": len(fit_train),
+                  "valid_events": len(valid), "test_events": len(test)},
+        "workers": workers,
+        "threads_per_worker": threads,
+        "trials": states,
+        "best": {"number": best.number, f"valid_ndcg@{args.k}": best.value, f"test_ndcg@{args.k}": test_ndcg,
+                 "params": best.params},
+        "artifact": artifact,
+    }
+    output = TUNING_DIR / f"{study_name}.json"
+    output.write_text(json.dumps(summary, ensure_ascii=False, indent=2, default=str))
+    print(json.dumps(summary["best"], ensure_ascii=False, indent=2))
+    print(f"Результаты: {output}, лучшая модель: {artifact}")
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.batch import ParquetChunkWriter, flatten_recommendations, top_n_excluding
+from rec_sys_common.registry import save_als
+from rec_sys_common.snapshot import save_snapshot
+
+
+def als_factors(model):
+    """
+    Факторы пользователей и статей обученной ALS модели как numpy-массивы
+    (GPU-модель implicit переносится на CPU).
+    """
+    if not isinstance(model.user_factors, np.ndarray):
+        model = model.to_cpu()
+    return model.user_factors, model.item_factors
+
+
+def fold_in_factors(fixed_factors, rows, regularization=0.01, alpha=1.0):
+    """
+    Факторы пользователей (или статей) по их взаимодействиям при фиксированных
+    факторах другой стороны — один шаг ALS, как recalculate_user в implicit,
+    но сразу для блока строк.
+
+    Для строки u с весами r_ui и доверием c_ui = alpha * r_ui решается
+        (YᵀY + λI + Σ_i (c_ui − 1) y_i y_iᵀ) x_u = Σ_i c_ui y_i
+    YᵀY + λI общая для всех строк: строки, у которых все c_ui = 1, решаются
+    одним solve, остальным добавляется поправка только по их кликам.
+
+    Parameters:
+    fixed_factors: факторы другой стороны (статей для пользователей), n × k
+    rows: CSR матрица взаимодействий B × n
+    regularization: λ модели
+    alpha: масштаб доверия, как в AlternatingLeastSquares(alpha=...)
+
+    Returns:
+    факторы B × k (float32)
+    """
+    Y = np.asarray(fixed_factors, dtype=np.float64)
+    confidence = sparse.csr_matrix(rows, dtype=np.float64) * alpha
+    base = Y.T @ Y + regularization * np.eye(Y.shape[1])
+    b = np.asarray(confidence @ Y)
+    x = np.linalg.solve(base, b.T).T
+
+    extra = confidence.copy()
+    extra.data -= 1
+    extra.eliminate_zeros()
+    users = np.flatnonzero(np.diff(extra.indptr))
+    if len(users):
+        A = np.repeat(base[None], len(users), axis=0)
+        for j, u in enumerate(users):
+            start, end = extra.indptr[u], extra.indptr[u + 1]
+            Yu = Y[extra.indices[start:end]]
+            A[j] += (Yu * extra.data[start:end, None]).T @ Yu
+        x[users] = np.linalg.solve(A, b[users][:, :, None])[:, :, 0]
+    return x.astype(np.float32)
+
+
+def recommend_als_batch(model, interactions, user_rows, N=10, factors=None):
+    """
+    Рекомендации ALS для блока пользователей одним матричным произведением.
+
+    Эквивалент model.recommend(user_idx, interactions[user_idx], N=N) для
+    каждой строки блока: просмотренные статьи исключаются.
+
+    Parameters:
+    model: обученная AlternatingLeastSquares
+    interactions: CSR матрица взаимодействий пользователи × статьи
+    user_rows: индексы строк пользователей в interactions
+    N: количество рекомендаций
+    factors: заранее полученные als_factors(model), чтобы не извлекать их на каждый блок
+
+    Returns:
+    (индексы статей B×N, scores B×N); при нехватке кандидатов — индекс -1
+    """
+    user_factors, item_factors = factors if factors is not None else als_factors(model)
+    user_rows = np.asarray(user_rows)
+    scores = (user_factors[user_rows] @ item_factors.T).astype(np.float64)
+    return top_n_excluding(scores, interactions[user_rows], N)
+
+
+def recommend_als_frame(model, interactions, user_map, item_ids, ehr_ids, N=10, batch_size=4096):
+    """
+    Рекомендации ALS для списка пользователей в длинном формате.
+
+    Returns:
+    DataFrame ehr_id, article_id, rank (с 1); пользователи, которых нет
+    в user_map, пропускаются
+    """
+    factors = als_factors(model)
+    item_ids = np.asarray(item_ids)
+    ehr_ids = np.asarray([u for u in ehr_ids if u in user_map])
+    user_rows = np.array([user_map[u] for u in ehr_ids], dtype=np.int64)
+
+    chunks = []
+    for start in range(0, len(ehr_ids), batch_size):
+        rows, scores = recommend_als_batch(model, interactions, user_rows[start:start + batch_size], N, factors)
+        users, rows, ranks, _ = flatten_recommendations(ehr_ids[start:start + batch_size], rows, scores)
+        chunks.append(pd.DataFrame({'ehr_id': users, 'article_id': item_ids[rows], 'rank': ranks}))
+    if not chunks:
+        return pd.DataFrame(columns=['ehr_id', 'article_id', 'rank'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def generate_als_recommendations_for_all(model, interactions, user_ids, item_ids,
+                                         output_path="als_recommendations.parquet",
+                                         N=10, batch_size=4096):
+    """
+    Рекомендации ALS для всех пользователей с потоковой записью в parquet.
+
+    Parameters:
+    model: обученная AlternatingLeastSquares
+    interactions: CSR матрица взаимодействий (строки — user_ids, столбцы — item_ids)
+    user_ids: ehr_id в порядке строк interactions
+    item_ids: article_id в порядке столбцов interactions
+    output_path: куда писать parquet (ehr_id, article_id, rank, score)
+    N: количество рекомендаций на пользователя
+    batch_size: сколько пользователей скорить за одно матричное произведение
+
+    Returns:
+    путь к записанному файлу
+    """
+    factors = als_factors(model)
+    user_ids = np.asarray(user_ids)
+    item_ids = np.asarray(item_ids)
+
+    with ParquetChunkWriter(output_path) as writer:
+        for start in range(0, len(user_ids), batch_size):
+            block = np.arange(start, min(start + batch_size, len(user_ids)))
+            rows, scores = recommend_als_batch(model, interactions, block, N, factors)
+            ehr_ids, rows, ranks, scores = flatten_recommendations(user_ids[block], rows, scores)
+            writer.write(pd.DataFrame({
+                'ehr_id': ehr_ids,
+                'article_id': item_ids[rows],
+                'rank': ranks,
+                'score': scores
+            }))
+
+    print(f"Сохранено {writer.rows} рекомендаций для {len(user_ids)} пользователей в файл {output_path}")
+    return output_path
+
+
+def publish_als_snapshot(model, interactions, user_ids, item_ids, root="artifacts", N=10, batch_size=4096,
+                         segment_tops=None, global_top=None, name="snapshot"):
+    """
+    Рекомендации ALS для всех пользователей в снимок для сервинга
+    (rec_sys_common/snapshot.py): top-N и топы сегментов как memmap-массивы,
+    которые сервис читает без загрузки в память и подменяет без перезапуска.
+
+    Parameters:
+    как у generate_als_recommendations_for_all; segment_tops, global_top —
+    топы из prepare_recommendation_systems для пользователей вне снимка
+
+    Returns:
+    путь к опубликованной версии
+    """
+    factors = als_factors(model)
+    user_ids = np.asarray(user_ids)
+
+    def blocks():
+        for start in range(0, len(user_ids), batch_size):
+            block = np.arange(start, min(start + batch_size, len(user_ids)))
+            rows, scores = recommend_als_batch(model, interactions, block, N, factors)
+            yield user_ids[block], rows, scores
+
+    return save_snapshot(root, blocks(), len(user_ids), N, item_ids, segment_tops, global_top,
+                         name=name, meta={"model": "als"})
+
+
+def save_als_artifacts(model, interactions, user_ids, item_ids, root="artifacts", name="als", meta=None):
+    """
+    Публикует обученную ALS модель в реестр артефактов (rec_sys_common/registry.py)
+    в виде, пригодном для онлайн-сервиса (service/): факторы float32,
+    маппинги id и матрица взаимодействий. Сервис читает root/als/LATEST.
+
+    Returns:
+    путь к опубликованной версии
+    """
+    user_factors, item_factors = als_factors(model)
+    meta = dict(meta or {}, regularization=getattr(model, "regularization", None),
+                alpha=getattr(model, "alpha", 1.0), iterations=getattr(model, "iterations", None))
+    return save_als(root, user_factors, item_factors, user_ids, item_ids,
+                    sparse.csr_matrix(interactions), name=name, meta=meta)
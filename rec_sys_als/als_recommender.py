@@ -0,0 +1,186 @@
+import sys
+from pathlib import Path
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_als.als_batch import als_factors, fold_in_factors
+from rec_sys_common.ann import build_index
+
+
+class Recommendation(NamedTuple):
+    article_id: int
+    title: str
+    url: str
+    score: float
+
+
+class ALSRecommender:
+    """
+    Обертка над обученной ALS моделью для выдачи рекомендаций.
+
+    Все маппинги и метаданные статей строятся один раз при создании,
+    поэтому стоимость запроса — только скоринг модели.
+
+    Новые клики подмешиваются через partial_fit без полного переобучения:
+    факторы затронутых пользователей пересчитываются при фиксированных
+    факторах статей (fold-in), маппинги растут на месте.
+    """
+
+    def __init__(self, model, interactions, user_ids, item_ids, articles: pd.DataFrame, index: str = 'exact'):
+        """
+        Parameters:
+        model: обученная AlternatingLeastSquares
+        interactions: CSR матрица взаимодействий (строки — user_ids, столбцы — item_ids)
+        user_ids: ehr_id в порядке строк interactions
+        item_ids: article_id в порядке столбцов interactions
+        articles: DataFrame с article_id, title, url (можно сырые события — дубликаты убираются)
+        index: тип индекса по факторам статей (rec_sys_common/ann.py): 'exact' — точный
+            скоринг всего каталога, 'ivf' — приближенный для больших каталогов
+        """
+        self.model = model
+        self.interactions = interactions.tocsr()
+        self.user_ids = np.asarray(user_ids)
+        self.item_ids = np.asarray(item_ids)
+        self.user_map = {u: i for i, u in enumerate(self.user_ids.tolist())}
+        self.user_factors, self.item_factors = als_factors(model)
+        self.regularization = getattr(model, 'regularization', 0.01)
+        self.alpha = getattr(model, 'alpha', 1.0)
+        self.index = build_index(self.item_factors, self.item_ids, kind=index)
+
+        # Метаданные в порядке столбцов interactions
+        meta = (
+            articles[['article_id', 'title', 'url']]
+            .drop_duplicates('article_id')
+            .set_index('article_id')
+            .reindex(self.item_ids)
+        )
+        self.titles = meta['title'].fillna('').to_numpy(dtype=object)
+        self.urls = meta['url'].fillna('').to_numpy(dtype=object)
+
+    def partial_fit(self, events: pd.DataFrame):
+        """
+        Дообучение на новых кликах без полного fit.
+
+        1. Новые статьи добавляются столбцами; их факторы — fold-in по уже
+           известным пользователям, кликнувшим их (без таких кликов — нули).
+        2. Клики прибавляются к строкам interactions, новые пользователи
+           добавляются строками в конец.
+        3. Факторы всех затронутых пользователей пересчитываются одним
+           батчевым fold-in по факторам статей.
+
+        Модель при этом не меняется; периодический полный fit по-прежнему
+        нужен, чтобы обновить факторы статей по новым данным.
+
+        Parameters:
+        events: ehr_id, article_id и, если есть, weight (иначе 1), title, url
+
+        Returns:
+        self
+        """
+        weights = events['weight'] if 'weight' in events else pd.Series(1.0, index=events.index)
+        clicks = (
+            pd.DataFrame({'ehr_id': events['ehr_id'], 'article_id': events['article_id'], 'weight': weights})
+            .groupby(['ehr_id', 'article_id'], as_index=False, sort=False)['weight'].sum()
+        )
+        if clicks.empty:
+            return self
+
+        # Новые статьи — в конец столбцов вместе с метаданными
+        item_index = pd.Index(self.item_ids)
+        new_items = pd.unique(clicks.loc[item_index.get_indexer(clicks['article_id']) < 0, 'article_id'])
+        if len(new_items):
+            meta = (
+                events.drop_duplicates('article_id')
+                .set_index('article_id')
+                .reindex(new_items, columns=['title', 'url'])
+            )
+            self.item_ids = np.concatenate([self.item_ids, new_items])
+            self.titles = np.concatenate([self.titles, meta['title'].fillna('').to_numpy(dtype=object)])
+            self.urls = np.concatenate([self.urls, meta['url'].fillna('').to_numpy(dtype=object)])
+            item_index = pd.Index(self.item_ids)
+
+        # Новые пользователи — в конец строк
+        new_users = [u for u in pd.unique(clicks['ehr_id']).tolist() if u not in self.user_map]
+        for u in new_users:
+            self.user_map[u] = len(self.user_map)
+        if new_users:
+            self.user_ids = np.concatenate([self.user_ids, np.asarray(new_users, dtype=self.user_ids.dtype)])
+
+        n_users, n_items = len(self.user_ids), len(self.item_ids)
+        rows = clicks['ehr_id'].map(self.user_map).to_numpy()
+        cols = item_index.get_indexer(clicks['article_id'])
+        indptr = np.concatenate([self.interactions.indptr,
+                                 np.full(n_users - self.interactions.shape[0], self.interactions.indptr[-1])])
+        old = sparse.csr_matrix((self.interactions.data, self.interactions.indices, indptr), shape=(n_users, n_items))
+        self.interactions = (old + sparse.csr_matrix((clicks['weight'].to_numpy(dtype=old.dtype), (rows, cols)),
+                                                      shape=(n_users, n_items))).tocsr()
+
+        user_factors = np.zeros((n_users, self.user_factors.shape[1]), dtype=np.float32)
+        user_factors[:len(self.user_factors)] = self.user_factors
+        if len(new_items):
+            # Новые пользователи пока с нулевыми факторами и в fold-in статей не участвуют
+            item_factors = fold_in_factors(user_factors, self.interactions[:, -len(new_items):].T.tocsr(),
+                                           self.regularization, self.alpha)
+            self.item_factors = np.vstack([self.item_factors, item_factors]).astype(np.float32)
+            self.index.add(item_factors, new_items)
+
+        touched = np.unique(rows)
+        user_factors[touched] = fold_in_factors(self.item_factors, self.interactions[touched],
+                                                self.regularization, self.alpha)
+        self.user_factors = user_factors
+        return self
+
+    def similar_items(self, article_id, N: int = 10) -> List[Recommendation]:
+        """
+        Похожие статьи по факторам ALS (скалярное произведение), без самой статьи.
+
+        Returns:
+        список Recommendation; пустой, если статьи нет в модели
+        """
+        item_idx = self.index.row(article_id)
+        if item_idx < 0:
+            return []
+        item_idxs, scores = self.index.search(self.item_factors[item_idx], N, exclude=[item_idx])
+        return self._records(item_idxs, scores)
+
+    def _records(self, item_idxs: np.ndarray, scores: np.ndarray) -> List[Recommendation]:
+        valid = item_idxs >= 0
+        item_idxs, scores = item_idxs[valid], scores[valid]
+        return list(map(Recommendation, self.item_ids[item_idxs].tolist(),
+                        self.titles[item_idxs], self.urls[item_idxs], scores.tolist()))
+
+    def recommend(self, ehr_id, N: int = 10) -> List[Recommendation]:
+        """
+        Рекомендации для одного пользователя (без уже просмотренных статей).
+
+        Returns:
+        список Recommendation по убыванию score; пустой, если пользователя нет в модели
+        """
+        user_idx = self.user_map.get(ehr_id)
+        if user_idx is None:
+            return []
+        seen = self.interactions.indices[self.interactions.indptr[user_idx]:self.interactions.indptr[user_idx + 1]]
+        item_idxs, scores = self.index.search(self.user_factors[user_idx], N, exclude=seen)
+        return self._records(item_idxs, scores)
+
+    def recommend_batch(self, ehr_ids, N: int = 10) -> List[List[Recommendation]]:
+        """
+        Рекомендации для списка пользователей одним матричным произведением.
+
+        Returns:
+        списки Recommendation в порядке ehr_ids; для неизвестных пользователей — пустые
+        """
+        rows = [self.user_map.get(ehr_id) for ehr_id in ehr_ids]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        result = [[] for _ in rows]
+        if not known:
+            return result
+        user_rows = [rows[i] for i in known]
+        item_idxs, scores = self.index.search(self.user_factors[user_rows], N, exclude=self.interactions[user_rows])
+        for i, user_items, user_scores in zip(known, item_idxs, scores):
+            result[i] = self._records(user_items, user_scores)
+        return result
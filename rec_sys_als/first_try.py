@@ -1,4 +1,6 @@
 import logging
+import sys
+from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -6,7 +8,10 @@ from scipy.sparse import coo_matrix
 from implicit.als import AlternatingLeastSquares
 from implicit.nearest_neighbours import bm25_weight
 
-data = pd.read_excel("cuprum_3.xlsx", sheet_name="Лист4") #cuprum/Лист4/Лист2/Лист1
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.loader import load_events
+
+data = load_events("cuprum_3.xlsx", sheet_name="Лист4") #cuprum/Лист4/Лист2/Лист1
 data
 
 data.drop(columns=["esb_ehr_id","patientnet_ehr_id"], inplace=True)
@@ -102,48 +107,27 @@ recs_df.drop(columns=["score"], inplace=True)
 recs_df
 
 
+# Маппинги и метаданные статей строятся один раз, а не на каждый вызов
+from als_recommender import ALSRecommender
+als_recommender = ALSRecommender(model, interactions, user_ids, item_ids, data)
+
+
 def recommend_for_user_als(user_ehr_id, N=10):
     """
     Вернуть рекомендации для одного пользователя:
     - user_ehr_id — ehr_id пользователя из данных
-    - model — обученная ALS модель implicit
-    - interactions — sparse матрица взаимодействий
-    - user_map — словарь {ehr_id: user_idx}
-    - item_ids — список всех article_id
-    - data — исходный DataFrame с title и url
     - N — сколько рекомендаций вернуть
 
     Возвращает: DataFrame с article_id, title, url
+    (пустой, если пользователя нет в модели)
     """
-
-    # Проверим, что пользователь есть в маппинге
-    #if user_ehr_id not in user_map:
-    #    print(f"Пользователь {user_ehr_id} не найден.")
-    #    return pd.DataFrame(columns=['article_id', 'title', 'url'])
-
-    user_idx = user_map[user_ehr_id]
-
-    # ALS рекомендации
-    item_idxs, scores = model.recommend(user_idx, interactions[user_idx], N=N)
-
-    # Индексы -> article_id
-    rec_article_ids = [item_ids[i] for i in item_idxs]
-
-    # Маппинги title + url
-    id_to_title = dict(zip(data['article_id'], data['title']))
-    id_to_url = dict(zip(data['article_id'], data['url']))
-
-    # Финальный DataFrame
-    recs_df = pd.DataFrame({
-        'article_id': rec_article_ids,
-        'title': [id_to_title.get(a_id, '') for a_id in rec_article_ids],
-        'url': [id_to_url.get(a_id, '') for a_id in rec_article_ids],
-        'score': scores
-    }).sort_values('score', ascending=False).reset_index(drop=True)
-
-    # Убираем score, если не нужен
-    recs_df.drop(columns=['score'], inplace=True)
-
-    return recs_df
+    recs = als_recommender.recommend(user_ehr_id, N=N)
+    return pd.DataFrame(recs, columns=['article_id', 'title', 'url', 'score'])[['article_id', 'title', 'url']]
 
 
+# Клики после обучения: факторы новых пользователей считаются fold-in
+# по факторам статей, без полного переобучения модели
+def recommend_articles_fresh(user_ehr_id, new_clicks, N=10):
+    if user_ehr_id not in als_recommender.user_map:
+        als_recommender.partial_fit(new_clicks)
+    return recommend_for_user_als(user_ehr_id, N=N)
@@ -0,0 +1,191 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.batch import ParquetChunkWriter, top_n_excluding
+from rec_sys_common.features import FeatureStore
+from rec_sys_common.negatives import click_matrix
+
+# Бюджеты кандидатов на пользователя по источникам: больше — выше recall, дольше predict
+ALS_CANDIDATES = 200
+TFIDF_CANDIDATES = 200
+SEGMENT_CANDIDATES = 100
+
+
+class TwoStageRecommender:
+    """
+    Двухэтапные рекомендации: кандидаты из ALS, соседей TF-IDF и топа
+    сегмента объединяются без дубликатов и уже просмотренного, затем
+    CatBoostRanker переранжирует только их — один predict на блок
+    пользователей.
+
+    Признаки кандидатов берутся из FeatureStore (rec_sys_common/features.py)
+    индексацией по строкам, без merge.
+    """
+
+    def __init__(self, ranker, features, store: FeatureStore, history: pd.DataFrame,
+                 als: dict = None, tfidf=None, segment_tops: dict = None, global_top=None,
+                 n_als: int = ALS_CANDIDATES, n_tfidf: int = TFIDF_CANDIDATES,
+                 n_segment: int = SEGMENT_CANDIDATES):
+        """
+        Parameters:
+        ranker: CatBoostRanker, обученный на store.pair_frame (или любая модель с predict(DataFrame))
+        features: признаки в порядке обучения
+        store: хранилище признаков; его статьи — каталог кандидатов
+        history: клики ehr_id, article_id — исключаются из выдачи
+        als: ALS из реестра (rec_sys_common.registry.load_als), необязательно
+        tfidf: ContentRecommenderSystem, необязательно
+        segment_tops: {(gender, age_group): [article_id, ...]} (save_recommendations)
+        global_top: [article_id, ...] — для пользователей без сегмента
+        n_als, n_tfidf, n_segment: бюджеты кандидатов по источникам (0 — источник выключен)
+        """
+        self.ranker = ranker
+        self.features = list(features)
+        self.store = store
+        self.n_als, self.n_tfidf, self.n_segment = n_als, n_tfidf, n_segment
+        self.article_ids = store.article_ids
+        self.article_index = store.article_index
+
+        # Просмотренное: пользователи истории × каталог
+        self.history_users = pd.Index(history['ehr_id'].unique())
+        item_codes = self.article_index.get_indexer(history['article_id'])
+        known = item_codes >= 0
+        self.seen = click_matrix(self.history_users.get_indexer(history['ehr_id'])[known], item_codes[known],
+                                 len(self.history_users), len(self.article_ids))
+
+        # ALS: столбец ALS -> строка каталога (-1 — статьи нет в каталоге)
+        self.als = als
+        if als is not None:
+            self.als_users = pd.Index(als['user_ids'])
+            self.als_rows = self.article_index.get_indexer(als['item_ids'])
+
+        # TF-IDF: строка каталога TF-IDF -> строка каталога ранкера
+        self.tfidf = tfidf
+        if tfidf is not None:
+            self.tfidf_rows = self.article_index.get_indexer(tfidf.article_ids)
+
+        # Топы сегментов — плотная таблица (сегмент × n_segment), последняя строка — общий топ
+        self.segment_table, self.user_segment = self._segment_table(segment_tops or {}, global_top or [])
+
+    def _segment_table(self, segment_tops: dict, global_top):
+        keys = list(segment_tops)
+        lists = [segment_tops[key] for key in keys] + [global_top]
+        table = np.full((len(lists), self.n_segment), -1, dtype=np.int64)
+        for i, article_ids in enumerate(lists):
+            rows = self.article_index.get_indexer(list(article_ids))
+            rows = rows[rows >= 0][:self.n_segment]
+            table[i, :len(rows)] = rows
+
+        # Сегмент каждого пользователя хранилища (по исходному значению пола и возрастной группе)
+        users = self.store.users
+        user_segment = np.full(len(self.store.user_ids), len(keys), dtype=np.int64)
+        known = (users['gender'] >= 0) & (users['age_group'] >= 0)
+        if keys and known.any():
+            segments = pd.MultiIndex.from_tuples([(int(g), int(a)) for g, a in keys])
+            gender = self.store.decode('gender', users['gender'][known]).astype(np.float64).astype(np.int64)
+            codes = segments.get_indexer(pd.MultiIndex.from_arrays([gender, users['age_group'][known]]))
+            user_segment[known] = np.where(codes >= 0, codes, len(keys))
+        return table, user_segment
+
+    def candidates(self, user_ids):
+        """
+        Объединенные кандидаты блока пользователей.
+
+        Returns:
+        (позиция пользователя в блоке, строка каталога) — без дубликатов
+        и просмотренного, отсортированы по пользователю
+        """
+        user_ids = np.asarray(user_ids)
+        positions, rows = [], []
+
+        if self.als is not None and self.n_als > 0:
+            als_codes = self.als_users.get_indexer(user_ids)
+            block = np.flatnonzero(als_codes >= 0)
+            if len(block):
+                scores = (np.asarray(self.als['user_factors'][als_codes[block]])
+                          @ np.asarray(self.als['item_factors']).T).astype(np.float64)
+                scores[:, self.als_rows < 0] = -np.inf
+                top, _ = top_n_excluding(scores, self.als['interactions'][als_codes[block]], self.n_als)
+                positions.append(np.repeat(block, top.shape[1]))
+                rows.append(np.where(top >= 0, self.als_rows[top], -1).ravel())
+
+        if self.tfidf is not None and self.n_tfidf > 0:
+            top, _ = self.tfidf.recommend_batch(user_ids, self.n_tfidf)
+            positions.append(np.repeat(np.arange(len(user_ids)), top.shape[1]))
+            rows.append(np.where(top >= 0, self.tfidf_rows[top], -1).ravel())
+
+        if self.n_segment > 0:
+            codes = self.store.user_rows(user_ids)
+            segment = np.where(codes >= 0, self.user_segment[codes], len(self.segment_table) - 1)
+            top = self.segment_table[segment]
+            positions.append(np.repeat(np.arange(len(user_ids)), top.shape[1]))
+            rows.append(top.ravel())
+
+        if not positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        positions, rows = np.concatenate(positions), np.concatenate(rows)
+        valid = rows >= 0
+        n_items = len(self.article_ids)
+        keys = np.unique(positions[valid].astype(np.int64) * n_items + rows[valid])
+
+        # Просмотренное: ключи кликов блока в той же нумерации
+        codes = self.history_users.get_indexer(user_ids)
+        block = np.flatnonzero(codes >= 0)
+        seen = self.seen[codes[block]]
+        seen_keys = np.repeat(block, np.diff(seen.indptr)).astype(np.int64) * n_items + seen.indices
+        keys = keys[~np.isin(keys, seen_keys)]
+        return keys // n_items, keys % n_items
+
+    def feature_frame(self, user_ids, positions, rows) -> pd.DataFrame:
+        """Таблица признаков кандидатов в порядке self.features"""
+        user_rows = self.store.user_rows(user_ids)[positions]
+        return self.store.rows_frame(user_rows, rows, self.features)
+
+    def recommend_batch(self, user_ids, N: int = 10) -> pd.DataFrame:
+        """
+        Рекомендации для блока пользователей: кандидаты + один predict ранкера.
+
+        Returns:
+        DataFrame ehr_id, article_id, rank (с 1), score
+        """
+        user_ids = np.asarray(user_ids)
+        positions, rows = self.candidates(user_ids)
+        if len(rows) == 0:
+            return pd.DataFrame({'ehr_id': user_ids[:0], 'article_id': self.article_ids[:0],
+                                 'rank': np.empty(0, dtype=np.int64), 'score': np.empty(0)})
+        scores = np.asarray(self.ranker.predict(self.feature_frame(user_ids, positions, rows)), dtype=np.float64)
+
+        # Top-N внутри пользователя по убыванию score
+        order = np.lexsort((-scores, positions))
+        positions, rows, scores = positions[order], rows[order], scores[order]
+        starts = np.searchsorted(positions, positions, side='left')
+        ranks = np.arange(len(positions)) - starts
+        keep = ranks < N
+        return pd.DataFrame({
+            'ehr_id': user_ids[positions[keep]],
+            'article_id': self.article_ids[rows[keep]],
+            'rank': ranks[keep] + 1,
+            'score': scores[keep],
+        })
+
+
+def generate_two_stage_recommendations_for_all(recommender: TwoStageRecommender, user_ids,
+                                               output_path="two_stage.parquet", N=10, batch_size=1024):
+    """
+    Двухэтапные рекомендации для всех user_ids блоками с потоковой записью в parquet.
+
+    batch_size ограничивает память: в блоке до batch_size × (n_als + n_tfidf + n_segment)
+    кандидатов.
+
+    Returns:
+    путь к записанному файлу
+    """
+    user_ids = pd.unique(np.asarray(user_ids))
+    with ParquetChunkWriter(output_path) as writer:
+        for start in range(0, len(user_ids), batch_size):
+            writer.write(recommender.recommend_batch(user_ids[start:start + batch_size], N))
+    print(f"Сохранено {writer.rows} рекомендаций для {len(user_ids)} пользователей в файл {output_path}")
+    return output_path
@@ -0,0 +1,6 @@
+"""
+Общий код для DAG, скриптов и ноутбуков рекомендательной системы.
+
+Из ноутбуков и скриптов в подпапках подключается через
+sys.path.append("..") (корень репозитория), в Airflow — через PYTHONPATH.
+"""
@@ -0,0 +1,345 @@
+import numpy as np
+from scipy import sparse
+
+from rec_sys_common import registry
+from rec_sys_common.batch import top_n_excluding
+
+# Сколько скоров (запросы × векторы) считать за один плотный блок точного поиска
+BLOCK_ELEMENTS = 1 << 24
+
+
+def _rows(vectors, rows):
+    """Строки векторов (плотные или CSR) как плотный float32 массив"""
+    block = vectors[rows]
+    if sparse.issparse(block):
+        block = block.toarray()
+    return np.asarray(block, dtype=np.float32)
+
+
+def _scores(queries: np.ndarray, vectors) -> np.ndarray:
+    """Скалярные произведения запросов (плотные B×d) со всеми векторами (плотные или CSR) — B×N"""
+    if sparse.issparse(vectors):
+        return np.asarray((vectors @ queries.T).T, dtype=np.float64)
+    return (queries @ vectors.T).astype(np.float64)
+
+
+def _exclude_matrix(exclude, n_queries: int, n_items: int):
+    """exclude в виде CSR B×N: CSR как есть, список строк — для одного запроса"""
+    if exclude is None or sparse.issparse(exclude):
+        return exclude
+    cols = np.asarray(exclude, dtype=np.int64).ravel()
+    return sparse.csr_matrix((np.ones(len(cols)), cols, [0, len(cols)]), shape=(n_queries, n_items))
+
+
+class ExactIndex:
+    """
+    Точный поиск по скалярному произведению: эталон для измерения recall
+    и замена ANN на маленьких каталогах.
+
+    Для ALS векторы — факторы статей (скор — как в model.recommend), для
+    TF-IDF — L2-нормированные строки, скалярное произведение = косинус.
+    """
+
+    kind = "exact"
+
+    def __init__(self, vectors, ids=None):
+        """
+        Parameters:
+        vectors: N×d numpy-массив или CSR матрица
+        ids: article_id в порядке строк vectors (по умолчанию — номера строк)
+        """
+        self.vectors = vectors.tocsr() if sparse.issparse(vectors) else np.asarray(vectors, dtype=np.float32)
+        self.ids = np.arange(vectors.shape[0]) if ids is None else np.asarray(ids)
+        self._index = None
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def row(self, item_id) -> int:
+        """Строка статьи по id (-1, если ее нет в индексе)"""
+        if self._index is None or len(self._index) != len(self.ids):
+            self._index = {item_id: i for i, item_id in enumerate(self.ids.tolist())}
+        return self._index.get(item_id, -1)
+
+    def search(self, vectors, k: int = 10, exclude=None):
+        """
+        Top-k строк индекса по скалярному произведению с запросами.
+
+        Parameters:
+        vectors: запрос d или блок запросов B×d (плотные или CSR)
+        k: сколько соседей вернуть
+        exclude: CSR B×N (ненулевые — исключаемые строки, например просмотренные)
+            или, для одного запроса, список строк
+
+        Returns:
+        (строки индекса, scores) — k или B×k по убыванию score; если кандидатов
+        меньше k, хвост заполнен строкой -1 и score -inf
+        """
+        single = not sparse.issparse(vectors) and np.ndim(vectors) == 1
+        queries = _rows(vectors, slice(None)) if sparse.issparse(vectors) \
+            else np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        exclude = _exclude_matrix(exclude, len(queries), len(self))
+        rows, scores = self._search(queries, k, exclude)
+        return (rows[0], scores[0]) if single else (rows, scores)
+
+    def _search(self, queries: np.ndarray, k: int, exclude):
+        chunk = max(1, BLOCK_ELEMENTS // max(len(self), 1))
+        rows, scores = [], []
+        for start in range(0, len(queries), chunk):
+            stop = min(start + chunk, len(queries))
+            top, top_scores = top_n_excluding(_scores(queries[start:stop], self.vectors),
+                                              None if exclude is None else exclude[start:stop], k)
+            rows.append(top)
+            scores.append(top_scores)
+        if not rows:
+            return np.empty((0, min(k, len(self))), dtype=np.int64), np.empty((0, min(k, len(self))))
+        return np.concatenate(rows), np.concatenate(scores)
+
+    def similar_items(self, item_id, k: int = 10):
+        """
+        Похожие статьи (без самой статьи).
+
+        Returns:
+        (article_id, scores) по убыванию score; пустые, если статьи нет в индексе
+        """
+        row = self.row(item_id)
+        if row < 0:
+            return self.ids[:0], np.empty(0)
+        rows, scores = self.search(_rows(self.vectors, [row])[0], k, exclude=[row])
+        valid = rows >= 0
+        return self.ids[rows[valid]], scores[valid]
+
+    def add(self, vectors, ids):
+        """Добавляет статьи в конец индекса (строки новых — len(self)...)"""
+        if sparse.issparse(self.vectors):
+            self.vectors = sparse.vstack([self.vectors, sparse.csr_matrix(vectors, dtype=self.vectors.dtype)],
+                                         format="csr")
+        else:
+            self.vectors = np.vstack([self.vectors, np.asarray(vectors, dtype=np.float32)])
+        self.ids = np.concatenate([self.ids, np.asarray(ids)])
+        return self
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted file index на numpy: векторы разбиты k-means на n_lists
+    кластеров, запрос скорится только с векторами n_probe ближайших (по
+    скалярному произведению с центроидом) кластеров.
+
+    Векторы хранятся отсортированными по кластерам, поэтому кластер — это
+    непрерывный срез. Блок запросов обрабатывается по кластерам: для
+    каждого кластера одно матричное произведение со всеми запросами,
+    которые его проверяют, — без цикла по запросам в Python.
+
+    Стоимость запроса ~ n_probe / n_lists от точного поиска; recall
+    растет с n_probe (см. recall_at_k).
+    """
+
+    kind = "ivf"
+
+    def __init__(self, vectors, ids=None, n_lists: int = None, n_probe: int = 8,
+                 iterations: int = 10, sample: int = 100_000, seed: int = 0):
+        """
+        Parameters:
+        vectors: N×d numpy-массив или CSR матрица
+        ids: article_id в порядке строк vectors
+        n_lists: число кластеров (по умолчанию ~4·√N)
+        n_probe: сколько кластеров проверять на запрос
+        iterations: итераций k-means
+        sample: на скольких векторах обучать центроиды
+        seed: random seed
+        """
+        super().__init__(vectors, ids)
+        self.n_probe = n_probe
+        n = len(self)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+        self.centroids = self.train(min(n_lists, max(n, 1)), iterations, sample, seed)
+        self._assign()
+
+    def train(self, n_lists: int, iterations: int, sample: int, seed: int) -> np.ndarray:
+        """Центроиды k-means (по евклидову расстоянию) на подвыборке векторов"""
+        rng = np.random.default_rng(seed)
+        n = len(self)
+        if n == 0:
+            return np.zeros((1, self.vectors.shape[1]), dtype=np.float32)
+        train_rows = np.sort(rng.choice(n, min(n, sample), replace=False))
+        data = self.vectors[train_rows]
+        n_lists = min(n_lists, len(train_rows))
+        centroids = _rows(data, rng.choice(len(train_rows), n_lists, replace=False))
+        for _ in range(iterations):
+            labels = self.nearest(data, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            members = sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+                                        shape=(n_lists, len(labels)))
+            sums = members @ data
+            sums = sums.toarray() if sparse.issparse(sums) else np.asarray(sums)
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        return centroids
+
+    @staticmethod
+    def nearest(vectors, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        """Ближайший центроид каждого вектора: argmax(x·c − |c|²/2) = argmin |x − c|²"""
+        half_norms = 0.5 * (centroids.astype(np.float64) ** 2).sum(axis=1)
+        labels = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], chunk):
+            block = vectors[start:start + chunk]
+            scores = np.asarray(block @ centroids.T, dtype=np.float64) - half_norms
+            labels[start:start + chunk] = scores.argmax(axis=1)
+        return labels
+
+    def _assign(self):
+        """Раскладка векторов по кластерам: order — строки индекса в порядке кластеров"""
+        self.labels = self.nearest(self.vectors, self.centroids)
+        self.order = np.argsort(self.labels, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.labels, minlength=len(self.centroids)))])
+        self.sorted_vectors = self.vectors[self.order]
+        # Позиция строки индекса в отсортированном порядке
+        self.position = np.empty(len(self), dtype=np.int64)
+        self.position[self.order] = np.arange(len(self))
+
+    def add(self, vectors, ids):
+        """Добавляет статьи без переобучения центроидов (раскладка пересобирается за O(N))"""
+        super().add(vectors, ids)
+        self._assign()
+        return self
+
+    def _search(self, queries: np.ndarray, k: int, exclude):
+        n_queries, n_lists = len(queries), len(self.centroids)
+        n_probe = min(self.n_probe, n_lists)
+        k = min(k, len(self))
+        if n_queries == 0 or k <= 0:
+            return np.full((n_queries, max(k, 0)), -1, dtype=np.int64), np.full((n_queries, max(k, 0)), -np.inf)
+
+        # Кластеры запроса: top-n_probe по скалярному произведению с центроидами
+        probes, _ = top_n_excluding(queries.astype(np.float64) @ self.centroids.T.astype(np.float64), None, n_probe)
+        probe_queries = np.repeat(np.arange(n_queries), n_probe)
+        probe_lists = probes.ravel()
+        order = np.argsort(probe_lists, kind="stable")
+        probe_queries, probe_lists = probe_queries[order], probe_lists[order]
+        bounds = np.searchsorted(probe_lists, np.arange(n_lists + 1))
+
+        # Исключения в отсортированной нумерации, сгруппированные по кластерам
+        if exclude is not None:
+            exclude = exclude.tocoo()
+            ex_queries, ex_positions = exclude.row.astype(np.int64), self.position[exclude.col]
+            ex_order = np.argsort(ex_positions, kind="stable")
+            ex_queries, ex_positions = ex_queries[ex_order], ex_positions[ex_order]
+            ex_bounds = np.searchsorted(ex_positions, self.offsets)
+        local = np.full(n_queries, -1, dtype=np.int64)
+
+        cand_queries, cand_positions, cand_scores = [], [], []
+        for cluster in np.flatnonzero(np.diff(bounds)):
+            start, stop = self.offsets[cluster], self.offsets[cluster + 1]
+            if start == stop:
+                continue
+            block_queries = probe_queries[bounds[cluster]:bounds[cluster + 1]]
+            scores = _scores(queries[block_queries], self.sorted_vectors[start:stop])
+            if exclude is not None and ex_bounds[cluster] < ex_bounds[cluster + 1]:
+                local[block_queries] = np.arange(len(block_queries))
+                part = slice(ex_bounds[cluster], ex_bounds[cluster + 1])
+                rows = local[ex_queries[part]]
+                hit = rows >= 0
+                scores[rows[hit], ex_positions[part][hit] - start] = -np.inf
+                local[block_queries] = -1
+            top, top_scores = top_n_excluding(scores, None, k)
+            cand_queries.append(np.repeat(block_queries, top.shape[1]))
+            cand_positions.append((top + start).ravel())
+            cand_scores.append(top_scores.ravel())
+
+        result = np.full((n_queries, k), -1, dtype=np.int64)
+        result_scores = np.full((n_queries, k), -np.inf)
+        if not cand_queries:
+            return result, result_scores
+        cand_queries = np.concatenate(cand_queries)
+        cand_positions = np.concatenate(cand_positions)
+        cand_scores = np.concatenate(cand_scores)
+        valid = np.isfinite(cand_scores)
+        cand_queries, cand_positions, cand_scores = cand_queries[valid], cand_positions[valid], cand_scores[valid]
+
+        # Слияние кандидатов кластеров: top-k внутри запроса по убыванию score
+        order = np.lexsort((cand_positions, -cand_scores, cand_queries))
+        cand_queries, cand_positions, cand_scores = cand_queries[order], cand_positions[order], cand_scores[order]
+        ranks = np.arange(len(cand_queries)) - np.searchsorted(cand_queries, cand_queries)
+        keep = ranks < k
+        result[cand_queries[keep], ranks[keep]] = self.order[cand_positions[keep]]
+        result_scores[cand_queries[keep], ranks[keep]] = cand_scores[keep]
+        return result, result_scores
+
+
+INDEXES = {ExactIndex.kind: ExactIndex, IVFIndex.kind: IVFIndex}
+
+
+def build_index(vectors, ids=None, kind: str = "ivf", **params) -> ExactIndex:
+    """
+    Индекс ближайших соседей по имени типа ('exact', 'ivf').
+
+    Parameters:
+    vectors: факторы статей ALS или L2-нормированные строки TF-IDF
+    ids: article_id в порядке строк
+    params: параметры конструктора индекса (n_lists, n_probe, ...)
+    """
+    if kind not in INDEXES:
+        raise ValueError(f"неизвестный тип индекса {kind}, доступны: {', '.join(INDEXES)}")
+    return INDEXES[kind](vectors, ids, **params)
+
+
+def recall_at_k(index: ExactIndex, queries, k: int = 10, exclude=None, exact: ExactIndex = None) -> float:
+    """
+    Доля истинных top-k соседей (точный поиск по тем же векторам), которые
+    нашел index, в среднем по запросам.
+
+    Parameters:
+    index: проверяемый индекс
+    queries: блок запросов B×d
+    exclude: исключения, как в search
+    exact: точный индекс по тем же векторам (по умолчанию строится)
+    """
+    exact = exact or ExactIndex(index.vectors, index.ids)
+    truth, _ = exact.search(queries, k, exclude)
+    found, _ = index.search(queries, k, exclude)
+    n_queries = truth.shape[0]
+    if n_queries == 0:
+        return float("nan")
+    offset = (np.arange(n_queries, dtype=np.int64) * (len(index) + 1))[:, None]
+    truth_keys = (truth + offset)[truth >= 0]
+    found_keys = (found + offset)[found >= 0]
+    return float(np.isin(truth_keys, found_keys).sum() / max(len(truth_keys), 1))
+
+
+def save_index(root, index: ExactIndex, name: str = "ann", meta: dict = None):
+    """
+    Публикует индекс в реестр артефактов: векторы (плотные или CSR), id,
+    для IVF — центроиды; раскладка по кластерам пересчитывается при загрузке.
+
+    Returns:
+    путь к опубликованной версии
+    """
+    def write(directory):
+        if sparse.issparse(index.vectors):
+            registry.save_csr(directory, "vectors", index.vectors)
+        else:
+            registry.save_array(directory, "vectors", index.vectors)
+        registry.save_array(directory, "ids", index.ids)
+        if isinstance(index, IVFIndex):
+            registry.save_array(directory, "centroids", index.centroids)
+
+    meta = dict(meta or {}, index=index.kind, sparse=sparse.issparse(index.vectors),
+                n_items=len(index), n_probe=getattr(index, "n_probe", None))
+    return registry.publish(root, name, "ann", write, meta)
+
+
+def load_index(path, verify: bool = False) -> ExactIndex:
+    """Индекс из реестра (save_index); векторы открываются через mmap"""
+    path, manifest = registry.open_artifact(path, "ann", verify)
+    meta = manifest["meta"]
+    vectors = registry.load_csr(path, "vectors") if meta["sparse"] else registry.load_array(path, "vectors")
+    ids = registry.load_array(path, "ids")
+    if meta["index"] == IVFIndex.kind:
+        index = IVFIndex.__new__(IVFIndex)
+        ExactIndex.__init__(index, vectors, ids)
+        index.n_probe = meta["n_probe"]
+        index.centroids = np.asarray(registry.load_array(path, "centroids", mmap=False))
+        index._assign()
+        return index
+    return ExactIndex(vectors, ids)
@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def top_n_excluding(scores: np.ndarray, seen=None, n: int = 10):
+    """
+    Top-N по строкам матрицы scores (пользователи × статьи) с исключением
+    уже просмотренных.
+
+    Parameters:
+    scores: плотная матрица B×N (изменяется на месте)
+    seen: разреженная B×N, ненулевые элементы — просмотренные статьи
+    n: сколько рекомендаций на пользователя
+
+    Returns:
+    (индексы B×n, scores B×n) по убыванию score; если кандидатов меньше n,
+    хвост заполнен индексом -1 и score -inf
+    """
+    if seen is not None:
+        seen = seen.tocoo()
+        scores[seen.row, seen.col] = -np.inf
+
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        return np.empty((scores.shape[0], 0), dtype=int), np.empty((scores.shape[0], 0))
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    top[~np.isfinite(top_scores)] = -1
+    return top, top_scores
+
+
+def flatten_recommendations(user_ids, item_rows: np.ndarray, scores: np.ndarray):
+    """
+    Разворачивает блок B×n в длинный формат, пропуская пустые позиции (-1).
+
+    Returns:
+    (ehr_id, строки статей, rank с 1, scores) — одномерные массивы
+    """
+    valid = item_rows >= 0
+    users = np.repeat(np.asarray(user_ids), valid.sum(axis=1))
+    ranks = np.broadcast_to(np.arange(1, item_rows.shape[1] + 1), item_rows.shape)[valid]
+    return users, item_rows[valid], ranks, scores[valid]
+
+
+class ParquetChunkWriter:
+    """
+    Потоковая запись результатов в один parquet-файл по чанкам.
+
+    Файл пишется во временный и переименовывается при закрытии,
+    поэтому читатели никогда не видят недописанный результат.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.writer = None
+        self.rows = 0
+
+    def write(self, chunk: pd.DataFrame):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+        self.rows += len(chunk)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer.close()
+            self.tmp_path.unlink(missing_ok=True)
@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+from rec_sys_common import registry
+from rec_sys_common.segments import AGE_BOUNDS, age_groups
+from rec_sys_common.loader import cached_columns, load_events
+
+# Метаданные статьи: строковые — category (строка хранится один раз), числовые — как есть
+CATALOG_STRING_COLUMNS = ["title", "url", "rubric_title", "tags", "formats"]
+CATALOG_COLUMNS = CATALOG_STRING_COLUMNS + ["views", "published_date"]
+
+# Колонки событий в EventTable.frame
+EVENT_COLUMNS = ["ehr_id", "article_id", "action_type", "created_at", "gender", "age", "age_group"]
+
+# Служебные идентификаторы выгрузки — компактной таблице не нужны
+SERVICE_ID_COLUMNS = ["esb_ehr_id", "patientnet_ehr_id", "medialog_ehr_id"]
+
+# Пропуски в компактных массивах
+MISSING_GENDER = -1
+MISSING_AGE = 255
+
+# uint8 возраст -> возрастная группа одним индексированием (MISSING_AGE -> -1)
+AGE_GROUP_TABLE = age_groups(np.arange(256))
+AGE_GROUP_TABLE[MISSING_AGE] = -1
+
+
+class ArticleCatalog:
+    """
+    Каталог статей: одна строка на статью, строковые поля — category.
+
+    События ссылаются на статью номером строки каталога (article_idx),
+    поэтому заголовки, url, рубрики и теги не повторяются в каждом клике.
+    """
+
+    def __init__(self, articles: pd.DataFrame):
+        """
+        Parameters:
+        articles: article_id и колонки CATALOG_COLUMNS (какие есть), одна строка на статью
+        """
+        articles = articles.reset_index(drop=True)
+        self.article_ids = articles["article_id"].to_numpy(dtype=np.int64)
+        self.columns = {}
+        for col in CATALOG_COLUMNS:
+            if col not in articles.columns:
+                continue
+            values = articles[col]
+            self.columns[col] = values.astype("category") if col in CATALOG_STRING_COLUMNS else values.to_numpy()
+        self.index = pd.Index(self.article_ids)
+
+    @classmethod
+    def from_events(cls, df: pd.DataFrame) -> "ArticleCatalog":
+        """Каталог по сырым событиям: первое вхождение каждой статьи, как в drop_duplicates('article_id')"""
+        columns = ["article_id"] + [c for c in CATALOG_COLUMNS if c in df.columns]
+        return cls(df.loc[df["article_id"].notna(), columns].drop_duplicates("article_id"))
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def rows(self, article_ids) -> np.ndarray:
+        """article_id -> строки каталога (-1 для неизвестных)"""
+        return self.index.get_indexer(np.asarray(article_ids))
+
+    def column(self, col: str, rows: np.ndarray = None):
+        """
+        Колонка каталога для строк rows (по умолчанию — всего каталога).
+        Строковые — Categorical по кодам, без копирования строк.
+        """
+        values = self.columns[col]
+        if isinstance(values, pd.Series):
+            codes = values.cat.codes.to_numpy()
+            return pd.Categorical.from_codes(codes if rows is None else codes[rows], values.cat.categories)
+        return values if rows is None else values[rows]
+
+    def frame(self, categorical: bool = False) -> pd.DataFrame:
+        """Каталог как DataFrame (article_id + метаданные); categorical=False — строки object"""
+        df = pd.DataFrame({"article_id": self.article_ids})
+        for col in self.columns:
+            values = self.column(col)
+            df[col] = values if categorical or not isinstance(values, pd.Categorical) \
+                else np.asarray(values, dtype=object)
+        return df
+
+
+class EventTable:
+    """
+    Компактная таблица событий: выровненные массивы фиксированной ширины
+    плюс каталог статей.
+
+        ehr_id       int32
+        article_idx  int32   — строка ArticleCatalog
+        gender       int8    (MISSING_GENDER — пропуск)
+        age          uint8   (MISSING_AGE — пропуск)
+        created_at   int64   — наносекунды unix-времени
+        action       int8    — код в action_types
+
+    ~19 байт на событие вместо сотен у сырого DataFrame со строками
+    в каждой строке; группировки идут по целым колонкам. frame()
+    разворачивает таблицу обратно в DataFrame для существующего кода.
+    """
+
+    def __init__(self, ehr_id, article_idx, gender, age, created_at, action, action_types, catalog: ArticleCatalog):
+        self.ehr_id = np.asarray(ehr_id, dtype=np.int32)
+        self.article_idx = np.asarray(article_idx, dtype=np.int32)
+        self.gender = np.asarray(gender, dtype=np.int8)
+        self.age = np.asarray(age, dtype=np.uint8)
+        self.created_at = np.asarray(created_at, dtype=np.int64)
+        self.action = np.asarray(action, dtype=np.int8)
+        self.action_types = list(action_types)
+        self.catalog = catalog
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "EventTable":
+        """
+        Компактная таблица из сырых событий (load_events или уже
+        переименованных колонок gender/age). События без ehr_id или
+        article_id отбрасываются, но их статьи попадают в каталог.
+        """
+        df = df.rename(columns={"пол": "gender", "возраст": "age"})
+        catalog = ArticleCatalog.from_events(df)
+        df = df[df["ehr_id"].notna() & df["article_id"].notna()]
+
+        ehr_id = df["ehr_id"].to_numpy()
+        int32 = np.iinfo(np.int32)
+        if len(ehr_id) and (ehr_id.min() < int32.min or ehr_id.max() > int32.max):
+            raise ValueError("ehr_id не помещается в int32")
+
+        gender = pd.to_numeric(df["gender"], errors="coerce") if "gender" in df else pd.Series(np.nan, index=df.index)
+        age = pd.to_numeric(df["age"], errors="coerce") if "age" in df else pd.Series(np.nan, index=df.index)
+        if "action_type" in df:
+            action, action_types = pd.factorize(df["action_type"].astype(object), use_na_sentinel=True)
+        else:
+            action, action_types = np.zeros(len(df), dtype=np.int8), ["CLICKED"]
+        if "created_at" in df:
+            created_at = pd.to_datetime(df["created_at"]).to_numpy(dtype="datetime64[ns]").view(np.int64)
+        else:
+            created_at = np.zeros(len(df), dtype=np.int64)
+
+        return cls(
+            ehr_id=ehr_id,
+            article_idx=catalog.rows(df["article_id"].to_numpy()),
+            gender=gender.fillna(MISSING_GENDER).to_numpy(),
+            age=age.clip(0, MISSING_AGE - 1).fillna(MISSING_AGE).to_numpy(),
+            created_at=created_at,
+            action=action,
+            action_types=list(action_types),
+            catalog=catalog,
+        )
+
+    def __len__(self):
+        return len(self.ehr_id)
+
+    @property
+    def nbytes(self) -> int:
+        """Размер массивов событий (без каталога)"""
+        return sum(a.nbytes for a in (self.ehr_id, self.article_idx, self.gender, self.age,
+                                      self.created_at, self.action))
+
+    def take(self, rows) -> "EventTable":
+        """Подмножество событий (маска или индексы); каталог общий"""
+        return EventTable(self.ehr_id[rows], self.article_idx[rows], self.gender[rows], self.age[rows],
+                          self.created_at[rows], self.action[rows], self.action_types, self.catalog)
+
+    def clicks(self) -> "EventTable":
+        """Только события CLICKED"""
+        if "CLICKED" not in self.action_types:
+            return self.take(np.zeros(len(self), dtype=bool))
+        return self.take(self.action == self.action_types.index("CLICKED"))
+
+    @property
+    def article_ids(self) -> np.ndarray:
+        return self.catalog.article_ids[self.article_idx]
+
+    def age_group(self) -> np.ndarray:
+        """Возрастная группа событий (int8, -1 — возраст неизвестен)"""
+        return AGE_GROUP_TABLE[self.age]
+
+    def segment_counts(self) -> pd.DataFrame:
+        """
+        Клики по (gender, age_group, article_id) — то же, что
+        groupby([...]).size() по сырым событиям, но одним bincount (или
+        np.unique) по составному int64 ключу. События с неизвестным полом или возрастом
+        не учитываются.
+
+        Returns:
+        DataFrame gender, age_group, article_id, clicks, отсортированный по ключам
+        """
+        groups = self.age_group()
+        known = (self.gender != MISSING_GENDER) & (groups >= 0)
+        n_groups, n_articles = len(AGE_BOUNDS) + 1, max(len(self.catalog), 1)
+        gender_codes, genders = pd.factorize(self.gender[known], sort=True)
+        keys = (gender_codes.astype(np.int64) * n_groups + groups[known]) * n_articles + self.article_idx[known]
+        space = len(genders) * n_groups * n_articles
+        if space <= 4 * len(keys):
+            # Плотное пространство ключей: счетчик за O(N) без сортировки
+            counts = np.bincount(keys, minlength=space)
+            keys = np.flatnonzero(counts)
+            counts = counts[keys]
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+        segment, article_idx = np.divmod(keys, n_articles)
+        return pd.DataFrame({
+            "gender": np.asarray(genders)[segment // n_groups],
+            "age_group": (segment % n_groups).astype(np.int8),
+            "article_id": self.catalog.article_ids[article_idx],
+            "clicks": counts,
+        })
+
+    def frame(self, columns=None) -> pd.DataFrame:
+        """
+        События как DataFrame для существующего кода (pandas-группировки,
+        ContentRecommenderSystem, prepare_recommendation_systems).
+
+        gender, age, age_group — nullable целые (пропуски как NA), created_at —
+        datetime64 без копирования, колонки каталога — Categorical по кодам.
+
+        Parameters:
+        columns: какие колонки (EVENT_COLUMNS и колонки каталога); None — все
+        """
+        columns = columns or EVENT_COLUMNS + list(self.catalog.columns)
+        df = {}
+        for col in columns:
+            if col == "ehr_id":
+                df[col] = self.ehr_id
+            elif col == "article_id":
+                df[col] = self.article_ids
+            elif col == "action_type":
+                df[col] = pd.Categorical.from_codes(self.action, self.action_types)
+            elif col == "created_at":
+                df[col] = self.created_at.view("datetime64[ns]")
+            elif col == "gender":
+                df[col] = pd.arrays.IntegerArray(self.gender, self.gender == MISSING_GENDER)
+            elif col == "age":
+                df[col] = pd.arrays.IntegerArray(self.age, self.age == MISSING_AGE)
+            elif col == "age_group":
+                groups = self.age_group()
+                df[col] = pd.arrays.IntegerArray(groups, groups < 0)
+            elif col in self.catalog.columns:
+                df[col] = self.catalog.column(col, self.article_idx)
+            else:
+                raise KeyError(f"нет колонки {col}")
+        return pd.DataFrame(df)
+
+    def save(self, root, name: str = "events", meta: dict = None):
+        """Публикует таблицу в реестр артефактов: массивы .npy (mmap) и каталог Arrow"""
+        def write(directory):
+            for col in ("ehr_id", "article_idx", "gender", "age", "created_at", "action"):
+                registry.save_array(directory, col, getattr(self, col))
+            registry.save_table(directory, "catalog", self.catalog.frame(categorical=True))
+
+        meta = dict(meta or {}, action_types=self.action_types, n_events=len(self), n_articles=len(self.catalog))
+        return registry.publish(root, name, "events", write, meta)
+
+    @classmethod
+    def load(cls, path, verify: bool = False) -> "EventTable":
+        """Таблица из реестра; массивы событий — memmap только на чтение"""
+        path, manifest = registry.open_artifact(path, "events", verify)
+        return cls(*(registry.load_array(path, col) for col in
+                     ("ehr_id", "article_idx", "gender", "age", "created_at", "action")),
+                   action_types=manifest["meta"]["action_types"],
+                   catalog=ArticleCatalog(registry.load_table(path, "catalog")))
+
+
+def load_compact_events(path, sheet_name: str = "Лист4", filters=None, cache_dir=None) -> EventTable:
+    """
+    Загрузка выгрузки сразу в компактном виде (через parquet-кеш load_events).
+    Служебные *_ehr_id не читаются из parquet (выбор колонок по схеме кеша).
+
+    Parameters:
+    path: путь к xlsx
+    sheet_name, filters, cache_dir: как в load_events
+    """
+    columns = [c for c in cached_columns(path, sheet_name, cache_dir) if c not in SERVICE_ID_COLUMNS]
+    df = load_events(path, sheet_name, columns=columns, filters=filters, cache_dir=cache_dir)
+    return EventTable.from_frame(df)
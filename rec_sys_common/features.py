@@ -0,0 +1,273 @@
+import numpy as np
+import pandas as pd
+
+from rec_sys_common import registry
+from rec_sys_common.segments import age_groups
+
+# Строковые справочники кодируются целыми по словарю (коды не меняются при обновлениях)
+ENCODED_COLUMNS = ["gender", "rubric_title", "tags", "formats"]
+
+USER_FEATURES = ["gender", "age", "age_group", "user_clicks"]
+ARTICLE_FEATURES = ["rubric_title", "tags", "formats", "views", "freshness_days"]
+# Признаки пары: клики пользователя в рубрике статьи
+PAIR_FEATURES = ["rubric_clicks"]
+RANKING_FEATURES = USER_FEATURES + ARTICLE_FEATURES + PAIR_FEATURES
+CAT_FEATURES = ["gender", "age_group", "rubric_title", "tags", "formats"]
+
+# Код пропуска для категориальных признаков
+MISSING = -1
+
+
+def _take(array: np.ndarray, rows: np.ndarray, fill):
+    """array[rows] с fill для rows < 0 (неизвестные id)"""
+    if len(array) == 0:
+        return np.full(len(rows), fill, dtype=array.dtype)
+    out = array[rows]
+    out[rows < 0] = fill
+    return out
+
+
+def _days(values) -> np.ndarray:
+    """Даты -> дни от эпохи (float, NaN для пропусков)"""
+    dates = pd.to_datetime(pd.Series(values), errors="coerce")
+    days = (dates - pd.Timestamp(0)).dt.total_seconds().to_numpy(dtype=np.float64) / 86400
+    return days
+
+
+class FeatureStore:
+    """
+    Признаки пользователей и статей для CatBoost, разложенные в выровненные
+    массивы: строка массива — пользователь (статья) из user_ids (article_ids).
+
+    Строится один раз по событиям и дополняется новыми выгрузками через
+    update; выборка признаков по id — поиск в хеш-индексе и индексация
+    массивов, без merge и astype(str).
+
+    Категориальные признаки хранятся целыми кодами по словарям self.vocab:
+    словари только дополняются, поэтому модель, обученная на старой версии
+    хранилища, видит те же коды.
+    """
+
+    def __init__(self):
+        self.vocab = {col: [] for col in ENCODED_COLUMNS}
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.users = {
+            "gender": np.empty(0, dtype=np.int32),
+            "age": np.empty(0, dtype=np.float32),
+            "age_group": np.empty(0, dtype=np.int32),
+            "clicks": np.empty(0, dtype=np.float32),
+            # Клики по рубрикам: пользователи × словарь рубрик
+            "rubric_clicks": np.empty((0, 0), dtype=np.float32),
+        }
+        self.article_ids = np.empty(0, dtype=np.int64)
+        self.articles = {
+            "rubric_title": np.empty(0, dtype=np.int32),
+            "tags": np.empty(0, dtype=np.int32),
+            "formats": np.empty(0, dtype=np.int32),
+            "views": np.empty(0, dtype=np.float32),
+            "published_day": np.empty(0, dtype=np.float64),
+        }
+        # Дата, от которой считается свежесть (последнее событие), в днях от эпохи
+        self.reference_day = np.nan
+        self._build_indexes()
+
+    def _build_indexes(self):
+        self.user_index = pd.Index(self.user_ids)
+        self.article_index = pd.Index(self.article_ids)
+
+    @classmethod
+    def from_events(cls, df: pd.DataFrame) -> "FeatureStore":
+        """Хранилище по событиям (как в ноутбуках: ehr_id, article_id, gender, age, признаки статей)"""
+        store = cls()
+        store.update(df)
+        return store
+
+    def encode(self, column: str, values) -> np.ndarray:
+        """Коды значений по словарю column; новые значения дописываются в словарь"""
+        # object: category и числовые колонки сравниваются как python-значения
+        values = pd.Series(np.asarray(values, dtype=object))
+        vocab = self.vocab[column]
+        new = pd.Index(values.dropna().unique()).difference(pd.Index(vocab, dtype=object), sort=False)
+        vocab.extend(new.tolist())
+        codes = pd.Index(vocab, dtype=object).get_indexer(values.to_numpy(dtype=object))
+        return codes.astype(np.int32)
+
+    def _upsert(self, ids, index: pd.Index, table: dict, updates: dict, id_attr: str):
+        """
+        Дописывает новые id в конец массивов и перезаписывает значения
+        известных; пропуски (NaN / MISSING) в updates старое значение не затирают.
+        """
+        rows = index.get_indexer(ids)
+        new = rows < 0
+        n_old, n_new = len(index), int(new.sum())
+        if n_new:
+            setattr(self, id_attr, np.concatenate([np.asarray(getattr(self, id_attr)), np.asarray(ids)[new]]))
+            rows[new] = n_old + np.arange(n_new)
+
+        for name, array in table.items():
+            fill = MISSING if array.dtype.kind == "i" else 0 if name in ("clicks", "rubric_clicks") else np.nan
+            shape = (n_old + n_new,) + array.shape[1:]
+            grown = np.full(shape, fill, dtype=array.dtype)
+            grown[:n_old] = array
+            table[name] = grown
+        for name, values in updates.items():
+            array = table[name]
+            known = values != MISSING if array.dtype.kind == "i" else ~np.isnan(values)
+            array[rows[known]] = values[known]
+
+    def update(self, df: pd.DataFrame, count_events: bool = True):
+        """
+        Дополняет хранилище событиями: новые пользователи и статьи
+        добавляются, у известных обновляются признаки (последнее непустое
+        значение в df), клики прибавляются к счетчикам.
+
+        Колонки: ehr_id, article_id и, если есть, gender, age, rubric_title,
+        tags, formats, views, published_date, created_at, action_type
+        (считаются только CLICKED).
+
+        count_events=False — только признаки пользователей и статей: счетчики
+        и дата отсчета свежести не меняются (например, метаданные теста,
+        чьи клики — метки).
+        """
+        # Статьи: последнее непустое значение каждой колонки
+        columns = [c for c in ("rubric_title", "tags", "formats", "views", "published_date") if c in df]
+        articles = df.groupby("article_id", sort=False)[columns].last().reset_index()
+        updates = {}
+        for col in ("rubric_title", "tags", "formats"):
+            if col in articles:
+                updates[col] = self.encode(col, articles[col])
+        if "views" in articles:
+            updates["views"] = articles["views"].to_numpy(dtype=np.float32, na_value=np.nan)
+        if "published_date" in articles:
+            updates["published_day"] = _days(articles["published_date"])
+        self._upsert(articles["article_id"].to_numpy(), self.article_index, self.articles, updates, "article_ids")
+
+        # Пользователи
+        columns = [c for c in ("gender", "age") if c in df]
+        users = df.groupby("ehr_id", sort=False)[columns].last().reset_index()
+        updates = {}
+        if "gender" in users:
+            updates["gender"] = self.encode("gender", users["gender"])
+        if "age" in users:
+            age = users["age"].to_numpy(dtype=np.float32, na_value=np.nan)
+            updates["age"] = age
+            updates["age_group"] = age_groups(age).astype(np.int32)
+        self._upsert(users["ehr_id"].to_numpy(), self.user_index, self.users, updates, "user_ids")
+        self._build_indexes()
+        if not count_events:
+            return self
+
+        # Счетчики кликов: всего и по рубрикам (рубрика — текущая рубрика статьи)
+        clicks = df[df["action_type"] == "CLICKED"] if "action_type" in df else df
+        user_rows = self.user_index.get_indexer(clicks["ehr_id"])
+        self.users["clicks"] += np.bincount(user_rows, minlength=len(self.user_ids)).astype(np.float32)
+
+        n_rubrics = len(self.vocab["rubric_title"])
+        matrix = self.users["rubric_clicks"]
+        if matrix.shape[1] < n_rubrics:
+            grown = np.zeros((matrix.shape[0], n_rubrics), dtype=np.float32)
+            grown[:, :matrix.shape[1]] = matrix
+            matrix = grown
+        rubrics = _take(self.articles["rubric_title"], self.article_index.get_indexer(clicks["article_id"]), MISSING)
+        known = rubrics >= 0
+        keys, counts = np.unique(user_rows[known].astype(np.int64) * n_rubrics + rubrics[known], return_counts=True)
+        matrix = np.ascontiguousarray(matrix)
+        matrix.reshape(-1)[keys] += counts
+        self.users["rubric_clicks"] = matrix
+
+        if "created_at" in df:
+            days = _days(df["created_at"])
+            days = days[~np.isnan(days)]
+            if len(days):
+                self.reference_day = float(np.fmax(self.reference_day, days.max()))
+        return self
+
+    def user_rows(self, ehr_ids) -> np.ndarray:
+        """Строки пользователей (-1 — неизвестный)"""
+        return self.user_index.get_indexer(np.asarray(ehr_ids))
+
+    def article_rows(self, article_ids) -> np.ndarray:
+        """Строки статей (-1 — неизвестная)"""
+        return self.article_index.get_indexer(np.asarray(article_ids))
+
+    def rows_frame(self, user_rows, article_rows, features=RANKING_FEATURES, clicked=None) -> pd.DataFrame:
+        """
+        Признаки пар (пользователь, статья) по строкам хранилища.
+
+        Parameters:
+        user_rows, article_rows: строки (user_rows / article_rows), одинаковой длины
+        features: имена признаков из RANKING_FEATURES
+        clicked: булева маска пар, чей клик уже учтен в счетчиках (позитивы
+            обучающей выборки, построенной по тем же событиям) — для них клик
+            вычитается, иначе счетчик подсказывает метку
+
+        Returns:
+        DataFrame в порядке features; категориальные — int коды, пропуск — MISSING
+        """
+        user_rows, article_rows = np.asarray(user_rows), np.asarray(article_rows)
+        own = np.asarray(clicked, dtype=np.float32) if clicked is not None else 0
+        columns = {}
+        for name in features:
+            if name in ("gender", "age", "age_group"):
+                array = self.users[name]
+                columns[name] = _take(array, user_rows, MISSING if array.dtype.kind == "i" else np.nan)
+            elif name == "user_clicks":
+                columns[name] = _take(self.users["clicks"], user_rows, 0) - own
+            elif name in ("rubric_title", "tags", "formats", "views"):
+                array = self.articles[name]
+                columns[name] = _take(array, article_rows, MISSING if array.dtype.kind == "i" else np.nan)
+            elif name == "freshness_days":
+                columns[name] = self.reference_day - _take(self.articles["published_day"], article_rows, np.nan)
+            elif name == "rubric_clicks":
+                matrix = self.users["rubric_clicks"]
+                rubric = _take(self.articles["rubric_title"], article_rows, MISSING)
+                # Рубрики, по которым кликов еще не было, может не быть среди столбцов
+                valid = (user_rows >= 0) & (rubric >= 0) & (rubric < matrix.shape[1])
+                values = np.zeros(len(user_rows), dtype=np.float32)
+                values[valid] = matrix[user_rows[valid], rubric[valid]]
+                values -= np.where(valid, own, 0)
+                columns[name] = values
+            else:
+                raise ValueError(f"неизвестный признак {name}")
+        return pd.DataFrame(columns)
+
+    def pair_frame(self, ehr_ids, article_ids, features=RANKING_FEATURES, clicked=None) -> pd.DataFrame:
+        """rows_frame по id пользователей и статей"""
+        return self.rows_frame(self.user_rows(ehr_ids), self.article_rows(article_ids), features, clicked)
+
+    def decode(self, column: str, codes) -> np.ndarray:
+        """Коды -> исходные значения (MISSING -> None)"""
+        vocab = np.array(self.vocab[column] + [None], dtype=object)
+        codes = np.asarray(codes)
+        return vocab[np.where(codes >= 0, codes, len(vocab) - 1)]
+
+    def save(self, root, name: str = "features", meta: dict = None):
+        """Публикует хранилище в реестр артефактов (массивы открываются через mmap)"""
+        def write(directory):
+            registry.save_array(directory, "user_ids", self.user_ids)
+            registry.save_array(directory, "article_ids", self.article_ids)
+            for key, array in self.users.items():
+                registry.save_array(directory, f"users.{key}", array)
+            for key, array in self.articles.items():
+                registry.save_array(directory, f"articles.{key}", array)
+
+        meta = dict(meta or {}, vocab=self.vocab, reference_day=float(self.reference_day),
+                    n_users=len(self.user_ids), n_articles=len(self.article_ids))
+        return registry.publish(root, name, "features", write, meta)
+
+    @classmethod
+    def load(cls, path, verify: bool = False) -> "FeatureStore":
+        """
+        Хранилище из реестра. Массивы — memmap только на чтение; update
+        создает новые массивы, поэтому загруженную версию можно дополнять.
+        """
+        path, manifest = registry.open_artifact(path, "features", verify)
+        store = cls()
+        store.vocab = {col: list(values) for col, values in manifest["meta"]["vocab"].items()}
+        store.reference_day = manifest["meta"]["reference_day"]
+        store.user_ids = registry.load_array(path, "user_ids")
+        store.article_ids = registry.load_array(path, "article_ids")
+        store.users = {key: registry.load_array(path, f"users.{key}") for key in store.users}
+        store.articles = {key: registry.load_array(path, f"articles.{key}") for key in store.articles}
+        store._build_indexes()
+        return store
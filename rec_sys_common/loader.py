@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Колонки с небольшим числом уникальных значений — храним как category
+CATEGORICAL_COLUMNS = ["tags", "rubric_title", "formats", "action_type"]
+
+# Идентификаторы — int32 (если без пропусков и влезают в диапазон)
+ID_COLUMNS = ["ehr_id", "article_id", "esb_ehr_id", "patientnet_ehr_id", "medialog_ehr_id"]
+
+DATETIME_COLUMNS = ["created_at"]
+
+CACHE_VERSION = 1
+
+
+def file_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _atomic_write(path: Path, write):
+    """
+    Запись через уникальный временный файл рядом с path и os.replace:
+    параллельные процессы (например, два DAG с общим кешем) не пишут
+    в один и тот же файл, а читатель видит либо старую, либо новую версию.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(Path(tmp))
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _source_hash(path: Path, cache_dir: Path) -> str:
+    """
+    Хеш исходника с мемоизацией по (размер, mtime): большой xlsx
+    не перечитывается целиком, пока файл не изменился.
+    """
+    stat = path.stat()
+    memo_path = cache_dir / f"{path.name}.hash.json"
+    signature = [stat.st_size, stat.st_mtime_ns]
+    if memo_path.exists():
+        memo = json.loads(memo_path.read_text())
+        if memo.get("signature") == signature:
+            return memo["sha256"]
+
+    sha256 = file_hash(path)
+    _atomic_write(memo_path, lambda tmp: tmp.write_text(json.dumps({"signature": signature, "sha256": sha256})))
+    return sha256
+
+
+def optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Типизация сырого листа: category для строковых справочников, int32 для id, даты"""
+    df = df.copy()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    int32 = np.iinfo(np.int32)
+    for col in ID_COLUMNS:
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            values = df[col]
+            if values.notna().all() and values.min() >= int32.min and values.max() <= int32.max \
+                    and (values % 1 == 0).all():
+                df[col] = values.astype(np.int32)
+
+    for col in DATETIME_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def cache_path(path, sheet_name: str = "Лист4", cache_dir=None) -> Path:
+    """
+    Путь к parquet-кешу листа. Ключ — хеш исходного файла и имя листа,
+    поэтому новая выгрузка автоматически получает новый кеш.
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir) if cache_dir is not None else path.parent / ".cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    source_key = _source_hash(path, cache_dir)[:16]
+    return cache_dir / f"{_cache_prefix(path, sheet_name)}.{source_key}.v{CACHE_VERSION}.parquet"
+
+
+def _cache_prefix(path: Path, sheet_name) -> str:
+    """Общая часть имени кешей одного листа одного исходника (без хеша содержимого)"""
+    sheet_key = hashlib.sha256(str(sheet_name).encode()).hexdigest()[:8]
+    return f"{path.stem}.{sheet_key}"
+
+
+def prune_caches(path, sheet_name: str = "Лист4", cache_dir=None, keep: Path = None) -> List[Path]:
+    """
+    Удаляет кеши прошлых выгрузок того же листа (другой хеш содержимого
+    или версия формата), кроме keep. Уже открытые через mmap файлы
+    дочитываются: удаляется только имя.
+
+    Returns:
+    удаленные файлы
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir) if cache_dir is not None else path.parent / ".cache"
+    removed = []
+    for old in cache_dir.glob(f"{_cache_prefix(path, sheet_name)}.*.parquet"):
+        if old != keep:
+            old.unlink(missing_ok=True)
+            removed.append(old)
+    return removed
+
+
+def build_cache(path, sheet_name: str = "Лист4", cache_dir=None) -> Path:
+    """
+    Parquet-кеш листа: при первом обращении к выгрузке парсит Excel и
+    сохраняет типизированный parquet (кеши прошлых выгрузок того же листа
+    удаляются — каждый из них полная копия данных).
+
+    Returns:
+    путь к кешу
+    """
+    cached = cache_path(path, sheet_name, cache_dir)
+    if not cached.exists():
+        df = optimize_dtypes(pd.read_excel(path, sheet_name=sheet_name))
+        _atomic_write(cached, lambda tmp: df.to_parquet(tmp, index=False))
+        prune_caches(path, sheet_name, cached.parent, keep=cached)
+    return cached
+
+
+def cached_columns(path, sheet_name: str = "Лист4", cache_dir=None) -> List[str]:
+    """Колонки листа по схеме parquet-кеша, без чтения данных"""
+    return pq.read_schema(build_cache(path, sheet_name, cache_dir)).names
+
+
+def load_events(path,
+                sheet_name: str = "Лист4",
+                columns: List[str] = None,
+                filters: List[Tuple] = None,
+                cache_dir=None,
+                categorical: bool = True) -> pd.DataFrame:
+    """
+    Загрузка листа с событиями через бинарный кеш.
+
+    Первый вызов парсит Excel и сохраняет типизированный parquet
+    (build_cache), следующие — читают его через memory-map.
+
+    Parameters:
+    path: путь к xlsx
+    sheet_name: лист (Лист4 по умолчанию, как во всех ноутбуках)
+    columns: какие колонки читать (None — все)
+    filters: фильтр строк в формате pyarrow, например
+        [("action_type", "==", "CLICKED"), ("created_at", ">", ts)]
+    cache_dir: папка кеша (по умолчанию .cache рядом с исходником)
+    categorical: False — вернуть справочные колонки как обычные строки (object)
+
+    Returns:
+    DataFrame с исходными названиями колонок
+    """
+    cached = build_cache(path, sheet_name, cache_dir)
+    table = pq.read_table(cached, columns=columns, filters=filters, memory_map=True)
+    df = table.to_pandas()
+    if not categorical:
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+    return df
@@ -0,0 +1,296 @@
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+METRICS = ["HitRate", "Precision", "Recall", "MRR", "NDCG", "MAP"]
+
+
+def _metrics_at_k(groups: np.ndarray, ranks: np.ndarray, relevant: np.ndarray,
+                  n_relevant: np.ndarray, ks: Sequence[int]) -> pd.DataFrame:
+    """
+    Все метрики за один проход по строкам, отсортированным по (группа, ранг).
+
+    groups: код группы (пользователя) для каждой строки, 0..n_groups-1
+    ranks: позиция строки в выдаче группы, с 0
+    relevant: булева релевантность строки
+    n_relevant: число релевантных статей у каждой группы (знаменатель Recall/NDCG/MAP)
+    """
+    n_groups = len(n_relevant)
+    relevant = relevant.astype(bool)
+
+    # Накопленное число попаданий внутри группы (включая текущую строку)
+    cum_hits = np.cumsum(relevant)
+    group_start = np.searchsorted(groups, np.arange(n_groups))
+    before = np.concatenate([[0], cum_hits])[group_start]
+    cum_hits = cum_hits - np.repeat(before, np.bincount(groups, minlength=n_groups))
+
+    max_k = max(ks)
+    discounts = 1.0 / np.log2(np.arange(max_k) + 2)
+    ideal_dcg = np.concatenate([[0.0], np.cumsum(discounts)])
+    rows_discount = 1.0 / np.log2(ranks + 2)
+    n_relevant = np.asarray(n_relevant, dtype=np.float64)
+
+    def per_group(weights):
+        return np.bincount(groups, weights=weights, minlength=n_groups)
+
+    def safe_div(a, b):
+        return np.divide(a, b, out=np.zeros(n_groups), where=b > 0)
+
+    result = {}
+    for k in ks:
+        hit = relevant & (ranks < k)
+        hits = per_group(hit)
+        ideal = np.minimum(n_relevant, k)
+        # Первое попадание в группе — строка с cum_hits == 1
+        first_hit = hit & (cum_hits == 1)
+        result[k] = {
+            "HitRate": np.mean(hits > 0),
+            "Precision": np.mean(hits / k),
+            "Recall": np.mean(safe_div(hits, n_relevant)),
+            "MRR": np.mean(per_group(first_hit / (ranks + 1))),
+            "NDCG": np.mean(safe_div(per_group(hit * rows_discount), ideal_dcg[ideal.astype(int)])),
+            "MAP": np.mean(safe_div(per_group(hit * cum_hits / (ranks + 1)), ideal)),
+        }
+    return pd.DataFrame.from_dict(result, orient="index")[METRICS].rename_axis("k")
+
+
+def ranking_metrics(groups, scores, labels, ks: Sequence[int] = (5, 10)) -> pd.DataFrame:
+    """
+    Метрики для размеченной таблицы кандидатов (например, предсказания CatBoostRanker).
+
+    Parameters:
+    groups: id группы (ehr_id) для каждой строки
+    scores: предсказанный score — чем больше, тем выше в выдаче
+    labels: релевантность (label > 0 — релевантно)
+    ks: значения K
+
+    Returns:
+    DataFrame: строки — K, столбцы — HitRate, Precision, Recall, MRR, NDCG, MAP.
+    Усреднение по всем группам; Recall/NDCG/MAP нормируются на число
+    релевантных строк в группе.
+    """
+    group_codes, _ = pd.factorize(np.asarray(groups))
+    scores = np.asarray(scores, dtype=np.float64)
+    relevant = np.asarray(labels) > 0
+
+    # Сортировка по группе и убыванию score (стабильно)
+    order = np.lexsort((-scores, group_codes))
+    group_codes, relevant = group_codes[order], relevant[order]
+    n_groups = group_codes.max() + 1 if len(group_codes) else 0
+    starts = np.searchsorted(group_codes, np.arange(n_groups))
+    ranks = np.arange(len(group_codes)) - np.repeat(starts, np.bincount(group_codes, minlength=n_groups))
+
+    n_relevant = np.bincount(group_codes, weights=relevant, minlength=n_groups)
+    return _metrics_at_k(group_codes, ranks, relevant, n_relevant, ks)
+
+
+def topn_metrics(recommendations: pd.DataFrame, truth: pd.DataFrame,
+                 ks: Sequence[int] = (5, 10)) -> pd.DataFrame:
+    """
+    Метрики для готовых top-N списков (ALS, TF-IDF, топы по сегментам, рандом).
+
+    Parameters:
+    recommendations: ehr_id, article_id и, опционально, rank (с 1); без rank
+        порядок строк внутри пользователя считается порядком выдачи
+    truth: ehr_id, article_id — реальные взаимодействия (тест)
+    ks: значения K
+
+    Returns:
+    DataFrame как у ranking_metrics. Оцениваются все пользователи truth:
+    у кого нет рекомендаций, получают нули.
+    """
+    truth = truth[["ehr_id", "article_id"]].drop_duplicates()
+    users = pd.Index(truth["ehr_id"].unique())
+    items = pd.Index(pd.unique(np.concatenate([truth["article_id"].to_numpy(),
+                                               recommendations["article_id"].to_numpy()])))
+    n_items = len(items)
+
+    truth_keys = np.sort(users.get_indexer(truth["ehr_id"]).astype(np.int64) * n_items
+                         + items.get_indexer(truth["article_id"]))
+    n_relevant = np.bincount(users.get_indexer(truth["ehr_id"]), minlength=len(users))
+
+    recs = recommendations
+    rec_users = users.get_indexer(recs["ehr_id"])
+    known = rec_users >= 0
+    rec_users = rec_users[known]
+    rec_items = items.get_indexer(recs["article_id"])[known]
+    if "rank" in recs.columns:
+        rank = recs["rank"].to_numpy()[known]
+    else:
+        rank = np.arange(known.sum())
+    order = np.lexsort((rank, rec_users))
+    rec_users, rec_items = rec_users[order], rec_items[order]
+
+    starts = np.searchsorted(rec_users, np.arange(len(users)))
+    ranks = np.arange(len(rec_users)) - np.repeat(starts, np.bincount(rec_users, minlength=len(users)))
+
+    keys = rec_users.astype(np.int64) * n_items + rec_items
+    pos = np.minimum(np.searchsorted(truth_keys, keys), max(len(truth_keys) - 1, 0))
+    relevant = truth_keys[pos] == keys if len(truth_keys) else np.zeros(len(keys), dtype=bool)
+
+    return _metrics_at_k(rec_users, ranks, relevant, n_relevant, ks)
+
+
+# ---------------------------------------------------------------------------
+# Beyond-accuracy: покрытие, Gini, разнообразие, новизна
+#
+# Выдача — матрица пользователи × K номеров статей в каталоге (-1 — пустая
+# позиция), как у recommend_batch и top_n_excluding.
+# ---------------------------------------------------------------------------
+
+def recommendation_matrix(recommendations: pd.DataFrame, article_index: pd.Index, k: int = None):
+    """
+    Длинная выдача (ehr_id, article_id, опционально rank) -> матрица пользователи × K.
+
+    Returns:
+    (ehr_id в порядке строк, номера статей в article_index B × K; -1 — пусто
+    или статьи нет в каталоге)
+    """
+    user_codes, users = pd.factorize(recommendations["ehr_id"])
+    items = article_index.get_indexer(recommendations["article_id"])
+    rank = recommendations["rank"].to_numpy() if "rank" in recommendations.columns else np.arange(len(items))
+    order = np.lexsort((rank, user_codes))
+    user_codes, items = user_codes[order], items[order]
+
+    counts = np.bincount(user_codes, minlength=len(users))
+    positions = np.arange(len(user_codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+    k = int(counts.max(initial=0)) if k is None else k
+    rows = np.full((len(users), k), -1, dtype=np.int64)
+    keep = positions < k
+    rows[user_codes[keep], positions[keep]] = items[keep]
+    return np.asarray(users), rows
+
+
+def recommendation_counts(rows: np.ndarray, n_items: int) -> np.ndarray:
+    """Сколько раз каждая статья каталога попала в выдачу"""
+    rows = np.asarray(rows)
+    return np.bincount(rows[rows >= 0], minlength=n_items)
+
+
+def catalog_coverage(rows: np.ndarray, n_items: int) -> float:
+    """Доля каталога, попавшая хотя бы в одну выдачу"""
+    return float(np.count_nonzero(recommendation_counts(rows, n_items)) / n_items) if n_items else 0.0
+
+
+def gini_index(counts) -> float:
+    """
+    Коэффициент Джини распределения показов: 0 — все статьи показаны поровну,
+    → 1 — показы сосредоточены на немногих. counts — показы по статьям (для
+    Gini по всему каталогу — recommendation_counts, включая нули).
+    """
+    counts = np.sort(np.asarray(counts, dtype=np.float64))
+    n, total = len(counts), counts.sum()
+    if n == 0 or total == 0:
+        return 0.0
+    return float(2 * np.sum(np.arange(1, n + 1) * counts) / (n * total) - (n + 1) / n)
+
+
+def _normalize_rows(vectors):
+    """L2-нормировка строк (sparse или dense); нулевые строки остаются нулевыми"""
+    if sparse.issparse(vectors):
+        vectors = sparse.csr_matrix(vectors, dtype=np.float64)
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        return sparse.diags(np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)) @ vectors
+    vectors = np.asarray(vectors, dtype=np.float64)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def intra_list_diversity(rows: np.ndarray, item_vectors, batch_size: int = 65536) -> np.ndarray:
+    """
+    Среднее попарное косинусное расстояние внутри выдачи каждого пользователя.
+
+    Попарные сходства не перебираются: для нормированных векторов
+    Σ_{i≠j} v_i·v_j = ‖Σ v_i‖² − Σ ‖v_i‖², поэтому на блок пользователей
+    нужен один gather-sum (разреженная матрица выбора × векторы статей).
+
+    Parameters:
+    rows: выдача B × K (номера строк item_vectors, -1 — пусто)
+    item_vectors: векторы статей (TF-IDF CSR или факторы ALS), нормируются внутри
+    batch_size: пользователей на один gather
+
+    Returns:
+    расстояние для каждого пользователя (NaN, если в выдаче меньше двух статей)
+    """
+    rows = np.asarray(rows)
+    vectors = _normalize_rows(item_vectors)
+    if sparse.issparse(vectors):
+        self_similarity = np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel()
+    else:
+        self_similarity = np.einsum("ij,ij->i", vectors, vectors)
+
+    result = np.full(len(rows), np.nan)
+    for start in range(0, len(rows), batch_size):
+        block = rows[start:start + batch_size]
+        valid = block >= 0
+        n = valid.sum(axis=1)
+        users = np.repeat(np.arange(len(block)), n)
+        items = block[valid]
+        select = sparse.csr_matrix((np.ones(len(items)), (users, items)), shape=(len(block), vectors.shape[0]))
+        sums = select @ vectors
+        if sparse.issparse(sums):
+            squared = np.asarray(sums.multiply(sums).sum(axis=1)).ravel()
+        else:
+            squared = np.einsum("ij,ij->i", sums, sums)
+        own = np.bincount(users, weights=self_similarity[items], minlength=len(block))
+        pairs = n * (n - 1) / 2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[start:start + len(block)] = np.where(n > 1, 1 - (squared - own) / 2 / pairs, np.nan)
+    return result
+
+
+def novelty(rows: np.ndarray, item_popularity, n_users: int) -> np.ndarray:
+    """
+    Средняя самоинформация −log2(p_i) статей выдачи, p_i — доля пользователей,
+    кликнувших статью. Статьи без кликов считаются кликнутыми одним
+    пользователем (максимальная новизна log2(n_users)).
+
+    Returns:
+    новизна для каждого пользователя (NaN для пустой выдачи)
+    """
+    rows = np.asarray(rows)
+    information = np.log2(n_users / np.maximum(np.asarray(item_popularity, dtype=np.float64), 1))
+    valid = rows >= 0
+    total = np.where(valid, information[np.where(valid, rows, 0)], 0).sum(axis=1)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def _mean_defined(values: np.ndarray) -> float:
+    """Среднее по пользователям, для которых метрика определена (не NaN)"""
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else float("nan")
+
+
+def beyond_accuracy_metrics(rows: np.ndarray, n_items: int, item_vectors=None,
+                            item_popularity=None, n_users: int = None) -> dict:
+    """
+    Метрики выдачи помимо точности сразу для всех пользователей.
+
+    Parameters:
+    rows: выдача B × K (номера статей каталога, -1 — пусто)
+    n_items: размер каталога
+    item_vectors: векторы статей для intra-list diversity (необязательно)
+    item_popularity: число пользователей с кликом по каждой статье для novelty (необязательно)
+    n_users: всего пользователей в истории (знаменатель популярности), нужен вместе с item_popularity
+
+    Returns:
+    dict: users, coverage, unique_items, gini (по всему каталогу), diversity, novelty
+    """
+    counts = recommendation_counts(rows, n_items)
+    result = {
+        "users": len(rows),
+        "coverage": float(np.count_nonzero(counts) / n_items) if n_items else 0.0,
+        "unique_items": int(np.count_nonzero(counts)),
+        "gini": gini_index(counts),
+    }
+    if item_vectors is not None:
+        result["diversity"] = _mean_defined(intra_list_diversity(rows, item_vectors))
+    if item_popularity is not None:
+        if n_users is None:
+            raise ValueError("для novelty нужен n_users")
+        result["novelty"] = _mean_defined(novelty(rows, item_popularity, n_users))
+    return result
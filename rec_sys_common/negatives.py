@@ -0,0 +1,222 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Во сколько раз больше кандидатов тянуть за раунд, чем не хватает
+OVERSAMPLE = 1.5
+MAX_ROUNDS = 8
+
+
+def click_matrix(user_codes: np.ndarray, item_codes: np.ndarray, n_users: int, n_items: int) -> sparse.csr_matrix:
+    """Булева CSR пользователи × статьи с отсортированными индексами"""
+    clicks = sparse.csr_matrix(
+        (np.ones(len(user_codes), dtype=bool), (user_codes, item_codes)),
+        shape=(n_users, n_items),
+    )
+    clicks.sum_duplicates()
+    clicks.sort_indices()
+    return clicks
+
+
+def popularity_weights(clicks: sparse.csr_matrix, alpha: float = 0.75) -> np.ndarray:
+    """
+    Веса для сэмплирования негативов пропорционально популярности^alpha
+    (alpha=0 — равномерно, 1 — пропорционально числу кликов).
+    Статьи без кликов получают вес как у статьи с одним кликом.
+    """
+    counts = np.asarray(clicks.sum(axis=0)).ravel().astype(np.float64)
+    return np.maximum(counts, 1.0) ** alpha
+
+
+def _contains(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Маска keys, присутствующих в отсортированном массиве sorted_keys"""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[pos] == keys
+
+
+def _draw(rng, n_items: int, size: int, cdf: np.ndarray = None) -> np.ndarray:
+    if cdf is None:
+        return rng.integers(0, n_items, size=size)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1], side="right"), n_items - 1)
+
+
+def _exact_sample(rng, clicks, users, accepted: dict, n_negatives: int, weights):
+    """
+    Точное сэмплирование для пользователей, которым не хватило кандидатов
+    после раундов отбора (почти весь каталог уже просмотрен).
+    """
+    out_users, out_items, short = [], [], 0
+    n_items = clicks.shape[1]
+    for u in users:
+        taken = accepted.get(u, np.empty(0, dtype=np.int64))
+        excluded = np.union1d(clicks.indices[clicks.indptr[u]:clicks.indptr[u + 1]], taken)
+        available = np.setdiff1d(np.arange(n_items), excluded, assume_unique=True)
+        need = min(n_negatives - len(taken), len(available))
+        if need < n_negatives - len(taken):
+            short += 1
+        if need <= 0:
+            continue
+        p = None
+        if weights is not None:
+            p = weights[available] / weights[available].sum()
+        out_items.append(rng.choice(available, size=need, replace=False, p=p))
+        out_users.append(np.full(need, u))
+    return out_users, out_items, short
+
+
+def sample_negatives(clicks: sparse.csr_matrix,
+                     n_negatives: int = 3,
+                     weights: np.ndarray = None,
+                     seed=None):
+    """
+    n_negatives непросмотренных статей на каждого пользователя без повторов.
+
+    Кандидаты для всех пользователей тянутся одним массивом и отбрасываются,
+    если попали в клики (поиск по ключам CSR) или повторились; пользователей,
+    которым не хватило, добирают следующими раундами.
+
+    Parameters:
+    clicks: булева CSR пользователи × статьи (click_matrix)
+    n_negatives: сколько негативов на пользователя
+    weights: веса статей для сэмплирования (popularity_weights), None — равномерно
+    seed: seed или np.random.Generator
+
+    Returns:
+    (коды пользователей, коды статей) — одномерные массивы, отсортированы по пользователю.
+    Если у пользователя непросмотренных статей меньше n_negatives, берутся все
+    оставшиеся и выдается предупреждение.
+    """
+    rng = np.random.default_rng(seed)
+    n_users, n_items = clicks.shape
+    clicks = clicks.tocsr()
+    clicks.sort_indices()
+    if n_negatives <= 0 or n_users == 0 or n_items == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    cdf = None
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        cdf = np.cumsum(weights)
+
+    # Ключи кликов user * n_items + item — отсортированы, т.к. индексы CSR отсортированы
+    row_lengths = np.diff(clicks.indptr)
+    clicked_keys = np.repeat(np.arange(n_users, dtype=np.int64), row_lengths) * n_items + clicks.indices
+
+    accepted_keys = np.empty(0, dtype=np.int64)
+    need = np.full(n_users, n_negatives, dtype=np.int64)
+    # Пользователи, у которых непросмотренного почти не осталось, сразу идут в точный режим
+    pending = np.flatnonzero(n_items - row_lengths > 2 * n_negatives)
+    exact = np.flatnonzero(n_items - row_lengths <= 2 * n_negatives)
+
+    for _ in range(MAX_ROUNDS):
+        if len(pending) == 0:
+            break
+        draws = np.ceil(need[pending] * OVERSAMPLE).astype(np.int64) + 2
+        users = np.repeat(pending, draws)
+        keys = users * n_items + _draw(rng, n_items, len(users), cdf)
+
+        # Отбрасываем клики и уже принятые
+        keys = keys[~_contains(clicked_keys, keys)]
+        keys = keys[~_contains(accepted_keys, keys)]
+        # Повторы внутри раунда: оставляем первое вхождение, порядок вытягивания сохраняем
+        _, first = np.unique(keys, return_index=True)
+        keys = keys[np.sort(first)]
+
+        # Первые need[u] кандидатов каждого пользователя (стабильно по порядку вытягивания)
+        users = keys // n_items
+        order = np.argsort(users, kind="stable")
+        keys, users = keys[order], users[order]
+        starts = np.searchsorted(users, users, side="left")
+        keep = np.arange(len(keys)) - starts < need[users]
+        keys, users = keys[keep], users[keep]
+
+        accepted_keys = np.sort(np.concatenate([accepted_keys, keys]))
+        need -= np.bincount(users, minlength=n_users)
+        pending = pending[need[pending] > 0]
+
+    user_codes = accepted_keys // n_items
+    item_codes = accepted_keys % n_items
+
+    leftovers = np.concatenate([exact, pending])
+    if len(leftovers):
+        accepted = {}
+        if len(pending):
+            mask = np.isin(user_codes, pending)
+            for u, items in zip(*_split_by_user(user_codes[mask], item_codes[mask])):
+                accepted[u] = items
+        extra_users, extra_items, short = _exact_sample(rng, clicks, leftovers, accepted, n_negatives, weights)
+        if short:
+            warnings.warn(f"{short} пользователей просмотрели почти весь каталог: "
+                          f"для них меньше {n_negatives} негативов")
+        user_codes = np.concatenate([user_codes] + extra_users).astype(np.int64)
+        item_codes = np.concatenate([item_codes] + extra_items).astype(np.int64)
+        order = np.argsort(user_codes, kind="stable")
+        user_codes, item_codes = user_codes[order], item_codes[order]
+
+    return user_codes, item_codes
+
+
+def _split_by_user(user_codes: np.ndarray, item_codes: np.ndarray):
+    users, starts = np.unique(user_codes, return_index=True)
+    return users, np.split(item_codes, starts[1:])
+
+
+def generate_negative_samples(df: pd.DataFrame,
+                              all_articles=None,
+                              n_negatives: int = 3,
+                              popularity: float = None,
+                              user_features: pd.DataFrame = None,
+                              article_features: pd.DataFrame = None,
+                              seed=None) -> pd.DataFrame:
+    """
+    Негативные примеры (label=0) для всех пользователей df одним проходом.
+
+    Parameters:
+    df: клики с колонками ehr_id, article_id
+    all_articles: каталог, из которого сэмплируются негативы (по умолчанию — статьи df
+        и article_features)
+    n_negatives: сколько негативов на пользователя
+    popularity: alpha для сэмплирования пропорционально популярности^alpha,
+        None — равномерно
+    user_features: DataFrame с ehr_id и признаками пользователя — присоединяются к негативам
+    article_features: DataFrame с article_id и признаками статьи — присоединяются к негативам
+    seed: seed генератора
+
+    Returns:
+    DataFrame ehr_id, article_id, label и колонки признаков (без merge —
+    признаки берутся индексацией по кодам)
+    """
+    if all_articles is None:
+        all_articles = df['article_id'].unique()
+        if article_features is not None:
+            all_articles = np.union1d(all_articles, article_features['article_id'].unique())
+    items = pd.Index(pd.unique(np.asarray(list(all_articles))))
+    user_codes, users = pd.factorize(df['ehr_id'])
+    item_codes = items.get_indexer(df['article_id'])
+
+    # Клики по статьям вне каталога не мешают сэмплированию
+    known = item_codes >= 0
+    clicks = click_matrix(user_codes[known], item_codes[known], len(users), len(items))
+    weights = popularity_weights(clicks, popularity) if popularity is not None else None
+
+    neg_users, neg_items = sample_negatives(clicks, n_negatives, weights, seed)
+    columns = {
+        'ehr_id': users.to_numpy()[neg_users],
+        'article_id': items.to_numpy()[neg_items],
+        'label': np.zeros(len(neg_users), dtype=np.int64),
+    }
+
+    if article_features is not None:
+        table = article_features.drop_duplicates('article_id').set_index('article_id').reindex(items)
+        for col in table.columns:
+            columns[col] = table[col].to_numpy()[neg_items]
+    if user_features is not None:
+        table = user_features.drop_duplicates('ehr_id').set_index('ehr_id').reindex(users)
+        for col in table.columns:
+            columns[col] = table[col].to_numpy()[neg_users]
+
+    return pd.DataFrame(columns)
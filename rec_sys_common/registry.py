@@ -0,0 +1,298 @@
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy import sparse
+
+from rec_sys_common.loader import file_hash
+
+# Версия формата папки артефакта; меняется при несовместимых изменениях раскладки
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+LATEST = "LATEST"
+
+
+class ArtifactError(ValueError):
+    """Артефакт поврежден, неполон или другого типа/версии формата"""
+
+
+# --- Примитивы: массивы, CSR, таблицы ---------------------------------------
+
+def save_array(directory: Path, name: str, array) -> None:
+    """Массив в name.npy (числовые — без pickle, поэтому открываются через mmap)"""
+    array = np.ascontiguousarray(array)
+    np.save(Path(directory) / f"{name}.npy", array, allow_pickle=array.dtype == object)
+
+
+def load_array(directory: Path, name: str, mmap: bool = True) -> np.ndarray:
+    """
+    Массив из name.npy. С mmap=True числовой массив отображается в память
+    только на чтение: загрузка не копирует данные, а страницы файла общие
+    для всех процессов, открывших тот же артефакт.
+    """
+    path = Path(directory) / f"{name}.npy"
+    try:
+        return np.load(path, mmap_mode="r" if mmap else None)
+    except ValueError:
+        # object-массив (строковые id) через mmap не открыть
+        return np.load(path, allow_pickle=True)
+
+
+def save_csr(directory: Path, name: str, matrix) -> None:
+    """CSR матрица как три .npy (data/indices/indptr) + форма — без сжатия npz, чтобы читать через mmap"""
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    save_array(directory, f"{name}.data", matrix.data)
+    save_array(directory, f"{name}.indices", matrix.indices)
+    save_array(directory, f"{name}.indptr", matrix.indptr)
+    save_array(directory, f"{name}.shape", np.asarray(matrix.shape, dtype=np.int64))
+
+
+def load_csr(directory: Path, name: str, mmap: bool = True) -> sparse.csr_matrix:
+    """CSR матрица из save_csr; с mmap=True массивы матрицы — memmap без копирования"""
+    parts = [load_array(directory, f"{name}.{part}", mmap) for part in ("data", "indices", "indptr")]
+    shape = tuple(int(x) for x in load_array(directory, f"{name}.shape", mmap=False))
+    matrix = sparse.csr_matrix(tuple(parts), shape=shape, copy=False)
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def save_table(directory: Path, name: str, df: pd.DataFrame) -> None:
+    """Таблица (метаданные статей и т.п.) в Arrow IPC без сжатия, вместе с индексом pandas"""
+    table = pa.Table.from_pandas(df)
+    with pa.OSFile(str(Path(directory) / f"{name}.arrow"), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def load_table(directory: Path, name: str) -> pd.DataFrame:
+    """Таблица из save_table: файл читается через memory map, числовые колонки без копирования"""
+    with pa.memory_map(str(Path(directory) / f"{name}.arrow")) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+# --- Версии и манифест ------------------------------------------------------
+
+def _manifest_files(directory: Path) -> Dict[str, dict]:
+    files = {}
+    for path in sorted(directory.rglob("*")):
+        if path.is_file() and path.name != MANIFEST:
+            files[path.relative_to(directory).as_posix()] = {
+                "sha256": file_hash(path),
+                "bytes": path.stat().st_size,
+            }
+    return files
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+def publish(root, name: str, kind: str, write: Callable[[Path], None],
+            meta: dict = None, set_latest: bool = True, keep: int = None) -> Path:
+    """
+    Публикует новую версию артефакта root/name/<version>/.
+
+    write(directory) записывает файлы модели во временную папку; затем
+    считаются sha256 всех файлов, пишется manifest.json, и папка атомарно
+    переименовывается в версию. Указатель root/name/LATEST заменяется
+    тоже атомарно, поэтому читатели видят либо старую, либо новую версию
+    целиком.
+
+    Parameters:
+    root: корень реестра
+    name: имя модели (als, tfidf, catboost, ...)
+    kind: тип артефакта — проверяется при загрузке
+    write: функция, записывающая файлы в переданную папку
+    meta: произвольные JSON-сериализуемые параметры (гиперпараметры, признаки)
+    set_latest: обновить ли LATEST
+    keep: после переключения LATEST оставить столько последних версий
+          (prune_versions); None — хранить все
+
+    Returns:
+    путь к папке опубликованной версии
+    """
+    model_dir = Path(root) / name
+    model_dir.mkdir(parents=True, exist_ok=True)
+    version = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    tmp_dir = model_dir / f".tmp-{version}"
+    tmp_dir.mkdir()
+    try:
+        write(tmp_dir)
+        manifest = {
+            "name": name,
+            "kind": kind,
+            "version": version,
+            "format_version": FORMAT_VERSION,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "files": _manifest_files(tmp_dir),
+            "meta": meta or {},
+        }
+        (tmp_dir / MANIFEST).write_text(json.dumps(manifest, ensure_ascii=False, indent=1))
+        os.replace(tmp_dir, model_dir / version)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if set_latest:
+        _write_atomic(model_dir / LATEST, version)
+    if keep is not None:
+        prune_versions(root, name, keep)
+    return model_dir / version
+
+
+def prune_versions(root, name: str, keep: int) -> List[str]:
+    """
+    Удаляет старые версии модели, кроме keep последних и той, на которую
+    указывает LATEST (ее не удалить, даже если она старше). Читатели,
+    уже открывшие удаленную версию через mmap, дочитывают ее: удаляются
+    только имена файлов.
+
+    Returns:
+    удаленные версии
+    """
+    if keep < 1:
+        raise ValueError(f"keep должно быть не меньше 1, получено {keep}")
+    model_dir = Path(root) / name
+    latest = model_dir / LATEST
+    current = latest.read_text().strip() if latest.exists() else None
+    removed = []
+    for version in list_versions(root, name)[:-keep]:
+        if version != current:
+            shutil.rmtree(model_dir / version, ignore_errors=True)
+            removed.append(version)
+    return removed
+
+
+def list_versions(root, name: str) -> List[str]:
+    """Опубликованные версии модели по возрастанию"""
+    model_dir = Path(root) / name
+    if not model_dir.exists():
+        return []
+    return sorted(p.name for p in model_dir.iterdir() if (p / MANIFEST).exists())
+
+
+def resolve(root, name: str = None, version: str = None) -> Path:
+    """
+    Папка версии артефакта.
+
+    Принимает папку версии (с manifest.json), папку модели (root/name,
+    берется LATEST) или корень реестра + name и, опционально, version.
+    """
+    path = Path(root)
+    if name is not None:
+        path = path / name
+    if version is not None:
+        path = path / version
+    if (path / MANIFEST).exists():
+        return path
+    latest = path / LATEST
+    if not latest.exists():
+        raise ArtifactError(f"{path}: нет {MANIFEST} и {LATEST}")
+    return path / latest.read_text().strip()
+
+
+def open_artifact(path, kind: str = None, verify: bool = False) -> Tuple[Path, dict]:
+    """
+    Манифест артефакта с проверкой целостности.
+
+    Всегда проверяются тип, версия формата, наличие и размеры файлов — это
+    дешево. Полная проверка sha256 (verify=True) читает все файлы и нужна
+    при переносе артефактов между машинами, а не на каждый старт воркера.
+
+    Returns:
+    (папка версии, манифест)
+    """
+    path = resolve(path)
+    manifest = json.loads((path / MANIFEST).read_text())
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ArtifactError(f"{path}: формат {manifest.get('format_version')}, ожидается {FORMAT_VERSION}")
+    if kind is not None and manifest["kind"] != kind:
+        raise ArtifactError(f"{path}: артефакт типа {manifest['kind']}, ожидается {kind}")
+
+    for rel, info in manifest["files"].items():
+        file = path / rel
+        if not file.exists() or file.stat().st_size != info["bytes"]:
+            raise ArtifactError(f"{path}: файл {rel} отсутствует или другого размера")
+        if verify and file_hash(file) != info["sha256"]:
+            raise ArtifactError(f"{path}: не совпадает sha256 у {rel}")
+    return path, manifest
+
+
+# --- ALS --------------------------------------------------------------------
+
+def save_als(root, user_factors, item_factors, user_ids, item_ids, interactions,
+             name: str = "als", meta: dict = None) -> Path:
+    """
+    ALS: факторы float32, маппинги id и матрица взаимодействий (для
+    исключения просмотренного).
+
+    Returns:
+    путь к опубликованной версии
+    """
+    def write(directory):
+        save_array(directory, "user_factors", np.asarray(user_factors, dtype=np.float32))
+        save_array(directory, "item_factors", np.asarray(item_factors, dtype=np.float32))
+        save_array(directory, "user_ids", np.asarray(user_ids))
+        save_array(directory, "item_ids", np.asarray(item_ids))
+        save_csr(directory, "interactions", interactions)
+
+    meta = dict(meta or {}, factors=int(np.shape(user_factors)[1]),
+                n_users=len(user_ids), n_items=len(item_ids))
+    return publish(root, name, "als", write, meta)
+
+
+def load_als(path, verify: bool = False, mmap: bool = True) -> dict:
+    """
+    ALS из реестра: dict user_factors, item_factors, user_ids, item_ids,
+    interactions, manifest. С mmap=True факторы и взаимодействия — memmap.
+    """
+    path, manifest = open_artifact(path, "als", verify)
+    return {
+        "user_factors": load_array(path, "user_factors", mmap),
+        "item_factors": load_array(path, "item_factors", mmap),
+        "user_ids": load_array(path, "user_ids", mmap),
+        "item_ids": load_array(path, "item_ids", mmap),
+        "interactions": load_csr(path, "interactions", mmap),
+        "manifest": manifest,
+    }
+
+
+# --- CatBoost ---------------------------------------------------------------
+
+def save_catboost(root, model, features: List[str], cat_features: List[str] = (),
+                  name: str = "catboost", meta: dict = None) -> Path:
+    """
+    CatBoost модель в родном формате .cbm (вместе с CTR-статистиками
+    категориальных признаков) + порядок признаков и список категориальных
+    в манифесте — по ним собирается матрица на инференсе.
+    """
+    def write(directory):
+        model.save_model(str(directory / "model.cbm"), format="cbm")
+
+    meta = dict(meta or {}, model_class=type(model).__name__,
+                features=list(features), cat_features=list(cat_features))
+    return publish(root, name, "catboost", write, meta)
+
+
+def load_catboost(path, verify: bool = False):
+    """
+    CatBoost модель из реестра.
+
+    Returns:
+    (модель, manifest); признаки — manifest['meta']['features'] и ['cat_features']
+    """
+    import catboost
+
+    path, manifest = open_artifact(path, "catboost", verify)
+    model = getattr(catboost, manifest["meta"]["model_class"])()
+    model.load_model(str(path / "model.cbm"), format="cbm")
+    return model, manifest
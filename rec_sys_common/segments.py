@@ -0,0 +1,266 @@
+"""
+Демографические сегменты (пол × возрастная группа) и плотная таблица их топов.
+
+Возрастная группа считается одним searchsorted по границам AGE_BOUNDS
+(или своим границам) для всего столбца сразу. Топы сегментов лежат
+массивом items[gender, age_group, :K]: рекомендации по демографии —
+одно индексирование, без фильтрации DataFrame на каждый запрос.
+"""
+import bisect
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from rec_sys_common import registry
+
+# Границы возрастных групп: 0–17, 18–29, 30–44, 45–59, 60+
+AGE_BOUNDS = [18, 30, 45, 60]
+
+# Возраст или пол неизвестен
+MISSING = -1
+
+# Чем добирать топ сегмента, если в нем меньше K статей: топ пола, затем общий
+FALLBACKS = ("gender", "global")
+
+
+def age_group(age, bounds: Sequence = AGE_BOUNDS) -> int:
+    """Возрастная группа одного возраста (MISSING для None/NaN)"""
+    if age is None or pd.isna(age):
+        return MISSING
+    return bisect.bisect_right(bounds, age)
+
+
+def age_groups(ages, bounds: Sequence = AGE_BOUNDS) -> np.ndarray:
+    """
+    Возрастные группы столбца возрастов одним searchsorted.
+
+    Parameters:
+    ages: массив / Series (в т.ч. nullable Int64), пропуски — NaN/NA
+    bounds: возрастающие границы групп: группа i — возраст в [bounds[i-1], bounds[i])
+
+    Returns:
+    int8 массив групп 0..len(bounds), MISSING для пропусков
+    """
+    ages = pd.to_numeric(pd.Series(ages), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    groups = np.searchsorted(np.asarray(bounds, dtype=np.float64), ages, side="right").astype(np.int8)
+    groups[np.isnan(ages)] = MISSING
+    return groups
+
+
+def _ranked_tops(keys: np.ndarray, article_ids: np.ndarray, clicks: np.ndarray,
+                 n_keys: int, k: int) -> np.ndarray:
+    """
+    Top-k строк по кликам для каждого ключа 0..n_keys-1 сразу
+    (при равенстве кликов — меньший article_id, как сортировка сгруппированных кликов).
+
+    Returns:
+    n_keys × k индексов входных строк (-1 — пусто)
+    """
+    table = np.full((n_keys, k), MISSING, dtype=np.int64)
+    order = np.lexsort((article_ids, -clicks, keys))
+    keys = keys[order]
+    starts = np.searchsorted(keys, keys, side="left")
+    rank = np.arange(len(keys)) - starts
+    top = rank < k
+    table[keys[top], rank[top]] = order[top]
+    return table
+
+
+def _fill(k: int, *lists: np.ndarray) -> np.ndarray:
+    """Первые k различных статей из списков по очереди (-1 пропускаются)"""
+    items = pd.unique(np.concatenate([np.asarray(lst)[np.asarray(lst) >= 0] for lst in lists]))[:k]
+    out = np.full(k, MISSING, dtype=np.int32)
+    out[:len(items)] = items
+    return out
+
+
+class SegmentTops:
+    """
+    Топы сегментов плотной таблицей.
+
+        items    int32  (G + 1) × (A + 1) × K — номера статей в article_ids, -1 — пусто
+        sizes    int32  (G + 1) × (A + 1) — сколько статей собственного топа у сегмента
+                        (0 — сегмента в данных нет)
+        genders  int64  G — значение пола для индекса 0..G-1
+
+    Последний индекс по каждой оси — «неизвестно»: [g, A] — топ пола g
+    (с добором общим), [G, *] — общий топ. Топ сегмента короче K при
+    построении добирается по fallback (пол, затем общий), поэтому запрос
+    не ветвится.
+    """
+
+    def __init__(self, items: np.ndarray, sizes: np.ndarray, genders: np.ndarray, article_ids: np.ndarray,
+                 bounds: Sequence = AGE_BOUNDS, fallback: Sequence = FALLBACKS, gender_tops: bool = True):
+        """
+        gender_tops: есть ли в таблице топы пола (False — строки [g, A] содержат общий топ)
+        """
+        self.items = items
+        self.sizes = sizes
+        self.genders = np.asarray(genders, dtype=np.int64)
+        self.article_ids = np.asarray(article_ids, dtype=np.int64)
+        self.bounds = list(bounds)
+        self.fallback = tuple(fallback)
+        self.gender_tops = gender_tops
+        self.k = items.shape[2]
+        self.gender_index = {int(g): i for i, g in enumerate(self.genders)}
+
+    @classmethod
+    def _build(cls, own: np.ndarray, gender_tops: np.ndarray, global_top: np.ndarray, genders, article_ids,
+               k: int, bounds, fallback) -> "SegmentTops":
+        """own: G × A × k собственные топы, gender_tops: G × k (или None), global_top: k"""
+        n_genders, n_groups = own.shape[:2]
+        items = np.full((n_genders + 1, n_groups + 1, k), MISSING, dtype=np.int32)
+        sizes = np.zeros((n_genders + 1, n_groups + 1), dtype=np.int32)
+        sizes[:n_genders, :n_groups] = (own >= 0).sum(axis=2)
+        empty = np.empty(0, dtype=np.int64)
+        for g in range(n_genders):
+            by_gender = gender_tops[g] if gender_tops is not None else empty
+            items[g, :n_groups] = [_fill(k, own[g, a], by_gender if "gender" in fallback else empty,
+                                         global_top if "global" in fallback else empty)
+                                   for a in range(n_groups)]
+            items[g, n_groups] = _fill(k, by_gender, global_top)
+        items[n_genders, :] = _fill(k, global_top)
+        return cls(items, sizes, genders, article_ids, bounds, fallback, gender_tops is not None)
+
+    @classmethod
+    def from_counts(cls, counts: pd.DataFrame, k: int = 10, bounds: Sequence = AGE_BOUNDS,
+                    fallback: Sequence = FALLBACKS) -> "SegmentTops":
+        """
+        Таблица по кликам сегментов.
+
+        Parameters:
+        counts: gender, age_group, article_id, clicks — например
+                EventTable.segment_counts() или groupby(...).size(); строки с
+                неизвестным полом или возрастом идут только в топ пола и общий
+        k: длина топа
+        bounds: границы возрастных групп, по которым посчитан age_group
+        fallback: чем добирать короткие топы — подмножество ("gender", "global")
+        """
+        gender = pd.to_numeric(counts["gender"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        group = pd.to_numeric(counts["age_group"], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        article_codes, article_ids = pd.factorize(counts["article_id"].to_numpy(dtype=np.int64), sort=True)
+        clicks = counts["clicks"].to_numpy(dtype=np.float64)
+        n_articles, n_groups = len(article_ids), len(bounds) + 1
+
+        known_gender = ~np.isnan(gender)
+        genders = np.unique(gender[known_gender]).astype(np.int64)
+        gender_codes = np.full(len(counts), MISSING, dtype=np.int64)
+        gender_codes[known_gender] = np.searchsorted(genders, gender[known_gender])
+        known = known_gender & (group >= 0) & (group < n_groups)
+
+        def ranked(keys, mask, n_keys):
+            # Клики по (ключ, статья) суммируются: counts может содержать повторы ключей
+            pairs = keys[mask] * n_articles + article_codes[mask]
+            pairs, inverse = np.unique(pairs, return_inverse=True)
+            summed = np.bincount(inverse, weights=clicks[mask], minlength=len(pairs))
+            key, codes = np.divmod(pairs, n_articles)
+            if len(codes) == 0:
+                return np.full((n_keys, k), MISSING, dtype=np.int64)
+            top = _ranked_tops(key, article_ids[codes], summed, n_keys, k)
+            return np.where(top >= 0, codes[np.maximum(top, 0)], MISSING)
+
+        own = ranked(gender_codes * n_groups + np.where(known, group, 0).astype(np.int64), known,
+                     len(genders) * n_groups).reshape(len(genders), n_groups, k)
+        gender_tops = ranked(gender_codes, known_gender, len(genders))
+        global_top = ranked(np.zeros(len(counts), dtype=np.int64), np.ones(len(counts), dtype=bool), 1)[0]
+        return cls._build(own, gender_tops, global_top, genders, np.asarray(article_ids), k, bounds, fallback)
+
+    @classmethod
+    def from_dict(cls, segment_tops: Dict, global_top: List = (), k: int = None,
+                  bounds: Sequence = AGE_BOUNDS, fallback: Sequence = ("global",)) -> "SegmentTops":
+        """
+        Таблица из готовых топов {(gender, age_group): [article_id, ...]}
+        (save_recommendations). Кликов в словаре нет, поэтому топ пола
+        не строится: короткие сегменты добираются только общим топом.
+        """
+        k = k or max([len(top) for top in segment_tops.values()] + [len(global_top), 1])
+        genders = np.unique([int(g) for g, _ in segment_tops]).astype(np.int64)
+        ids = [int(a) for top in [global_top, *segment_tops.values()] for a in top]
+        article_ids = pd.unique(np.asarray(ids, dtype=np.int64))
+        index = pd.Index(article_ids)
+
+        def codes(top):
+            out = np.full(k, MISSING, dtype=np.int64)
+            top = index.get_indexer(np.asarray(list(top)[:k], dtype=np.int64))
+            out[:len(top)] = top
+            return out
+
+        n_groups = len(bounds) + 1
+        own = np.full((len(genders), n_groups, k), MISSING, dtype=np.int64)
+        for (g, a), top in segment_tops.items():
+            if 0 <= int(a) < n_groups:
+                own[np.searchsorted(genders, int(g)), int(a)] = codes(top)
+        return cls._build(own, None, codes(global_top), genders, article_ids, k, bounds, fallback)
+
+    def cells(self, genders, groups):
+        """(gender, age_group) -> индексы таблицы; неизвестные значения — в последний индекс оси"""
+        genders = pd.to_numeric(pd.Series(genders), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        groups = np.asarray(groups, dtype=np.float64)
+        n_genders, n_groups = len(self.genders), len(self.bounds) + 1
+        g = np.searchsorted(self.genders, genders)
+        found = g < n_genders
+        found[found] = self.genders[g[found]] == genders[found]
+        g[~found] = n_genders
+        a = np.where((groups >= 0) & (groups < n_groups), groups, n_groups).astype(np.int64)
+        return g, a
+
+    def lookup(self, genders, ages, n: int = None) -> np.ndarray:
+        """
+        Топы для массивов пол/возраст одним индексированием.
+
+        Returns:
+        B × n article_id (-1 — пусто)
+        """
+        g, a = self.cells(genders, age_groups(ages, self.bounds))
+        items = self.items[g, a, :n]
+        return np.where(items >= 0, self.article_ids[np.maximum(items, 0)], MISSING)
+
+    def cell(self, gender, age):
+        """Индекс таблицы для одного пользователя — без pandas, для онлайн-запросов"""
+        g = self.gender_index.get(gender, len(self.genders))
+        a = age_group(age, self.bounds)
+        return g, (a if a != MISSING else len(self.bounds) + 1)
+
+    def recommend(self, gender, age, n: int = 10) -> np.ndarray:
+        """article_id топа для одного пользователя (сегмент с fallback)"""
+        items = self.items[self.cell(gender, age)][:n]
+        return self.article_ids[items[items >= 0]]
+
+    def source(self, cell) -> str:
+        """Откуда выдача ячейки: 'segment' — собственный топ, 'gender' — топ пола, 'global' — общий"""
+        if self.sizes[cell] > 0:
+            return "segment"
+        return "gender" if self.gender_tops and cell[0] < len(self.genders) else "global"
+
+    def to_dict(self) -> Dict:
+        """Собственные топы сегментов в формате prepare_recommendation_systems: {(gender, age_group): [article_id]}"""
+        tops = {}
+        for g, gender in enumerate(self.genders):
+            for a in np.flatnonzero(self.sizes[g, :-1]):
+                tops[(int(gender), int(a))] = self.article_ids[self.items[g, a, :self.sizes[g, a]]].tolist()
+        return tops
+
+    def global_top(self, n: int = None) -> np.ndarray:
+        """article_id общего топа"""
+        items = self.items[-1, -1, :n]
+        return self.article_ids[items[items >= 0]]
+
+    def save(self, root, name: str = "segment_tops", meta: dict = None):
+        """Публикует таблицу в реестр артефактов"""
+        def write(directory):
+            registry.save_array(directory, "items", self.items)
+            registry.save_array(directory, "sizes", self.sizes)
+            registry.save_array(directory, "genders", self.genders)
+            registry.save_array(directory, "article_ids", self.article_ids)
+
+        meta = dict(meta or {}, bounds=self.bounds, fallback=list(self.fallback), gender_tops=self.gender_tops,
+                    k=self.k)
+        return registry.publish(root, name, "segment_tops", write, meta)
+
+    @classmethod
+    def load(cls, path, verify: bool = False) -> "SegmentTops":
+        path, manifest = registry.open_artifact(path, "segment_tops", verify)
+        meta = manifest["meta"]
+        return cls(*(registry.load_array(path, name, mmap=False) for name in ("items", "sizes", "genders", "article_ids")),
+                   bounds=meta["bounds"], fallback=meta["fallback"], gender_tops=meta["gender_tops"])
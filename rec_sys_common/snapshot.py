@@ -0,0 +1,249 @@
+"""
+Снимок рекомендаций для сервинга: заранее посчитанный top-N каждого
+пользователя и топы сегментов, сохраненные в реестр артефактов
+(rec_sys_common/registry.py) массивами фиксированной ширины.
+
+    items         int32   users × K — номер статьи в article_ids (-1 — пусто)
+    scores        float16 users × K
+    user_table    int32   ehr_id − id_min -> строка items (-1 — нет)
+      или user_keys/user_rows — отсортированные ehr_id и их строки,
+      если id разрежены
+    article_ids   int64   номер статьи -> article_id
+    segment_keys  int64   S × 2 — (gender, age_group)
+    segment_items int32   S × K, global_items int32 K
+
+Все массивы открываются через mmap: чтение пользователя — одна-две
+страницы файла, а не загрузка снимка в кучу. Новая ночная версия
+публикуется атомарно (publish), SnapshotWatcher подхватывает ее по
+LATEST без перезапуска читателя.
+"""
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from rec_sys_common import registry
+
+SNAPSHOT_KIND = "snapshot"
+
+# Плотная таблица ehr_id -> строка, если диапазон id не больше DENSE_SPAN_RATIO × число пользователей
+DENSE_SPAN_RATIO = 4
+
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+# Сколько версий снимка хранить (каждая ночь — новая полная версия)
+SNAPSHOT_VERSIONS_KEEP = 3
+
+
+def _top_items(top: List, article_index: pd.Index, k: int) -> np.ndarray:
+    """Список article_id -> номера статей снимка, дополненные -1 до k"""
+    cols = article_index.get_indexer(np.asarray(top[:k], dtype=np.int64))
+    items = np.full(k, -1, dtype=np.int32)
+    items[:len(cols)] = cols
+    return items
+
+
+def save_snapshot(root, blocks: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]], n_users: int, k: int,
+                  article_ids, segment_tops: Dict = None, global_top: List = None,
+                  name: str = "snapshot", meta: dict = None, keep: int = SNAPSHOT_VERSIONS_KEEP) -> Path:
+    """
+    Публикует снимок рекомендаций.
+
+    Блоки пишутся сразу в memmap-файлы версии, поэтому весь снимок
+    в памяти не собирается.
+
+    Parameters:
+    root: корень реестра
+    blocks: итератор (ehr_id блока, строки статей B × n, scores B × n) —
+            как recommend_batch / recommend_als_batch; строка -1 — пусто
+    n_users: сколько всего пользователей во всех блоках
+    k: ширина снимка (лишние рекомендации блока отбрасываются)
+    article_ids: article_id для строк статей в blocks
+    segment_tops: {(gender, age_group): [article_id, ...]} (save_recommendations)
+    global_top: [article_id, ...]
+    name: имя артефакта в реестре
+    keep: сколько последних версий снимка оставить (None — все)
+
+    Returns:
+    путь к опубликованной версии
+    """
+    article_ids = np.asarray(article_ids, dtype=np.int64)
+    segment_tops = segment_tops or {}
+    global_top = list(global_top or [])
+    # Статьи топов, которых нет среди строк моделей, дописываются в конец каталога снимка
+    top_ids = pd.unique(np.asarray([a for top in [global_top, *segment_tops.values()] for a in top[:k]],
+                                   dtype=np.int64))
+    article_ids = np.concatenate([article_ids, top_ids[~np.isin(top_ids, article_ids)]])
+    article_index = pd.Index(article_ids)
+
+    def write(directory):
+        items = np.lib.format.open_memmap(directory / "items.npy", "w+", np.int32, (n_users, k))
+        scores = np.lib.format.open_memmap(directory / "scores.npy", "w+", np.float16, (n_users, k))
+        ehr_ids = np.empty(n_users, dtype=np.int64)
+        offset = 0
+        for users, rows, block_scores in blocks:
+            end = offset + len(users)
+            if end > n_users:
+                raise ValueError(f"в блоках больше пользователей, чем n_users={n_users}")
+            width = min(k, rows.shape[1])
+            rows = np.asarray(rows[:, :width])
+            block_scores = np.clip(np.asarray(block_scores[:, :width], dtype=np.float64), -FLOAT16_MAX, FLOAT16_MAX)
+            items[offset:end] = -1
+            items[offset:end, :width] = rows
+            scores[offset:end] = np.nan
+            scores[offset:end, :width] = np.where(rows >= 0, block_scores, np.nan)
+            ehr_ids[offset:end] = users
+            offset = end
+        if offset != n_users:
+            raise ValueError(f"в блоках {offset} пользователей, ожидалось n_users={n_users}")
+        items.flush()
+        scores.flush()
+        del items, scores
+
+        order = np.argsort(ehr_ids, kind="stable")
+        keys = ehr_ids[order]
+        if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+            raise ValueError("ehr_id в снимке повторяются")
+        if len(keys) and keys[-1] - keys[0] < DENSE_SPAN_RATIO * n_users:
+            table = np.full(int(keys[-1] - keys[0]) + 1, -1, dtype=np.int32)
+            table[keys - keys[0]] = order
+            registry.save_array(directory, "user_table", table)
+            meta.update(user_index="dense", id_min=int(keys[0]))
+        else:
+            registry.save_array(directory, "user_keys", keys)
+            registry.save_array(directory, "user_rows", order.astype(np.int32))
+            meta.update(user_index="sorted")
+
+        segment_keys = sorted(segment_tops)
+        registry.save_array(directory, "article_ids", article_ids)
+        registry.save_array(directory, "segment_keys", np.asarray(segment_keys, dtype=np.int64).reshape(-1, 2))
+        registry.save_array(directory, "segment_items", np.asarray(
+            [_top_items(segment_tops[key], article_index, k) for key in segment_keys], dtype=np.int32).reshape(-1, k))
+        registry.save_array(directory, "global_items", _top_items(global_top, article_index, k))
+
+    # Вид индекса пользователей известен только после записи блоков: write дописывает его в meta
+    meta = dict(meta or {}, k=k, n_users=n_users, n_articles=len(article_ids), n_segments=len(segment_tops))
+    return registry.publish(root, name, SNAPSHOT_KIND, write, meta, keep=keep)
+
+
+class RecommendationSnapshot:
+    """
+    Снимок рекомендаций, открытый только на чтение через mmap.
+
+    Строка пользователя находится за O(1) (плотная таблица) или бинарным
+    поиском по отсортированным ehr_id; читаются только страницы его
+    строки. Пользователь без строки получает топ своего сегмента, затем
+    общий топ.
+    """
+
+    def __init__(self, path, verify: bool = False):
+        """
+        Parameters:
+        path: папка версии, папка снимка (берется LATEST) или корень реестра/имя
+        verify: проверить sha256 всех файлов
+        """
+        self.path, manifest = registry.open_artifact(path, SNAPSHOT_KIND, verify)
+        self.meta = manifest["meta"]
+        self.version = manifest["version"]
+        self.k = self.meta["k"]
+        # np.asarray — обычный ndarray поверх того же mmap: срезы без накладных расходов np.memmap
+        self.items = np.asarray(registry.load_array(self.path, "items"))
+        self.scores = np.asarray(registry.load_array(self.path, "scores"))
+        self.article_ids = np.asarray(registry.load_array(self.path, "article_ids"))
+        if self.meta["user_index"] == "dense":
+            self.user_table = np.asarray(registry.load_array(self.path, "user_table"))
+            self.id_min = self.meta["id_min"]
+        else:
+            self.user_keys = np.asarray(registry.load_array(self.path, "user_keys"))
+            self.user_rows = np.asarray(registry.load_array(self.path, "user_rows"))
+
+        # Сегментов единицы: топы целиком в памяти
+        segment_items = registry.load_array(self.path, "segment_items", mmap=False)
+        self.segments = {(int(g), int(a)): segment_items[i]
+                         for i, (g, a) in enumerate(registry.load_array(self.path, "segment_keys", mmap=False))}
+        self.global_items = registry.load_array(self.path, "global_items", mmap=False)
+
+    def __len__(self):
+        return self.meta["n_users"]
+
+    def user_row(self, ehr_id: int) -> int:
+        """Строка пользователя в items или -1"""
+        if self.meta["user_index"] == "dense":
+            i = int(ehr_id) - self.id_min
+            return int(self.user_table[i]) if 0 <= i < len(self.user_table) else -1
+        i = int(np.searchsorted(self.user_keys, ehr_id))
+        return int(self.user_rows[i]) if i < len(self.user_keys) and self.user_keys[i] == ehr_id else -1
+
+    def user(self, ehr_id: int, n: int = None):
+        """
+        Персональная выдача из снимка.
+
+        Returns:
+        (номера статей, scores float16) без пустых позиций или None,
+        если пользователя в снимке нет
+        """
+        row = self.user_row(ehr_id)
+        if row < 0:
+            return None
+        items = self.items[row, :n]
+        valid = items >= 0
+        return items[valid], self.scores[row, :n][valid]
+
+    def fallback(self, gender=None, group=None, n: int = None):
+        """
+        Топ сегмента (gender, age_group), если он есть, иначе общий.
+
+        Returns:
+        (источник 'segment' / 'global', номера статей)
+        """
+        if gender is not None and group is not None:
+            items = self.segments.get((int(gender), int(group)))
+            if items is not None and items[0] >= 0:
+                items = items[:n]
+                return "segment", items[items >= 0]
+        items = self.global_items[:n]
+        return "global", items[items >= 0]
+
+    def recommend(self, ehr_id=None, gender=None, group=None, n: int = 10):
+        """
+        Returns:
+        (источник 'snapshot' / 'segment' / 'global', article_id, scores или None для топов)
+        """
+        if ehr_id is not None:
+            found = self.user(ehr_id, n)
+            if found is not None and len(found[0]):
+                return "snapshot", self.article_ids[found[0]], found[1]
+        source, items = self.fallback(gender, group, n)
+        return source, self.article_ids[items], None
+
+
+class SnapshotWatcher:
+    """
+    Текущая версия снимка для долго живущего читателя.
+
+    refresh() сверяет LATEST и, если вышла новая версия, открывает ее
+    и подменяет current одним присваиванием: запрос, уже взявший
+    старый снимок, дочитывает его, а память старой версии — страницы
+    файла, которые освобождаются вместе с последней ссылкой. Папки
+    версий неизменяемы, поэтому читатель никогда не видит полузаписанный
+    снимок.
+    """
+
+    def __init__(self, root, name: str = None):
+        """
+        Parameters:
+        root: папка снимка (root/name с LATEST) или корень реестра + name
+        """
+        self.root = Path(root) if name is None else Path(root) / name
+        self.current = RecommendationSnapshot(self.root)
+        self.swaps = 0
+
+    def refresh(self) -> bool:
+        """Подхватывает новую версию; True, если снимок сменился"""
+        path = registry.resolve(self.root)
+        if path == self.current.path:
+            return False
+        self.current = RecommendationSnapshot(path)
+        self.swaps += 1
+        return True
@@ -0,0 +1,241 @@
+"""
+Потоковый подсчет популярности: клики читаются из JSONL (или любого
+итератора событий) и сразу попадают в затухающие счетчики по сегментам
+(gender, age_group) и в общий — без полных groupby по истории.
+
+Затухание экспоненциальное с периодом полураспада half_life: клик
+возрастом half_life весит вдвое меньше свежего. Счетчики хранятся в
+«прямом» затухании (forward decay): вес клика — exp(rate · (t − landmark)),
+поэтому порядок статей не меняется со временем, и min-heap топа остается
+корректным между событиями; приводить к текущему моменту нужно только
+отдаваемые scores.
+"""
+import heapq
+import json
+import math
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from rec_sys_common.segments import age_group
+
+# Показатель exp, после которого счетчики перемасштабируются к новому landmark
+RESCALE_EXPONENT = 50.0
+# Статьи вне топа с затухшим весом меньше этого удаляются при перемасштабировании
+MIN_WEIGHT = 1e-3
+
+
+def event_time(value) -> float:
+    """created_at события в секундах unix-времени (число, ISO-строка или None — сейчас)"""
+    if value is None:
+        return time.time()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value)).timestamp()
+
+
+class DecayedTopK:
+    """
+    Затухающие счетчики кликов по статьям с точным top-K.
+
+    Счетчики растут только вверх (в forward decay), поэтому top-K
+    поддерживается min-heap: статья вне топа вытесняет минимум, как только
+    его обгоняет. Устаревшие записи кучи (статья выросла) отбрасываются
+    лениво. Запрос топа не зависит от числа статей — O(K log K).
+
+    version растет при каждом изменении состава или порядка топа (клик
+    по статье топа или вход новой); общее затухание порядок не меняет.
+    """
+
+    def __init__(self, k: int = 100, half_life: float = 24 * 3600.0):
+        """
+        Parameters:
+        k: размер поддерживаемого топа
+        half_life: период полураспада веса клика, секунды
+        """
+        self.k = k
+        self.rate = math.log(2) / half_life
+        self.landmark = None
+        self.scores: Dict = {}
+        self.top = set()
+        self.heap: List[Tuple[float, object]] = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _min(self):
+        """Актуальная запись минимума топа (устаревшие снимаются с кучи)"""
+        while self.heap:
+            score, item = self.heap[0]
+            if item in self.top and self.scores[item] == score:
+                return score, item
+            heapq.heappop(self.heap)
+        return None
+
+    def add(self, item, timestamp: float = None, weight: float = 1.0):
+        """Клик по статье item в момент timestamp (unix-время, по умолчанию сейчас)"""
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.landmark is None:
+            self.landmark = timestamp
+        exponent = self.rate * (timestamp - self.landmark)
+        if exponent > RESCALE_EXPONENT:
+            self.rescale(timestamp)
+            exponent = 0.0
+        score = self.scores.get(item, 0.0) + weight * math.exp(exponent)
+        self.scores[item] = score
+
+        if item in self.top:
+            heapq.heappush(self.heap, (score, item))
+            self.version += 1
+        elif len(self.top) < self.k:
+            self.top.add(item)
+            heapq.heappush(self.heap, (score, item))
+            self.version += 1
+        else:
+            current = self._min()
+            if current is not None and score > current[0]:
+                heapq.heappop(self.heap)
+                self.top.discard(current[1])
+                self.top.add(item)
+                heapq.heappush(self.heap, (score, item))
+                self.version += 1
+        # Устаревших записей не больше, чем обновлений топа; держим кучу компактной
+        if len(self.heap) > 4 * self.k + 16:
+            self.heap = [(self.scores[item], item) for item in self.top]
+            heapq.heapify(self.heap)
+
+    def rescale(self, timestamp: float):
+        """Перенос landmark в timestamp: все счетчики умножаются на один множитель, порядок сохраняется"""
+        factor = math.exp(-self.rate * (timestamp - self.landmark))
+        self.landmark = timestamp
+        self.scores = {
+            item: score * factor for item, score in self.scores.items()
+            if item in self.top or score * factor >= MIN_WEIGHT
+        }
+        self.heap = [(self.scores[item], item) for item in self.top]
+        heapq.heapify(self.heap)
+
+    def top_k(self, n: int = None, now: float = None) -> List[Tuple[object, float]]:
+        """
+        Текущий топ по убыванию веса.
+
+        Returns:
+        [(article_id, вес на момент now), ...] — не больше min(n, k) статей
+        """
+        if self.landmark is None:
+            return []
+        now = time.time() if now is None else now
+        factor = math.exp(-self.rate * (now - self.landmark))
+        items = sorted(self.top, key=lambda item: (-self.scores[item], item))[:n]
+        return [(item, self.scores[item] * factor) for item in items]
+
+
+class PopularityStream:
+    """
+    Затухающие топы по сегментам (gender, age_group) и общий.
+
+    Событие — dict с article_id и, опционально, gender, age (или age_group),
+    created_at, action_type (учитываются только CLICKED). События без пола
+    или возраста попадают только в общий топ.
+    """
+
+    def __init__(self, k: int = 100, half_life: float = 24 * 3600.0):
+        self.k = k
+        self.half_life = half_life
+        self.global_top = DecayedTopK(k, half_life)
+        self.segments: Dict[Tuple[int, int], DecayedTopK] = {}
+        self.events = 0
+
+    def add(self, event: dict):
+        if event.get("action_type", "CLICKED") != "CLICKED" or event.get("article_id") is None:
+            return
+        article_id = int(event["article_id"])
+        timestamp = event_time(event.get("created_at"))
+        self.global_top.add(article_id, timestamp)
+
+        gender = event.get("gender")
+        group = event.get("age_group")
+        if group is None and event.get("age") is not None:
+            group = age_group(event["age"])
+        if gender is not None and group is not None:
+            key = (int(gender), int(group))
+            segment = self.segments.get(key)
+            if segment is None:
+                segment = self.segments[key] = DecayedTopK(self.k, self.half_life)
+            segment.add(article_id, timestamp)
+        self.events += 1
+
+    def add_many(self, events: Iterable[dict]) -> int:
+        """Пачка событий; возвращает число учтенных"""
+        before = self.events
+        for event in events:
+            self.add(event)
+        return self.events - before
+
+    def top(self, gender=None, age=None, n: int = 10, now: float = None) -> List[Tuple[int, float]]:
+        """
+        Топ сегмента (gender, возрастная группа age) или общий, если
+        сегмент не задан или по нему еще не было кликов.
+        """
+        if gender is not None and age is not None:
+            segment = self.segments.get((int(gender), age_group(age)))
+            if segment is not None:
+                return segment.top_k(n, now)
+        return self.global_top.top_k(n, now)
+
+    def version(self, gender=None, age=None) -> Tuple[int, int]:
+        """
+        Версия топов, от которых зависит ответ по сегменту (gender, возрастная
+        группа age): (версия сегмента или -1, если его еще нет, версия общего)
+        """
+        segment = None
+        if gender is not None and age is not None:
+            segment = self.segments.get((int(gender), age_group(age)))
+        return (segment.version if segment is not None else -1), self.global_top.version
+
+    def snapshot(self, n: int = 10) -> dict:
+        """Топы в формате prepare_recommendation_systems (top/random_vs_top.py): segment_tops и global_top"""
+        return {
+            "segment_tops": {key: [a for a, _ in segment.top_k(n)] for key, segment in self.segments.items()},
+            "global_top": [a for a, _ in self.global_top.top_k(n)],
+        }
+
+
+class JsonlTail:
+    """
+    Чтение дописываемого JSONL-файла как очереди: poll() возвращает новые
+    полные строки с прошлого вызова. Недописанная последняя строка ждет
+    следующего poll, битые строки пропускаются.
+    """
+
+    def __init__(self, path, offset: int = 0):
+        """
+        Parameters:
+        path: JSONL, одно событие на строку
+        offset: позиция в файле, с которой начинать (0 — с начала)
+        """
+        self.path = Path(path)
+        self.offset = offset
+        self.skipped = 0
+
+    def poll(self, max_bytes: int = 1 << 24) -> List[dict]:
+        if not self.path.exists():
+            return []
+        if self.path.stat().st_size < self.offset:
+            self.offset = 0  # файл пересоздан
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(max_bytes)
+        end = chunk.rfind(b"\n") + 1
+        events = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                self.skipped += 1
+        self.offset += end
+        return events
@@ -0,0 +1,901 @@
+import copy
+import sys
+from pathlib import Path
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import MinMaxScaler
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.batch import ParquetChunkWriter, flatten_recommendations, top_n_excluding
+from rec_sys_common import registry
+from rec_sys_common.ann import build_index
+from rec_sys_common.events import EventTable
+from rec_sys_common.metrics import beyond_accuracy_metrics, intra_list_diversity
+from rec_sys_common.snapshot import save_snapshot
+
+# Веса смешивания контентной схожести и схожести по популярности
+CONTENT_WEIGHT = 0.9
+POPULARITY_WEIGHT = 0.1
+
+# Ограничение на размер плотного блока схожестей (элементов) при построении соседей
+BLOCK_ELEMENTS = 1 << 25
+
+# Колонки каталога статей
+ARTICLE_COLUMNS = ['article_id', 'title', 'tags', 'rubric_title', 'views', 'published_date']
+
+def top_indices(scores, top_n):
+    """
+    Индексы top_n максимальных конечных scores по убыванию
+    (argpartition + сортировка только выбранных, при равенстве — меньший индекс)
+    """
+    n_finite = int(np.isfinite(scores).sum())
+    top_n = min(top_n, n_finite)
+    if top_n <= 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
+
+
+def article_content(articles):
+    """
+    Каталог с текстом для TF-IDF: пропуски в title, tags, rubric_title
+    заполняются, content = заголовок дважды (больший вес) + теги + рубрика
+    """
+    articles = articles.copy()
+    
+    # Заполняем пропущенные значения
+    articles['tags'] = articles['tags'].fillna('')
+    articles['rubric_title'] = articles['rubric_title'].fillna('')
+    articles['title'] = articles['title'].fillna('')
+    
+    # Создаем комбинированное текстовое представление статьи
+    # Даем больший вес заголовку, повторяя его
+    articles['content'] = (
+        articles['title'] + ' ' + 
+        articles['title'] + ' ' +  # удваиваем заголовок для большего веса
+        articles['tags'].astype(str).str.replace(',', ' ') + ' ' + 
+        articles['rubric_title']
+    )
+    return articles
+
+
+def make_vectorizer():
+    """TF-IDF векторизатор системы (одни параметры для обучения и загрузки из реестра)"""
+    return TfidfVectorizer(
+        max_features=1000,
+        ngram_range=(1, 2),  # используем униграммы и биграммы
+        min_df=2,
+        max_df=0.8,
+        token_pattern=r'[а-яА-Яa-zA-Z]+' # учитываем и русские, и английские слова
+    )
+
+
+class HistorySlices:
+    """
+    ehr_id → срез (start, stop) в history_rows.
+    
+    Хранится двумя массивами вместо dict: хеш-таблица pd.Index строится
+    при первом обращении, поэтому загрузка из реестра не тратит время
+    на миллионы Python-объектов.
+    """
+    
+    def __init__(self, user_ids, indptr):
+        self.user_ids = np.asarray(user_ids)
+        self.indptr = np.asarray(indptr)
+        self.index = pd.Index(self.user_ids)
+    
+    def __len__(self):
+        return len(self.user_ids)
+    
+    def get(self, user_id, default=None):
+        try:
+            i = self.index.get_loc(user_id)
+        except (KeyError, TypeError):
+            return default
+        return int(self.indptr[i]), int(self.indptr[i + 1])
+    
+    def bounds(self, user_ids):
+        """Массив B×2 срезов для блока пользователей (неизвестные — пустой срез)"""
+        codes = self.index.get_indexer(np.asarray(user_ids))
+        bounds = np.stack([self.indptr[codes], self.indptr[codes + 1]], axis=1).astype(np.int64)
+        bounds[codes < 0] = 0
+        return bounds
+
+
+class ContentRecommenderSystem:
+    """
+    Контентная рекомендательная система на основе TF-IDF и косинусного сходства
+    """
+    
+    def __init__(self, df, n_neighbors=None, chunk_size=1024, ann=None):
+        """
+        Инициализация системы рекомендаций
+        
+        Parameters:
+        df: DataFrame с данными о статьях и пользователях или EventTable
+            (rec_sys_common/events.py) — тогда каталог берется из него, а события не копируются
+        n_neighbors: None — плотные матрицы схожести N×N (как раньше);
+            число — хранить только top-K соседей каждой статьи (разреженный режим)
+        chunk_size: сколько статей обрабатывать за блок при поиске соседей
+        ann: None — точные соседи; тип индекса rec_sys_common/ann.py ('ivf') —
+            приближенные, без сравнения каждой статьи со всем каталогом
+        """
+        # df только читается, поэтому не копируется
+        self.df = df
+        self.tfidf_matrix = None
+        self.article_features = None
+        self.n_neighbors = n_neighbors
+        self.chunk_size = chunk_size
+        self.ann = ann
+        self.prepare_data()
+        
+    def prepare_data(self):
+        """Подготовка данных для рекомендательной системы"""
+        
+        # Удаляем дубликаты статей для создания каталога
+        if isinstance(self.df, EventTable):
+            articles = self.df.catalog.frame()[ARTICLE_COLUMNS]
+        else:
+            articles = self.df[ARTICLE_COLUMNS].drop_duplicates('article_id')
+        self.articles = article_content(articles)
+        
+        self.fit_content()
+        self.build_indexes()
+        
+        print(f"Подготовлено {len(self.articles)} уникальных статей")
+        print(f"Размер TF-IDF матрицы: {self.tfidf_matrix.shape}")
+    
+    def fit_content(self):
+        """Словарь, idf, TF-IDF матрица и схожести (или соседи) по текущему каталогу"""
+        # Создаем TF-IDF матрицу
+        self.vectorizer = make_vectorizer()
+        
+        self.tfidf_matrix = self.vectorizer.fit_transform(self.articles['content'])
+        
+        # Добавляем нормализованную популярность как дополнительный признак
+        scaler = MinMaxScaler()
+        popularity_scores = scaler.fit_transform(self.articles[['views']].fillna(0))
+        self.views_min = float(scaler.data_min_[0])
+        self.added_since_fit = 0
+        
+        if self.n_neighbors is None:
+            # Комбинируем TF-IDF с популярностью (90% контент, 10% популярность)
+            self.content_similarity = cosine_similarity(self.tfidf_matrix)
+            self.final_similarity = CONTENT_WEIGHT * self.content_similarity + POPULARITY_WEIGHT * cosine_similarity(popularity_scores)
+        else:
+            # Косинус одномерных неотрицательных векторов популярности равен 1,
+            # если обе популярности ненулевые, и 0 иначе — считаем его на лету
+            self.popularity_nonzero = (popularity_scores.ravel() > 0).astype(np.float32)
+            self.neighbors = self.build_neighbors(self.n_neighbors)
+            print(f"Соседей на статью: {self.n_neighbors}, "
+                  f"размер индекса: {self.neighbors.data.nbytes + self.neighbors.indices.nbytes} байт")
+    
+    def build_neighbors(self, k):
+        """
+        Top-K соседей каждой статьи по косинусной схожести TF-IDF.
+        
+        Схожесть считается блоками строк, поэтому в памяти не бывает
+        больше chunk_size × N плотных значений. С self.ann соседи ищутся
+        через ANN индекс (ann_neighbors).
+        
+        Returns:
+        csr_matrix N×N (float32 схожести, int32 индексы) без самой статьи
+        """
+        # Строки TF-IDF нормированы по L2, косинус — просто скалярное произведение
+        tfidf = sparse.csr_matrix(self.tfidf_matrix, dtype=np.float32)
+        n_articles = tfidf.shape[0]
+        k = min(k, n_articles - 1)
+        if k <= 0:
+            return sparse.csr_matrix((n_articles, n_articles), dtype=np.float32)
+        chunk_size = max(1, min(self.chunk_size, BLOCK_ELEMENTS // n_articles))
+        
+        if self.ann is not None:
+            indices, scores = self.ann_neighbors(tfidf, k, chunk_size)
+        else:
+            indices = np.empty((n_articles, k), dtype=np.int32)
+            scores = np.empty((n_articles, k), dtype=np.float32)
+            tfidf_t = tfidf.T.tocsc()
+            for start in range(0, n_articles, chunk_size):
+                stop = min(start + chunk_size, n_articles)
+                block = (tfidf[start:stop] @ tfidf_t).toarray()
+                rows = np.arange(stop - start)
+                block[rows, rows + start] = -np.inf  # исключаем саму статью
+                top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+                indices[start:stop] = top
+                scores[start:stop] = block[rows[:, None], top]
+        
+        neighbors = sparse.csr_matrix(
+            (scores.ravel(), indices.ravel(), np.arange(0, n_articles * k + 1, k)),
+            shape=(n_articles, n_articles)
+        )
+        neighbors.eliminate_zeros()
+        neighbors.sort_indices()
+        return neighbors
+    
+    def ann_neighbors(self, tfidf, k, chunk_size):
+        """
+        Приближенные top-K соседей через ANN индекс по строкам TF-IDF.
+        
+        Returns:
+        (индексы N×K int32, схожести N×K float32); ненайденные соседи —
+        сама статья со схожестью 0 (удаляются eliminate_zeros)
+        """
+        n_articles = tfidf.shape[0]
+        index = build_index(tfidf, kind=self.ann)
+        indices = np.empty((n_articles, k), dtype=np.int32)
+        scores = np.empty((n_articles, k), dtype=np.float32)
+        for start in range(0, n_articles, chunk_size):
+            stop = min(start + chunk_size, n_articles)
+            own = np.arange(start, stop)
+            exclude = sparse.csr_matrix((np.ones(stop - start), own, np.arange(stop - start + 1)),
+                                        shape=(stop - start, n_articles))
+            top, top_scores = index.search(tfidf[start:stop], k, exclude=exclude)
+            missing = top < 0
+            indices[start:stop] = np.where(missing, own[:, None], top)
+            scores[start:stop] = np.where(missing, 0, top_scores)
+        return indices, scores
+    
+    def add_articles(self, articles):
+        """
+        Добавление новых статей без переобучения (разреженный режим).
+
+        Новые статьи векторизуются замороженными словарем и idf, их top-K
+        соседей ищут по всему каталогу, и сами они вставляются в списки
+        соседей старых статей, если оказываются ближе текущего K-го соседа.
+        Считаются только строки новых статей (M × N схожестей), остальной
+        индекс копируется без пересчета. Слова вне словаря не учитываются —
+        дрейф словаря снимает refit по расписанию.
+
+        Parameters:
+        articles: DataFrame с колонками ARTICLE_COLUMNS; уже известные article_id пропускаются
+
+        Returns:
+        self
+        """
+        if self.n_neighbors is None:
+            raise ValueError("add_articles работает только в разреженном режиме (n_neighbors)")
+        articles = articles[ARTICLE_COLUMNS].drop_duplicates('article_id')
+        articles = articles[self.article_index.get_indexer(articles['article_id']) < 0]
+        if len(articles) == 0:
+            return self
+        articles = article_content(articles)
+
+        n_old, n_new = len(self.article_ids), len(articles)
+        n_articles = n_old + n_new
+        new_tfidf = sparse.csr_matrix(self.vectorizer.transform(articles['content']), dtype=np.float32)
+        tfidf = sparse.vstack([sparse.csr_matrix(self.tfidf_matrix, dtype=np.float32), new_tfidf], format='csr')
+        tfidf_t = tfidf.T.tocsc()
+        k = min(self.n_neighbors, n_articles - 1)
+
+        # Порог вставки в старую строку: K-й сосед, если строка заполнена, иначе любая схожесть > 0
+        old = self.neighbors
+        lengths = np.diff(old.indptr)
+        nonempty = np.flatnonzero(lengths)
+        row_min = np.zeros(n_old, dtype=np.float32)
+        if len(nonempty):
+            row_min[nonempty] = np.minimum.reduceat(np.asarray(old.data), old.indptr[nonempty])
+        threshold = np.where(lengths >= k, row_min, 0)
+
+        forward, reverse = [], []
+        chunk_size = max(1, min(self.chunk_size, BLOCK_ELEMENTS // n_articles))
+        for start in range(0, n_new, chunk_size):
+            stop = min(start + chunk_size, n_new)
+            block = (new_tfidf[start:stop] @ tfidf_t).toarray()
+            rows = np.arange(stop - start)
+            block[rows, n_old + start + rows] = -np.inf  # исключаем саму статью
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k] if k > 0 else np.empty((len(rows), 0), dtype=int)
+            scores = block[rows[:, None], top]
+            keep = scores > 0
+            forward.append((np.repeat(n_old + start + rows, keep.sum(axis=1)), top[keep], scores[keep]))
+            # Обратное направление: новая статья ближе K-го соседа старой
+            old_rows, new_rows = np.nonzero((block[:, :n_old] > threshold).T)
+            reverse.append((old_rows, n_old + start + new_rows, block[new_rows, old_rows]))
+
+        # Затронутые старые строки: старые соседи + кандидаты, top-K заново
+        rev_rows, rev_cols, rev_scores = (np.concatenate(parts) for parts in zip(*reverse))
+        affected = np.unique(rev_rows)
+        current = old[affected].tocoo()
+        rows = np.concatenate([affected[current.row], rev_rows])
+        cols = np.concatenate([current.col, rev_cols])
+        scores = np.concatenate([current.data, rev_scores]).astype(np.float32)
+        order = np.lexsort((-scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        counts = np.bincount(rows, minlength=n_old)
+        keep = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts) < k
+
+        # Сборка: старые строки без затронутых + затронутые + строки новых статей
+        kept = sparse.csr_matrix(old, dtype=np.float32, copy=True)
+        affected_lengths = lengths[affected]
+        offsets = np.cumsum(affected_lengths) - affected_lengths
+        kept.data[np.repeat(kept.indptr[affected] - offsets, affected_lengths)
+                  + np.arange(affected_lengths.sum())] = 0
+        kept.eliminate_zeros()
+        kept.resize((n_articles, n_articles))
+        new_rows, new_cols, new_scores = (np.concatenate(parts) for parts in zip(*forward))
+        updates = sparse.csr_matrix(
+            (np.concatenate([scores[keep], new_scores]), (np.concatenate([rows[keep], new_rows]),
+                                                          np.concatenate([cols[keep], new_cols]))),
+            shape=(n_articles, n_articles), dtype=np.float32)
+        self.neighbors = (kept + updates).tocsr()
+        self.neighbors.sort_indices()
+
+        self.tfidf_matrix = tfidf
+        views = articles['views'].fillna(0).to_numpy(dtype=np.float64)
+        self.popularity_nonzero = np.concatenate([self.popularity_nonzero,
+                                                  (views > self.views_min).astype(np.float32)])
+        self.articles = pd.concat([self.articles, articles], ignore_index=True)
+        self.article_ids = self.articles['article_id'].to_numpy()
+        self.article_index = pd.Index(self.article_ids)
+        self.article_row.update(zip(self.article_ids[n_old:], range(n_old, n_articles)))
+        self.added_since_fit += n_new
+        return self
+
+    def refit(self):
+        """
+        Полное переобучение словаря, idf и соседей по текущему каталогу
+        (вместе с добавленными add_articles) — снимает дрейф словаря.
+
+        Исходная система не меняется: новая строится рядом (историю
+        пользователей делит с исходной), поэтому refit можно запускать по
+        расписанию в фоне и затем подменить ссылку (или опубликовать save).
+
+        Returns:
+        новая ContentRecommenderSystem
+        """
+        refitted = copy.copy(self)
+        # Изменяемые контейнеры каталога — свои: add_articles дополняет article_row на месте
+        refitted.articles = self.articles.copy()
+        refitted.article_row = dict(self.article_row)
+        refitted.fit_content()
+        return refitted
+
+    def neighbors_mismatch(self):
+        """
+        Проверка инкрементального индекса: сравнивает соседей (после
+        add_articles) с полным пересчетом build_neighbors по той же
+        TF-IDF матрице. Соседи с равной схожестью взаимозаменяемы,
+        поэтому сравниваются отсортированные схожести строк.
+
+        Returns:
+        число строк, чьи top-K схожести расходятся с пересчетом
+        """
+        def row_scores(neighbors):
+            k = max(int(np.diff(neighbors.indptr).max(initial=0)), 1)
+            scores = np.zeros((neighbors.shape[0], k), dtype=np.float32)
+            lengths = np.diff(neighbors.indptr)
+            rows = np.repeat(np.arange(neighbors.shape[0]), lengths)
+            order = np.lexsort((-neighbors.data, rows))
+            ranks = np.arange(len(rows)) - np.repeat(neighbors.indptr[:-1], lengths)
+            scores[rows, ranks] = neighbors.data[order]
+            return scores
+
+        current, rebuilt = row_scores(self.neighbors), row_scores(self.build_neighbors(self.n_neighbors))
+        if current.shape != rebuilt.shape:
+            width = max(current.shape[1], rebuilt.shape[1])
+            current, rebuilt = (np.pad(s, ((0, 0), (0, width - s.shape[1]))) for s in (current, rebuilt))
+        return int((~np.isclose(current, rebuilt, atol=1e-5)).any(axis=1).sum())
+
+    def similarity_row(self, article_idx):
+        """
+        Итоговая схожесть статьи (по позиции в self.articles) со всеми статьями.
+        
+        В разреженном режиме контентная часть берется из top-K соседей
+        (остальные считаются нулевыми), популярность смешивается здесь.
+        """
+        if self.n_neighbors is None:
+            return self.final_similarity[article_idx]
+        
+        row = POPULARITY_WEIGHT * self.popularity_nonzero[article_idx] * self.popularity_nonzero
+        start, stop = self.neighbors.indptr[article_idx], self.neighbors.indptr[article_idx + 1]
+        row[self.neighbors.indices[start:stop]] += CONTENT_WEIGHT * self.neighbors.data[start:stop]
+        # Сама с собой статья всегда максимально похожа, как и в плотном режиме
+        row[article_idx] = CONTENT_WEIGHT * (self.tfidf_matrix[article_idx].nnz > 0) \
+            + POPULARITY_WEIGHT * self.popularity_nonzero[article_idx]
+        return row
+        
+    def build_indexes(self):
+        """
+        Индексы для быстрых запросов: article_id → строка каталога
+        и ehr_id → срез истории (строки каталога в порядке первого просмотра)
+        """
+        self.article_ids = self.articles['article_id'].to_numpy()
+        self.article_index = pd.Index(self.article_ids)
+        self.article_row = dict(zip(self.article_ids, range(len(self.article_ids))))
+        
+        if isinstance(self.df, EventTable):
+            history = pd.DataFrame({'ehr_id': self.df.ehr_id, 'article_id': self.df.article_ids}).drop_duplicates()
+        else:
+            history = self.df.loc[self.df['ehr_id'].notna(), ['ehr_id', 'article_id']].drop_duplicates()
+        user_codes, user_ids = pd.factorize(history['ehr_id'])
+        order = np.argsort(user_codes, kind='stable')
+        self.history_rows = self.article_index.get_indexer(history['article_id'].to_numpy()[order])
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(user_codes, minlength=len(user_ids)))])
+        self.user_history_slices = HistorySlices(user_ids, indptr)
+    
+    def user_history_rows(self, user_id):
+        """Строки каталога просмотренных статей (без статей вне каталога)"""
+        start, stop = self.user_history_slices.get(user_id, (0, 0))
+        rows = self.history_rows[start:stop]
+        return rows[rows >= 0]
+    
+    def get_user_history(self, user_id):
+        """
+        Получение истории просмотров пользователя
+        
+        Parameters:
+        user_id: ID пользователя (ehr_id)
+        
+        Returns:
+        list: список ID просмотренных статей
+        """
+        start, stop = self.user_history_slices.get(user_id, (0, 0))
+        rows = self.history_rows[start:stop]
+        return self.article_ids[rows[rows >= 0]]
+    
+    def get_similar_articles(self, article_id, top_n=10):
+        """
+        Получение похожих статей для данной статьи
+        
+        Parameters:
+        article_id: ID статьи
+        top_n: количество рекомендаций
+        
+        Returns:
+        DataFrame с рекомендациями
+        """
+        if article_id not in self.article_row:
+            return pd.DataFrame()
+        
+        # Находим индекс статьи
+        article_idx = self.article_row[article_id]
+        
+        # Получаем похожие статьи, исключая саму статью
+        similarities = np.array(self.similarity_row(article_idx), dtype=np.float64)
+        similarities[article_idx] = -np.inf
+        article_indices = top_indices(similarities, top_n)
+        
+        # Создаем DataFrame с результатами
+        recommendations = self.articles.iloc[article_indices][['article_id', 'title', 'tags', 'rubric_title']].copy()
+        recommendations['similarity_score'] = similarities[article_indices]
+        
+        return recommendations
+    
+    def aggregate_scores(self, history_rows, method='weighted'):
+        """
+        Score всех статей каталога по истории пользователя.
+        
+        Parameters:
+        history_rows: строки каталога просмотренных статей, от старых к новым
+        method: 'weighted' — взвешенное среднее (новые просмотры важнее),
+            'max' — максимум, 'avg' — среднее схожестей
+        
+        Returns:
+        np.ndarray длины N
+        """
+        if method == 'weighted':
+            weights = np.linspace(0.5, 1.0, len(history_rows))
+        else:
+            weights = np.ones(len(history_rows))
+        weights = weights / weights.sum()
+        
+        if self.n_neighbors is None:
+            similarities = self.final_similarity[history_rows]
+            if method == 'max':
+                return similarities.max(axis=0)
+            return weights @ similarities
+        
+        # Разреженный режим: популярность — ранг-1 слагаемое, контент — соседи
+        popularity = self.popularity_nonzero
+        history_popularity = popularity[history_rows].astype(np.float64)
+        neighbors = self.neighbors[history_rows]
+        if method == 'max':
+            scores = POPULARITY_WEIGHT * history_popularity.max() * popularity.astype(np.float64)
+            neighbors = neighbors.tocoo()
+            values = (POPULARITY_WEIGHT * history_popularity[neighbors.row] * popularity[neighbors.col]
+                      + CONTENT_WEIGHT * neighbors.data)
+            np.maximum.at(scores, neighbors.col, values)
+            return scores
+        return (POPULARITY_WEIGHT * (weights @ history_popularity) * popularity
+                + CONTENT_WEIGHT * (neighbors.T @ weights))
+    
+    def score_user(self, user_id, top_n=10, method='weighted'):
+        """
+        Top-N рекомендаций пользователя без построения DataFrame.
+        
+        Returns:
+        (строки каталога, scores) — отсортированы по убыванию score;
+        пустые массивы, если у пользователя нет истории
+        """
+        history_rows = self.user_history_rows(user_id)
+        if len(history_rows) == 0:
+            return np.array([], dtype=int), np.array([])
+        
+        scores = np.array(self.aggregate_scores(history_rows, method), dtype=np.float64)
+        # Исключаем уже просмотренные
+        scores[history_rows] = -np.inf
+        rows = top_indices(scores, top_n)
+        return rows, scores[rows]
+    
+    def history_matrix(self, user_ids, method='weighted'):
+        """
+        Разреженная матрица весов истории B×N для блока пользователей.
+        
+        Веса в строке нормированы на 1: для 'weighted' растут линейно от 0.5
+        до 1.0 по порядку просмотров, для 'avg' одинаковые. Ненулевые элементы
+        строки — просмотренные статьи.
+        """
+        bounds = self.user_history_slices.bounds(user_ids)
+        lengths = bounds[:, 1] - bounds[:, 0]
+        offsets = np.repeat(bounds[:, 0] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        rows = self.history_rows[np.arange(lengths.sum()) + offsets]
+        users = np.repeat(np.arange(len(user_ids)), lengths)
+        users, rows = users[rows >= 0], rows[rows >= 0]
+        
+        counts = np.bincount(users, minlength=len(user_ids))
+        position = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        if method == 'weighted':
+            span = np.maximum(counts[users] - 1, 1)
+            weights = 0.5 + 0.5 * position / span
+        else:
+            weights = np.ones(len(rows))
+        weights = weights / np.bincount(users, weights=weights, minlength=len(user_ids))[users]
+        
+        return sparse.csr_matrix((weights, (users, rows)), shape=(len(user_ids), len(self.article_ids)))
+    
+    def recommend_batch(self, user_ids, top_n=10, method='weighted'):
+        """
+        Рекомендации для блока пользователей одним матричным произведением.
+        
+        Плотные scores считаются по частям не больше BLOCK_ELEMENTS / N строк,
+        поэтому память не растёт с размером блока B.
+        
+        Parameters:
+        user_ids: ehr_id пользователей блока
+        top_n: количество рекомендаций
+        method: 'weighted', 'avg' или 'max' (для 'max' — по одному пользователю)
+        
+        Returns:
+        (строки каталога B×top_n, scores B×top_n); для пользователей
+        без истории и при нехватке кандидатов — индекс -1
+        """
+        history = self.history_matrix(user_ids, method)
+        chunk_size = max(1, BLOCK_ELEMENTS // max(history.shape[1], 1))
+        
+        rows, scores = [], []
+        for start in range(0, history.shape[0], chunk_size):
+            block = history[start:start + chunk_size]
+            block_rows, block_scores = top_n_excluding(
+                self.batch_scores(block, user_ids[start:start + chunk_size], method), block, top_n)
+            rows.append(block_rows)
+            scores.append(block_scores)
+        if not rows:
+            return top_n_excluding(np.empty(history.shape), history, top_n)
+        return np.vstack(rows), np.vstack(scores)
+    
+    def batch_scores(self, history, user_ids, method='weighted'):
+        """
+        Плотная матрица scores B×N для части блока recommend_batch.
+        
+        Parameters:
+        history: строки history_matrix для user_ids
+        user_ids: ehr_id пользователей части блока
+        method: метод агрегации
+        
+        Returns:
+        np.ndarray B×N (float64); у пользователей без истории — -inf
+        """
+        if method == 'max':
+            scores = np.full(history.shape, -np.inf)
+            for i, user_id in enumerate(user_ids):
+                history_rows = self.user_history_rows(user_id)
+                if len(history_rows):
+                    scores[i] = self.aggregate_scores(history_rows, method)
+        elif self.n_neighbors is None:
+            scores = np.asarray(history @ self.final_similarity, dtype=np.float64)
+        else:
+            # Контентная часть и rank-1 добавка популярности складываются на месте
+            popularity = self.popularity_nonzero.astype(np.float64)
+            scores = np.asarray((history @ self.neighbors).toarray(), dtype=np.float64)
+            scores *= CONTENT_WEIGHT
+            rank_one = np.outer(history @ popularity, popularity)
+            rank_one *= POPULARITY_WEIGHT
+            scores += rank_one
+        
+        # Пользователи без истории — без рекомендаций
+        scores[np.diff(history.indptr) == 0] = -np.inf
+        return scores
+    
+    def recommend_for_user(self, user_id, top_n=10, method='weighted', verbose=True):
+        """
+        Рекомендации для пользователя на основе истории просмотров
+        
+        Parameters:
+        user_id: ID пользователя (ehr_id)
+        top_n: количество рекомендаций
+        method: метод агрегации ('weighted' - взвешенный, 'max' - максимум, 'avg' - среднее)
+        verbose: печатать ли информацию о пользователе
+        
+        Returns:
+        DataFrame с рекомендациями
+        """
+        # Получаем историю пользователя
+        history_rows = self.user_history_rows(user_id)
+        
+        if len(history_rows) == 0:
+            if verbose:
+                print(f"Пользователь {user_id} не найден или нет истории просмотров")
+            return self.get_popular_articles(top_n)
+        
+        if verbose:
+            print(f"Пользователь {user_id} просмотрел {len(history_rows)} статей")
+        
+        rows, scores = self.score_user(user_id, top_n, method)
+        
+        # Создаем DataFrame с рекомендациями
+        recommendations = self.articles.iloc[rows][
+            ['article_id', 'title', 'tags', 'rubric_title', 'views']
+        ].copy()
+        
+        # Добавляем scores
+        recommendations['recommendation_score'] = scores
+        
+        return recommendations
+    
+    def get_popular_articles(self, top_n=10):
+        """
+        Получение самых популярных статей (fallback для холодного старта)
+        
+        Parameters:
+        top_n: количество статей
+        
+        Returns:
+        DataFrame с популярными статьями
+        """
+        return self.articles.nlargest(top_n, 'views')[['article_id', 'title', 'tags', 'rubric_title', 'views']]
+    
+    def evaluate_diversity(self, recommendations):
+        """
+        Оценка разнообразия рекомендаций
+        
+        Parameters:
+        recommendations: DataFrame с рекомендациями
+        
+        Returns:
+        dict: метрики разнообразия
+        """
+        if len(recommendations) == 0:
+            return {}
+        
+        # Уникальные рубрики
+        unique_rubrics = recommendations['rubric_title'].nunique()
+        
+        # Среднее попарное косинусное расстояние по строкам TF-IDF
+        rows = self.article_index.get_indexer(recommendations['article_id'])
+        avg_distance = intra_list_diversity(rows[rows >= 0][None], self.tfidf_matrix)[0]
+        avg_distance = 0 if np.isnan(avg_distance) else avg_distance
+        
+        return {
+            'unique_rubrics': unique_rubrics,
+            'rubrics_ratio': unique_rubrics / len(recommendations),
+            'avg_content_distance': avg_distance
+        }
+
+    def evaluate_beyond_accuracy(self, rows):
+        """
+        Покрытие каталога, Gini, intra-list diversity по TF-IDF и новизна
+        (по популярности в истории) для выдачи всех пользователей сразу.
+
+        Parameters:
+        rows: выдача B × K строк каталога (-1 — пусто), например из recommend_batch
+
+        Returns:
+        dict (rec_sys_common.metrics.beyond_accuracy_metrics)
+        """
+        known = self.history_rows[self.history_rows >= 0]
+        return beyond_accuracy_metrics(rows, len(self.article_ids), self.tfidf_matrix,
+                                       np.bincount(known, minlength=len(self.article_ids)),
+                                       len(self.user_history_slices))
+
+    def save(self, root, name='tfidf', meta=None):
+        """
+        Публикует обученную систему в реестр артефактов (rec_sys_common/registry.py).
+
+        Сохраняются словарь и idf векторизатора, TF-IDF матрица, индекс
+        соседей (или плотная матрица схожести), каталог статей и истории
+        пользователей — все, что нужно для рекомендаций без исходного df.
+
+        Returns:
+        путь к опубликованной версии
+        """
+        terms = np.empty(len(self.vectorizer.vocabulary_), dtype=object)
+        for term, idx in self.vectorizer.vocabulary_.items():
+            terms[idx] = term
+
+        def write(directory):
+            registry.save_table(directory, 'vocabulary', pd.DataFrame({'term': terms}))
+            registry.save_array(directory, 'idf', self.vectorizer.idf_)
+            registry.save_csr(directory, 'tfidf', self.tfidf_matrix)
+            if self.n_neighbors is None:
+                registry.save_array(directory, 'final_similarity', self.final_similarity)
+            else:
+                registry.save_csr(directory, 'neighbors', self.neighbors)
+                registry.save_array(directory, 'popularity_nonzero', self.popularity_nonzero)
+            registry.save_table(directory, 'articles', self.articles)
+            registry.save_array(directory, 'history_rows', self.history_rows)
+            registry.save_array(directory, 'history_users', self.user_history_slices.user_ids)
+            registry.save_array(directory, 'history_indptr', self.user_history_slices.indptr)
+
+        meta = dict(meta or {}, n_neighbors=self.n_neighbors, chunk_size=self.chunk_size, ann=self.ann,
+                    views_min=self.views_min, added_since_fit=self.added_since_fit,
+                    n_articles=len(self.article_ids), n_users=len(self.user_history_slices))
+        return registry.publish(root, name, 'tfidf', write, meta)
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """
+        Система из реестра без переобучения: матрицы открываются через mmap,
+        поэтому загрузка занимает миллисекунды, а воркеры делят одни страницы.
+
+        Parameters:
+        path: папка версии, папка модели (берется LATEST) или корень реестра/имя
+        verify: проверить sha256 всех файлов
+        """
+        path, manifest = registry.open_artifact(path, 'tfidf', verify)
+        meta = manifest['meta']
+        self = cls.__new__(cls)
+        self.df = None
+        self.article_features = None
+        self.n_neighbors = meta['n_neighbors']
+        self.chunk_size = meta['chunk_size']
+        self.ann = meta.get('ann')
+
+        terms = registry.load_table(path, 'vocabulary')['term']
+        self.vectorizer = make_vectorizer()
+        self.vectorizer.vocabulary_ = dict(zip(terms, range(len(terms))))
+        self.vectorizer.idf_ = np.asarray(registry.load_array(path, 'idf'))
+        self.tfidf_matrix = registry.load_csr(path, 'tfidf')
+        if self.n_neighbors is None:
+            self.final_similarity = registry.load_array(path, 'final_similarity')
+        else:
+            self.neighbors = registry.load_csr(path, 'neighbors')
+            self.popularity_nonzero = registry.load_array(path, 'popularity_nonzero')
+
+        self.articles = registry.load_table(path, 'articles')
+        self.views_min = meta.get('views_min', float(self.articles['views'].fillna(0).min()))
+        self.added_since_fit = meta.get('added_since_fit', 0)
+        self.article_ids = self.articles['article_id'].to_numpy()
+        self.article_index = pd.Index(self.article_ids)
+        self.article_row = dict(zip(self.article_ids, range(len(self.article_ids))))
+        self.history_rows = registry.load_array(path, 'history_rows')
+        self.user_history_slices = HistorySlices(registry.load_array(path, 'history_users'),
+                                                 registry.load_array(path, 'history_indptr'))
+        return self
+
+
+def generate_recommendations_for_all(df, output_path="recommendations.parquet", top_n=10,
+                                     batch_size=1024, method='weighted', recommender=None):
+    """
+    Рекомендации для всех пользователей df блоками, с потоковой записью в parquet.
+    
+    Parameters:
+    df: DataFrame с кликами
+    output_path: куда писать parquet (ehr_id, article_id, title, rubric_title, recommendation_score)
+    top_n: количество рекомендаций на пользователя
+    batch_size: сколько пользователей скорить за одно матричное произведение
+    recommender: уже обученная ContentRecommenderSystem (иначе строится по df)
+    
+    Returns:
+    путь к записанному файлу
+    """
+    # Инициализируем систему
+    if recommender is None:
+        recommender = ContentRecommenderSystem(df)
+    
+    # Получаем список всех пользователей
+    users = df['ehr_id'].dropna().unique()
+    titles = recommender.articles['title'].to_numpy()
+    rubrics = recommender.articles['rubric_title'].to_numpy()
+    
+    with ParquetChunkWriter(output_path) as writer:
+        for start in range(0, len(users), batch_size):
+            block = users[start:start + batch_size]
+            rows, scores = recommender.recommend_batch(block, top_n, method)
+            ehr_ids, rows, _, scores = flatten_recommendations(block, rows, scores)
+            writer.write(pd.DataFrame({
+                'ehr_id': ehr_ids,
+                'article_id': recommender.article_ids[rows],
+                'title': titles[rows],
+                'rubric_title': rubrics[rows],
+                'recommendation_score': scores
+            }))
+    
+    print(f"Сохранено {writer.rows} рекомендаций для {len(users)} пользователей в файл {output_path}")
+    return output_path
+
+
+
+def publish_recommendation_snapshot(recommender, users, root="artifacts", top_n=10, batch_size=1024,
+                                    method='weighted', segment_tops=None, global_top=None, name="snapshot"):
+    """
+    Рекомендации для всех пользователей в снимок для сервинга
+    (rec_sys_common/snapshot.py) вместо плоского файла.
+
+    Parameters:
+    recommender: обученная ContentRecommenderSystem
+    users: ehr_id пользователей
+    root: корень реестра артефактов
+    segment_tops, global_top: топы из prepare_recommendation_systems — выдача
+                              для пользователей без истории
+
+    Returns:
+    путь к опубликованной версии
+    """
+    users = np.asarray(users)
+
+    def blocks():
+        for start in range(0, len(users), batch_size):
+            block = users[start:start + batch_size]
+            rows, scores = recommender.recommend_batch(block, top_n, method)
+            yield block, rows, scores
+
+    return save_snapshot(root, blocks(), len(users), top_n, recommender.article_ids,
+                         segment_tops, global_top, name=name, meta={'model': 'tfidf', 'method': method})
+
+# Пример использования
+def demo_recommendations(df):
+    """
+    Демонстрация работы рекомендательной системы
+    """
+    # Создаем систему рекомендаций
+    recommender = ContentRecommenderSystem(df)
+    
+    # Выбираем случайного пользователя с историей
+    users_with_history = df.groupby('ehr_id').size()
+    active_users = users_with_history[users_with_history >= 5].index.tolist()
+    
+    if active_users:
+        sample_user = np.random.choice(active_users)
+        
+        print(f"\n{'='*50}")
+        print(f"Рекомендации для пользователя {sample_user}")
+        print(f"{'='*50}\n")
+        
+        # История пользователя
+        user_history = recommender.get_user_history(sample_user)
+        history_df = df[df['ehr_id'] == sample_user][['article_id', 'title']].drop_duplicates()
+        
+        print("История просмотров пользователя:")
+        for _, row in history_df.head(5).iterrows():
+            print(f"- {row['title'][:80]}...")
+        
+        # Получаем рекомендации
+        recommendations = recommender.recommend_for_user(sample_user, top_n=10)
+        
+        print(f"\n{'='*50}")
+        print("Топ-10 рекомендаций:")
+        print(f"{'='*50}\n")
+        
+        for i, row in recommendations.iterrows():
+            print(f"{len(recommendations) - recommendations.index.get_loc(i)}. {row['title'][:70]}...")
+            print(f"   Рубрика: {row['rubric_title']}, Score: {row['recommendation_score']:.3f}")
+            print()
+        
+        # Оценка разнообразия
+        diversity = recommender.evaluate_diversity(recommendations)
+        print(f"\n{'='*50}")
+        print("Метрики разнообразия рекомендаций:")
+        print(f"{'='*50}")
+        print(f"Уникальных рубрик: {diversity['unique_rubrics']}")
+        print(f"Доля уникальных рубрик: {diversity['rubrics_ratio']:.2%}")
+        print(f"Среднее расстояние между рекомендациями: {diversity['avg_content_distance']:.3f}")
+    
+    return recommender
+
+
+# Если у вас уже есть загруженный DataFrame df, используйте:
+# recommender = ContentRecommenderSystem(df)
+# recommendations = recommender.recommend_for_user(user_id=1169819, top_n=10)
+# print(recommendations)
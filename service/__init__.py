@@ -0,0 +1,7 @@
+"""
+Онлайн-сервис рекомендаций: загружает обученные артефакты один раз
+и отдает GET /recommend?ehr_id=&gender=&age=&n= по HTTP (asyncio).
+
+Запуск из корня репозитория:
+    python -m service.server --artifacts artifacts --port 8080
+"""
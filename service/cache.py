@@ -0,0 +1,43 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    LRU-кеш с ограничением времени жизни записей.
+
+    При переполнении вытесняется давно не использованная запись,
+    записи старше ttl секунд считаются отсутствующими.
+    """
+
+    def __init__(self, maxsize: int = 100_000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,294 @@
+import json
+import pickle
+import sys
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_als.als_batch import fold_in_factors
+from rec_sys_common.batch import top_n_excluding
+from rec_sys_common import registry
+from rec_sys_common.segments import SegmentTops, age_group
+from rec_sys_common.snapshot import SnapshotWatcher
+from rec_sys_common.streaming import PopularityStream
+
+# ALS-рекомендации — только при истории больше MIN_HISTORY кликов
+# (как в recommend_articles), иначе топ сегмента
+MIN_HISTORY = 5
+
+MAX_N = 100
+
+# Сколько пользователей со свежими кликами держать в памяти (LRU)
+MAX_FRESH_USERS = 100_000
+
+
+def _json_or_none(value):
+    return None if pd.isna(value) else value
+
+
+class OnlineRecommender:
+    """
+    Рекомендации для онлайн-сервиса: готовая выдача из ночного снимка,
+    ALS для пользователей с историей, иначе топ сегмента (пол, возрастная
+    группа), иначе топ пола, иначе общий топ.
+
+    Все артефакты загружаются один раз. Для каждой статьи заранее собран
+    JSON-фрагмент {"article_id", "title", "url"}, поэтому ответ — это
+    склейка готовых строк без pandas на запрос. Топы сегментов — плотная
+    таблица строк каталога (rec_sys_common/segments.py): выбор топа — одно
+    индексирование.
+
+    Свежие клики (add_clicks) сразу пересчитывают факторы пользователя
+    fold-in по факторам статей ALS, поэтому новый пользователь получает
+    персональную выдачу без переобучения модели. Такие пользователи живут
+    в памяти процесса до перезагрузки модели; их не больше max_fresh —
+    давно не обновлявшиеся и не запрашивавшие вытесняются и снова получают
+    выдачу ночной модели.
+
+    С popularity (rec_sys_common/streaming.py) топы сегмента и общий
+    берутся из затухающих потоковых счетчиков, а при нехватке статей
+    дополняются топами из артефактов.
+
+    Снимок (rec_sys_common/snapshot.py) читается через mmap; reload_snapshot()
+    подхватывает новую версию из snapshot/LATEST без перезапуска. Пользователи
+    со свежими кликами обходят снимок и получают ALS.
+
+    Структура папки с артефактами:
+        recommendations_segment.pkl        — save_recommendations (top/random_vs_top.py)
+        recommendations_global.pkl
+        segment_tops/                      — SegmentTops.save (DAG build_top), необязательна:
+                                             с ней короткие сегменты добираются топом пола
+        recommendations_articles_info.csv  — article_id, title, url
+        als/                               — save_als_artifacts (rec_sys_als/als_batch.py),
+                                             необязательна; берется версия из als/LATEST
+        snapshot/                          — publish_als_snapshot / publish_recommendation_snapshot,
+                                             необязательна; берется версия из snapshot/LATEST
+    """
+
+    def __init__(self, artifacts_dir, prefix: str = "recommendations", popularity: PopularityStream = None,
+                 max_fresh: int = MAX_FRESH_USERS):
+        artifacts_dir = Path(artifacts_dir)
+        self.popularity = popularity
+        self.max_fresh = max_fresh
+
+        with open(artifacts_dir / f"{prefix}_segment.pkl", "rb") as f:
+            segment_tops = pickle.load(f)
+        with open(artifacts_dir / f"{prefix}_global.pkl", "rb") as f:
+            global_top = pickle.load(f)
+        articles_info = (
+            pd.read_csv(artifacts_dir / f"{prefix}_articles_info.csv")
+            .drop_duplicates("article_id")
+            .reset_index(drop=True)
+        )
+
+        # Каталог статей: строка -> готовый JSON-фрагмент
+        self.article_ids = articles_info["article_id"].to_numpy()
+        self.article_row = {int(a): i for i, a in enumerate(self.article_ids)}
+        self.catalog_index = pd.Index(self.article_ids)
+        self.item_json = np.array([
+            json.dumps({"article_id": int(a), "title": _json_or_none(t), "url": _json_or_none(u)},
+                       ensure_ascii=False)
+            for a, t, u in zip(articles_info["article_id"], articles_info["title"], articles_info["url"])
+        ], dtype=object)
+
+        if (artifacts_dir / "segment_tops").exists():
+            self.segments = SegmentTops.load(artifacts_dir / "segment_tops")
+        else:
+            self.segments = SegmentTops.from_dict(segment_tops, global_top, k=MAX_N)
+        # Таблица топов в строках каталога (-1 из items попадает на дописанный -1);
+        # статьи без метаданных сдвигаются в хвост ячейки
+        rows = np.append(self.catalog_index.get_indexer(self.segments.article_ids), -1)[self.segments.items]
+        self.segment_table = np.take_along_axis(rows, np.argsort(rows < 0, axis=2, kind="stable"), axis=2)
+        self.global_rows = self.catalog_rows(global_top)
+
+        self.snapshot = None
+        self.snapshot_rows = None
+        if (artifacts_dir / "snapshot").exists():
+            self.snapshot = SnapshotWatcher(artifacts_dir / "snapshot")
+
+        # Пользователи со свежими кликами: ehr_id -> факторы и клики (с ALS), номер обновления (LRU)
+        self.fresh = OrderedDict()
+        # Сквозной счетчик обновлений: номер версии не повторяется и после вытеснения пользователя
+        self.fresh_updates = 0
+
+        self.als = None
+        als_dir = artifacts_dir / "als"
+        if als_dir.exists():
+            self.load_als(als_dir)
+
+    def catalog_rows(self, article_ids) -> np.ndarray:
+        """article_id -> строки каталога; статьи без метаданных пропускаются"""
+        rows = [self.article_row.get(int(a), -1) for a in article_ids]
+        return np.array([r for r in rows if r >= 0], dtype=np.int64)
+
+    def reload_snapshot(self) -> bool:
+        """Переход на новую версию снимка, если она вышла; True — снимок сменился"""
+        return self.snapshot is not None and self.snapshot.refresh()
+
+    def recommend_snapshot(self, ehr_id: int, n: int):
+        """Строки каталога из снимка или None, если пользователя в нем нет"""
+        snapshot = self.snapshot.current
+        found = snapshot.user(ehr_id, n)
+        if found is None:
+            return None
+        # Номер статьи снимка -> строка каталога; считается один раз на версию
+        if self.snapshot_rows is None or self.snapshot_rows[0] != snapshot.version:
+            self.snapshot_rows = (snapshot.version, self.catalog_index.get_indexer(snapshot.article_ids))
+        rows = self.snapshot_rows[1][found[0]]
+        return rows[rows >= 0]
+
+    def load_als(self, als_dir: Path):
+        # Факторы и взаимодействия — memmap: воркеры сервиса делят одни страницы
+        artifact = registry.load_als(als_dir)
+        user_ids, item_ids = artifact["user_ids"], artifact["item_ids"]
+        interactions = artifact["interactions"]
+        meta = artifact["manifest"]["meta"]
+        self.als = {
+            "user_factors": artifact["user_factors"],
+            "item_factors": artifact["item_factors"],
+            "version": artifact["manifest"]["version"],
+            "user_row": {int(u): i for i, u in enumerate(user_ids.tolist())},
+            "item_col": {int(a): j for j, a in enumerate(item_ids.tolist())},
+            "regularization": meta.get("regularization") or 0.01,
+            "alpha": meta.get("alpha") or 1.0,
+            "interactions": interactions,
+            "history": np.asarray(interactions.sum(axis=1)).ravel(),
+            # Столбец ALS -> строка каталога (-1, если метаданных нет)
+            "catalog_rows": np.array([self.article_row.get(int(a), -1) for a in item_ids], dtype=np.int64),
+        }
+        self.als["no_metadata"] = np.flatnonzero(self.als["catalog_rows"] < 0)
+
+    def add_clicks(self, ehr_id: int, article_ids, gender: int = None, age: int = None) -> float:
+        """
+        Свежие клики пользователя: клики добавляются к его истории, а факторы
+        пересчитываются одним шагом ALS при фиксированных факторах статей.
+        Статьи, которых нет в модели, не учитываются. Если включены потоковые
+        топы, клики учитываются и в них (в сегменте — при известных поле и возрасте).
+
+        Returns:
+        размер истории пользователя с учетом новых кликов
+        """
+        if self.popularity is not None:
+            self.popularity.add_many({"article_id": a, "gender": gender, "age": age} for a in article_ids)
+        if self.als is None:
+            # Без ALS выдача пользователя не персональная, но версия его ответа все равно меняется
+            self.remember_fresh(ehr_id, {})
+            return 0.0
+        cols = [self.als["item_col"].get(int(a), -1) for a in article_ids]
+        cols = np.array([c for c in cols if c >= 0], dtype=np.int32)
+
+        user = self.fresh.get(ehr_id)
+        if user is not None:
+            indices, data = user["indices"], user["data"]
+        else:
+            interactions = self.als["interactions"]
+            row = self.als["user_row"].get(ehr_id)
+            start, end = (interactions.indptr[row], interactions.indptr[row + 1]) if row is not None else (0, 0)
+            indices, data = interactions.indices[start:end], interactions.data[start:end]
+
+        n_items = len(self.als["catalog_rows"])
+        clicks = sparse.csr_matrix(
+            (np.concatenate([data, np.ones(len(cols))]), np.concatenate([indices, cols]), [0, len(data) + len(cols)]),
+            shape=(1, n_items),
+        )
+        clicks.sum_duplicates()
+        history = float(clicks.data.sum())
+        self.remember_fresh(ehr_id, {
+            "factors": fold_in_factors(self.als["item_factors"], clicks,
+                                       self.als["regularization"], self.als["alpha"])[0],
+            "indices": clicks.indices,
+            "data": clicks.data,
+            "history": history,
+        })
+        return history
+
+    def remember_fresh(self, ehr_id: int, user: dict):
+        """Запись пользователя со свежими кликами под новым номером обновления; LRU не больше max_fresh"""
+        self.fresh_updates += 1
+        user["updates"] = self.fresh_updates
+        self.fresh[ehr_id] = user
+        self.fresh.move_to_end(ehr_id)
+        while len(self.fresh) > self.max_fresh:
+            self.fresh.popitem(last=False)
+
+    def user_version(self, ehr_id) -> int:
+        """Номер последнего обновления пользователя через add_clicks (0 — нет) — часть ключа кеша ответов"""
+        user = self.fresh.get(ehr_id)
+        return user["updates"] if user is not None else 0
+
+    def stream_version(self, gender=None, age=None):
+        """
+        Версия потоковых топов для ответа по (gender, age) или None без
+        потоковых топов — ответы по топам сверяются с ней в кеше
+        """
+        return self.popularity.version(gender, age) if self.popularity is not None else None
+
+    def recommend_als(self, ehr_id: int, n: int):
+        """Строки каталога по ALS или None, если пользователь не подходит"""
+        if self.als is None:
+            return None
+        user = self.fresh.get(ehr_id)
+        if user is not None:
+            self.fresh.move_to_end(ehr_id)
+            factors, seen, history = user["factors"], user["indices"], user["history"]
+        else:
+            row = self.als["user_row"].get(ehr_id)
+            if row is None:
+                return None
+            interactions = self.als["interactions"]
+            factors, history = self.als["user_factors"][row], self.als["history"][row]
+            seen = interactions.indices[interactions.indptr[row]:interactions.indptr[row + 1]]
+        if history <= MIN_HISTORY:
+            return None
+        scores = (self.als["item_factors"] @ factors).astype(np.float64)[None, :]
+        # Просмотренные и статьи без метаданных не отдаем
+        scores[0, seen] = -np.inf
+        scores[0, self.als["no_metadata"]] = -np.inf
+        top, _ = top_n_excluding(scores, None, n)
+        top = top[0][top[0] >= 0]
+        return self.als["catalog_rows"][top]
+
+    def recommend(self, ehr_id=None, gender=None, age=None, n: int = 10):
+        """
+        Returns:
+        (источник: 'snapshot' / 'als' / 'segment' / 'gender' / 'global', строки каталога)
+        """
+        n = max(0, min(n, MAX_N))
+        if ehr_id is not None:
+            fresh = self.als is not None and ehr_id in self.fresh
+            if self.snapshot is not None and not fresh:
+                rows = self.recommend_snapshot(ehr_id, n)
+                if rows is not None and len(rows):
+                    return "snapshot", rows
+            rows = self.recommend_als(ehr_id, n)
+            if rows is not None:
+                return "als", rows
+        if gender is not None:
+            cell = self.segments.cell(gender, age)
+            source = self.segments.source(cell)
+            rows = self.segment_table[cell]
+            rows = rows[rows >= 0]
+            key = (gender, age_group(age)) if age is not None else None
+            if self.popularity is not None and key in self.popularity.segments:
+                source, rows = "segment", self.live_rows(self.popularity.segments[key], rows, n)
+            if source != "global" and len(rows):
+                return source, rows[:n]
+        if self.popularity is not None and len(self.popularity.global_top):
+            return "global", self.live_rows(self.popularity.global_top, self.global_rows, n)
+        return "global", self.global_rows[:n]
+
+    def live_rows(self, counter, fallback, n: int) -> np.ndarray:
+        """Строки каталога потокового топа, дополненные fallback (топом из артефактов) до n"""
+        live = self.catalog_rows([a for a, _ in counter.top_k(n)])
+        if fallback is None or len(live) >= n:
+            return live[:n]
+        return np.concatenate([live, fallback[~np.isin(fallback, live)]])[:n]
+
+    def render(self, ehr_id, source: str, rows: np.ndarray) -> bytes:
+        """JSON-ответ из заранее подготовленных фрагментов"""
+        head = json.dumps({"ehr_id": ehr_id, "source": source})[:-1]
+        return f'{head}, "items": [{", ".join(self.item_json[rows])}]}}'.encode("utf-8")
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.segments import age_group
+from rec_sys_common.streaming import JsonlTail, PopularityStream
+from service.cache import TTLCache
+from service.recommender import MAX_FRESH_USERS, OnlineRecommender
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+MAX_HEADER_BYTES = 16 * 1024
+# Источники ответа, которые меняются вместе с потоковыми топами
+STREAM_SOURCES = ("segment", "gender", "global")
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _int_param(params: dict, name: str, default=None):
+    values = params.get(name)
+    if not values or values[0] == "":
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise BadRequest(f"параметр {name} должен быть целым числом")
+
+
+class RecommendationService:
+    """
+    HTTP/1.1 поверх asyncio.start_server без сторонних фреймворков.
+
+    GET /recommend?ehr_id=&gender=&age=&n= — рекомендации (JSON),
+    GET /health — состояние сервиса и статистика кеша,
+    POST /clicks {"ehr_id", "article_ids", "gender"?, "age"?} — свежие клики
+    (fold-in в ALS и, если включены, потоковые топы).
+    Готовые ответы кешируются по (ehr_id, версия пользователя, gender,
+    возрастная группа, n): после новых кликов старый ответ не отдается.
+    Ответ по потоковым топам (segment / gender / global) хранится вместе
+    с версией этих топов и отдается из кеша, только пока она не сменилась.
+    """
+
+    def __init__(self, recommender: OnlineRecommender, cache: TTLCache):
+        self.recommender = recommender
+        self.cache = cache
+        self.requests = 0
+        self.started_at = time.time()
+
+    def recommend(self, params: dict) -> bytes:
+        ehr_id = _int_param(params, "ehr_id")
+        gender = _int_param(params, "gender")
+        age = _int_param(params, "age")
+        n = _int_param(params, "n", 10)
+        if n <= 0:
+            raise BadRequest("n должно быть положительным")
+
+        key = (ehr_id, self.recommender.user_version(ehr_id), gender, None if age is None else age_group(age), n)
+        stream = self.recommender.stream_version(gender, age)
+        cached = self.cache.get(key)
+        if cached is not None and (cached[0] is None or cached[0] == stream):
+            return cached[1]
+        source, rows = self.recommender.recommend(ehr_id, gender, age, n)
+        body = self.recommender.render(ehr_id, source, rows)
+        self.cache.put(key, (stream if source in STREAM_SOURCES else None, body))
+        return body
+
+    def clicks(self, body: bytes) -> bytes:
+        try:
+            payload = json.loads(body or b"{}")
+            ehr_id = int(payload["ehr_id"])
+            article_ids = [int(a) for a in payload.get("article_ids", [])]
+            gender, age = (None if payload.get(k) is None else int(payload[k]) for k in ("gender", "age"))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise BadRequest("ожидается JSON {\"ehr_id\": int, \"article_ids\": [int, ...]}")
+        history = self.recommender.add_clicks(ehr_id, article_ids, gender, age)
+        return json.dumps({"ehr_id": ehr_id, "history": history}).encode("utf-8")
+
+    def health(self) -> bytes:
+        return json.dumps({
+            "status": "ok",
+            "als": self.recommender.als["version"] if self.recommender.als is not None else None,
+            "snapshot": self.recommender.snapshot.current.version if self.recommender.snapshot is not None else None,
+            "requests": self.requests,
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "cache": {"size": len(self.cache), "hits": self.cache.hits, "misses": self.cache.misses},
+            "stream_events": self.recommender.popularity.events if self.recommender.popularity is not None else None,
+        }).encode("utf-8")
+
+    def route(self, method: str, target: str, body: bytes = b""):
+        url = urlsplit(target)
+        if (method, url.path) == ("POST", "/clicks"):
+            try:
+                return 200, self.clicks(body)
+            except BadRequest as e:
+                return 400, json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8")
+        if method != "GET":
+            return 405, json.dumps({"error": "только GET"}).encode("utf-8")
+        try:
+            if url.path == "/recommend":
+                return 200, self.recommend(parse_qs(url.query))
+            if url.path == "/health":
+                return 200, self.health()
+        except BadRequest as e:
+            return 400, json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8")
+        return 404, json.dumps({"error": "not found"}).encode("utf-8")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+                                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # Тело вычитывается всегда, даже если маршруту не нужно, — для keep-alive
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                try:
+                    payload = await reader.readexactly(length) if length else b""
+                except asyncio.IncompleteReadError:
+                    # Тело короче Content-Length: клиент закрыл запись, не дослав его
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                except ConnectionError:
+                    break
+
+                self.requests += 1
+                status, body = self.route(method, target, payload)
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def follow(self, tail: JsonlTail, interval: float = 1.0):
+        """Фоновое чтение потока кликов в потоковые топы рекомендателя"""
+        while True:
+            events = tail.poll()
+            if events:
+                self.recommender.popularity.add_many(events)
+            await asyncio.sleep(interval)
+
+    async def watch_snapshot(self, interval: float = 60.0):
+        """Фоновая проверка новой версии снимка; после подмены кеш ответов сбрасывается"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.recommender.reload_snapshot():
+                self.cache.clear()
+                print(f"Снимок рекомендаций обновлен: {self.recommender.snapshot.current.version}")
+
+    async def serve(self, host: str = "0.0.0.0", port: int = 8080, reuse_port: bool = False,
+                    stream: JsonlTail = None, snapshot_interval: float = 60.0):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES,
+                                            reuse_port=reuse_port or None)
+        print(f"Сервис рекомендаций слушает {host}:{port}")
+        background = []
+        if stream is not None:
+            background.append(asyncio.create_task(self.follow(stream)))
+        if self.recommender.snapshot is not None:
+            background.append(asyncio.create_task(self.watch_snapshot(snapshot_interval)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in background:
+                task.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Онлайн-сервис рекомендаций")
+    parser.add_argument("--artifacts", default="artifacts", help="папка с артефактами моделей")
+    parser.add_argument("--prefix", default="recommendations", help="префикс файлов save_recommendations")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-size", type=int, default=100_000)
+    parser.add_argument("--cache-ttl", type=float, default=300.0, help="время жизни ответа в кеше, с")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="SO_REUSEPORT: несколько процессов на одном порту")
+    parser.add_argument("--stream", default=None,
+                        help="JSONL с кликами для потоковых топов (читается с начала и далее по мере дописывания)")
+    parser.add_argument("--half-life", type=float, default=24.0,
+                        help="период полураспада веса клика в потоковых топах, часы")
+    parser.add_argument("--max-fresh-users", type=int, default=MAX_FRESH_USERS,
+                        help="сколько пользователей со свежими кликами держать в памяти (LRU)")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0,
+                        help="как часто проверять новую версию снимка рекомендаций, с")
+    args = parser.parse_args(argv)
+
+    popularity = tail = None
+    if args.stream:
+        popularity = PopularityStream(k=100, half_life=args.half_life * 3600)
+        tail = JsonlTail(args.stream)
+
+    service = RecommendationService(
+        OnlineRecommender(args.artifacts, args.prefix, popularity, args.max_fresh_users),
+        TTLCache(args.cache_size, args.cache_ttl),
+    )
+    asyncio.run(service.serve(args.host, args.port, args.reuse_port, tail, args.snapshot_interval))
+
+
+if __name__ == "__main__":
+    main()
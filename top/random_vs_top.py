@@ -1,21 +1,25 @@
 import numpy as np
 import pandas as pd
 from typing import Dict, List, Tuple
+import os
+import sys
 import random
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from scipy import sparse
+from scipy.special import gammaln
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from rec_sys_common.metrics import catalog_coverage, gini_index, novelty, recommendation_counts
+from rec_sys_common.segments import SegmentTops, age_groups
 
-def age_group(age):
-    """Преобразование возраста в группу"""
-    if age < 18:
-        return 0  # '0-17'
-    elif age < 30:
-        return 1  # '18-29'
-    elif age < 45:
-        return 2  # '30-44'
-    elif age < 60:
-        return 3  # '45-59'
-    else:
-        return 4  # '60+'
+
+def _with_age_group(clicked_df: pd.DataFrame) -> pd.DataFrame:
+    """Клики с колонкой age_group: если ее нет, группа считается по age"""
+    if 'age_group' in clicked_df:
+        return clicked_df
+    return clicked_df.assign(age_group=age_groups(clicked_df['age']))
 
 
 def prepare_recommendation_systems(clicked_df: pd.DataFrame, n_top: int = 10) -> Dict:
@@ -25,46 +29,200 @@ def prepare_recommendation_systems(clicked_df: pd.DataFrame, n_top: int = 10) ->
     2. Общий топ для всех
     3. Рандом (для сравнения)
     
+    Parameters:
+        clicked_df: клики с gender и age_group (или age — группа считается здесь)
+    
     Returns:
-        Dict с топами для каждой системы
+        Dict с топами для каждой системы; segment_table — те же топы
+        плотной таблицей SegmentTops с добором топом пола и общим
     """
+    clicked_df = _with_age_group(clicked_df)
     
-    # 1. СЕГМЕНТНЫЕ ТОПЫ (по полу и возрасту)
+    # 1. СЕГМЕНТНЫЕ ТОПЫ (по полу и возрасту); клики без пола или возраста — только в общий топ
     grouped = (
-        clicked_df.groupby(['gender', 'age_group', 'article_id'])
+        clicked_df.groupby(['gender', 'age_group', 'article_id'], dropna=False)
         .size()
         .reset_index(name='clicks')
     )
-    
-    top_articles_by_segment = (
-        grouped
-        .sort_values(['gender', 'age_group', 'clicks'], ascending=[True, True, False])
-        .groupby(['gender', 'age_group'])['article_id']
-        .apply(lambda x: x.head(n_top).tolist())
-        .to_dict()
-    )
+    segment_table = SegmentTops.from_counts(grouped, k=n_top)
     
     # 2. ОБЩИЙ ТОП (без сегментации)
-    global_top = (
-        clicked_df.groupby('article_id')
-        .size()
-        .reset_index(name='clicks')
-        .sort_values('clicks', ascending=False)
-        .head(n_top)['article_id']
-        .tolist()
-    )
+    global_top = segment_table.global_top().tolist()
     
     # 3. Информация о статьях
     articles_info = clicked_df[['article_id', 'title', 'url']].drop_duplicates()
     
     return {
-        'segment_tops': top_articles_by_segment,
+        'segment_tops': segment_table.to_dict(),
+        'segment_table': segment_table,
         'global_top': global_top,
         'articles_info': articles_info,
+        'article_table': articles_info.drop_duplicates('article_id').set_index('article_id')[['title', 'url']],
         'all_articles': list(clicked_df['article_id'].unique())
     }
 
 
+def build_interaction_matrix(clicked_df: pd.DataFrame,
+                             articles: List = None) -> Dict:
+    """
+    Бинарная CSR-матрица пользователь × статья, строится один раз на весь лог кликов.
+
+    Строки матрицы — уникальные ehr_id, столбцы — статьи каталога
+    (articles) плюс статьи из кликов, которых нет в каталоге.
+
+    Returns:
+        Dict с матрицей, индексами пользователей/статей, маской каталога
+        и таблицей оцениваемых пользователей (ehr_id, gender, age_group)
+    """
+    clicked_df = _with_age_group(clicked_df)
+    user_codes, user_ids = pd.factorize(clicked_df['ehr_id'])
+
+    if articles is None:
+        articles = clicked_df['article_id'].unique()
+    article_index = pd.Index(pd.unique(np.asarray(articles)))
+    n_catalog = len(article_index)
+    extra = pd.Index(clicked_df['article_id'].unique()).difference(article_index)
+    article_index = article_index.append(extra)
+
+    article_codes = article_index.get_indexer(clicked_df['article_id'])
+    matrix = sparse.coo_matrix(
+        (np.ones(len(user_codes), dtype=np.float64), (user_codes, article_codes)),
+        shape=(len(user_ids), len(article_index))
+    ).tocsr()
+    matrix.data[:] = 1  # повторные клики по статье считаем одним
+
+    in_catalog = np.zeros(len(article_index), dtype=np.float64)
+    in_catalog[:n_catalog] = 1
+
+    # Пользователь оценивается столько раз, сколько у него пар (gender, age_group)
+    users = clicked_df[['ehr_id', 'gender', 'age_group']].drop_duplicates().reset_index(drop=True)
+    user_rows = pd.Index(user_ids).get_indexer(users['ehr_id'])
+
+    return {
+        'matrix': matrix,
+        'article_index': article_index,
+        'in_catalog': in_catalog,
+        'n_catalog': n_catalog,
+        'users': users,
+        'user_rows': user_rows
+    }
+
+
+def _top_lists_matrix(top_lists: List[List], article_index: pd.Index, k: int) -> sparse.csr_matrix:
+    """Бинарная матрица список × статья для первых k элементов каждого топа"""
+    rows, cols = [], []
+    for i, articles_list in enumerate(top_lists):
+        codes = article_index.get_indexer(list(articles_list[:k]))
+        codes = codes[codes >= 0]
+        rows.append(np.full(len(codes), i))
+        cols.append(codes)
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+
+    matrix = sparse.coo_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+        shape=(len(top_lists), len(article_index))
+    ).tocsr()
+    matrix.data[:] = 1
+    return matrix
+
+
+def _top_lists_rows(top_lists: List[List], article_index: pd.Index, k: int) -> np.ndarray:
+    """Первые k элементов каждого топа как матрица список × k строк каталога (-1 — пусто)"""
+    rows = np.full((len(top_lists), k), -1, dtype=np.int64)
+    for i, articles_list in enumerate(top_lists):
+        codes = article_index.get_indexer(list(articles_list[:k]))
+        codes = codes[codes >= 0]
+        rows[i, :len(codes)] = codes
+    return rows
+
+
+def _random_hit_probability(n_relevant: np.ndarray, n_catalog: int, n_draws: int) -> np.ndarray:
+    """
+    Вероятность хотя бы одного попадания при выборке n_draws статей без возвращения
+    из каталога размера n_catalog, где n_relevant статей кликнуты (гипергеометрическое
+    распределение): 1 - C(N - m, n) / C(N, n)
+    """
+    n_relevant = np.asarray(n_relevant, dtype=np.float64)
+    n_miss = n_catalog - n_relevant
+    with np.errstate(invalid='ignore'):
+        log_p_miss = (gammaln(n_miss + 1) - gammaln(n_miss - n_draws + 1)
+                      - gammaln(n_catalog + 1) + gammaln(n_catalog - n_draws + 1))
+    p_miss = np.where(n_miss >= n_draws, np.exp(log_p_miss), 0.0)
+    return 1.0 - p_miss
+
+
+def compute_user_metrics(clicked_df: pd.DataFrame,
+                         recommendation_systems: Dict,
+                         n_recommendations: int = 10,
+                         interactions: Dict = None) -> Dict:
+    """
+    Поюзерные метрики всех трех методов, считаются разреженными произведениями.
+
+    Для рандома вместо симуляций используется матожидание гипергеометрического
+    распределения (то, к чему сходится среднее по random.sample).
+
+    Returns:
+        Dict по методам: массивы 'matches' (кликов в топе), 'n_recs' (длина списка)
+        и 'hit' (1/0 для топов, вероятность попадания для рандома), выровненные
+        по строкам interactions['users']
+    """
+    clicked_df = _with_age_group(clicked_df)
+    if interactions is None:
+        interactions = build_interaction_matrix(clicked_df, recommendation_systems['all_articles'])
+
+    matrix = interactions['matrix']
+    article_index = interactions['article_index']
+    users = interactions['users']
+    user_rows = interactions['user_rows']
+
+    # 1. Сегментные топы: последний (пустой) список — для пользователей без сегмента
+    segment_tops = recommendation_systems['segment_tops']
+    segment_keys = list(segment_tops.keys())
+    segment_lists = [segment_tops[key] for key in segment_keys] + [[]]
+    if segment_keys:
+        segment_rows = pd.MultiIndex.from_tuples(segment_keys).get_indexer(
+            pd.MultiIndex.from_frame(users[['gender', 'age_group']])
+        )
+        segment_rows[segment_rows < 0] = len(segment_keys)
+    else:
+        segment_rows = np.zeros(len(users), dtype=int)
+
+    segment_matrix = _top_lists_matrix(segment_lists, article_index, n_recommendations)
+    segment_hits = (matrix @ segment_matrix.T).tocsr()
+    segment_matches = np.asarray(segment_hits[user_rows, segment_rows]).ravel()
+    segment_sizes = np.array([len(lst[:n_recommendations]) for lst in segment_lists])[segment_rows]
+
+    # 2. Общий топ
+    global_top = recommendation_systems['global_top'][:n_recommendations]
+    global_matrix = _top_lists_matrix([global_top], article_index, n_recommendations)
+    global_matches = np.asarray((matrix @ global_matrix.T).todense()).ravel()[user_rows]
+
+    # 3. Рандом: m кликнутых статей каталога, выборка n из N
+    n_catalog = interactions['n_catalog']
+    n_draws = min(n_recommendations, n_catalog)
+    n_relevant = (matrix @ interactions['in_catalog'])[user_rows]
+    random_matches = n_relevant * n_draws / n_catalog if n_catalog else np.zeros(len(users))
+
+    return {
+        'segment': {
+            'matches': segment_matches,
+            'n_recs': segment_sizes,
+            'hit': (segment_matches > 0).astype(float)
+        },
+        'global': {
+            'matches': global_matches,
+            'n_recs': np.full(len(users), len(global_top)),
+            'hit': (global_matches > 0).astype(float)
+        },
+        'random': {
+            'matches': random_matches,
+            'n_recs': np.full(len(users), n_draws),
+            'hit': _random_hit_probability(n_relevant, n_catalog, n_draws)
+        }
+    }
+
+
 def evaluate_all_methods(clicked_df: pd.DataFrame, 
                         recommendation_systems: Dict,
                         n_recommendations: int = 10,
@@ -74,102 +232,35 @@ def evaluate_all_methods(clicked_df: pd.DataFrame,
     1. Сегментные топы
     2. Общий топ
     3. Рандом
+
+    n_random_iterations оставлен для совместимости: рандом считается
+    через матожидание, а не симуляцией.
     """
-    
-    segment_tops = recommendation_systems['segment_tops']
-    global_top = recommendation_systems['global_top'][:n_recommendations]
-    all_articles = recommendation_systems['all_articles']
-    
-    # Инициализация метрик
-    metrics = {
-        'segment': {'hits': 0, 'total_clicks': [], 'precisions': []},
-        'global': {'hits': 0, 'total_clicks': [], 'precisions': []},
-        'random': {'hits': [], 'total_clicks': [], 'precisions': []}
-    }
-    
-    # Уникальные пользователи
-    users = clicked_df[['ehr_id', 'gender', 'age_group']].drop_duplicates()
-    total_users = len(users)
+    clicked_df = _with_age_group(clicked_df)
+    interactions = build_interaction_matrix(clicked_df, recommendation_systems['all_articles'])
+    total_users = len(interactions['users'])
     
     print(f"Оцениваем {total_users} пользователей по трем методам...")
     
-    for _, user_row in users.iterrows():
-        user_id = user_row['ehr_id']
-        gender = user_row['gender']
-        age_grp = user_row['age_group']
-        
-        # Статьи, которые кликнул пользователь
-        user_clicks = set(clicked_df[clicked_df['ehr_id'] == user_id]['article_id'].unique())
-        n_user_clicks = len(user_clicks)
-        
-        # 1. СЕГМЕНТНЫЕ РЕКОМЕНДАЦИИ
-        segment_recs = segment_tops.get((gender, age_grp), [])[:n_recommendations]
-        segment_recs_set = set(segment_recs)
-        segment_matches = user_clicks & segment_recs_set
-        
-        if segment_matches:
-            metrics['segment']['hits'] += 1
-        metrics['segment']['total_clicks'].append(len(segment_matches))
-        if len(segment_recs) > 0:
-            metrics['segment']['precisions'].append(len(segment_matches) / len(segment_recs))
-        
-        # 2. ОБЩИЙ ТОП
-        global_recs_set = set(global_top)
-        global_matches = user_clicks & global_recs_set
-        
-        if global_matches:
-            metrics['global']['hits'] += 1
-        metrics['global']['total_clicks'].append(len(global_matches))
-        if len(global_top) > 0:
-            metrics['global']['precisions'].append(len(global_matches) / len(global_top))
-        
-        # 3. РАНДОМНЫЕ РЕКОМЕНДАЦИИ (усредняем по итерациям)
-        user_random_hits = []
-        user_random_clicks = []
-        user_random_precisions = []
-        
-        for _ in range(n_random_iterations):
-            random_recs = random.sample(all_articles, min(n_recommendations, len(all_articles)))
-            random_recs_set = set(random_recs)
-            random_matches = user_clicks & random_recs_set
-            
-            user_random_hits.append(1 if random_matches else 0)
-            user_random_clicks.append(len(random_matches))
-            user_random_precisions.append(len(random_matches) / len(random_recs))
-        
-        metrics['random']['hits'].append(np.mean(user_random_hits))
-        metrics['random']['total_clicks'].append(np.mean(user_random_clicks))
-        metrics['random']['precisions'].append(np.mean(user_random_precisions))
+    user_metrics = compute_user_metrics(clicked_df, recommendation_systems,
+                                        n_recommendations, interactions)
     
     # Расчет финальных метрик
     results = {}
     
-    # Сегментные топы
-    results['segment'] = {
-        'hit_rate': metrics['segment']['hits'] / total_users,
-        'avg_clicks_in_top': np.mean(metrics['segment']['total_clicks']),
-        'median_clicks_in_top': np.median(metrics['segment']['total_clicks']),
-        'precision': np.mean(metrics['segment']['precisions']),
-        'users_with_hits': metrics['segment']['hits']
-    }
-    
-    # Общий топ
-    results['global'] = {
-        'hit_rate': metrics['global']['hits'] / total_users,
-        'avg_clicks_in_top': np.mean(metrics['global']['total_clicks']),
-        'median_clicks_in_top': np.median(metrics['global']['total_clicks']),
-        'precision': np.mean(metrics['global']['precisions']),
-        'users_with_hits': metrics['global']['hits']
-    }
-    
-    # Рандом
-    results['random'] = {
-        'hit_rate': np.mean(metrics['random']['hits']),
-        'avg_clicks_in_top': np.mean(metrics['random']['total_clicks']),
-        'median_clicks_in_top': np.median(metrics['random']['total_clicks']),
-        'precision': np.mean(metrics['random']['precisions']),
-        'users_with_hits': int(np.sum(metrics['random']['hits']))
-    }
+    for method in ['segment', 'global', 'random']:
+        method_metrics = user_metrics[method]
+        has_recs = method_metrics['n_recs'] > 0
+        precisions = method_metrics['matches'][has_recs] / method_metrics['n_recs'][has_recs]
+        hits = method_metrics['hit']
+        
+        results[method] = {
+            'hit_rate': np.mean(hits),
+            'avg_clicks_in_top': np.mean(method_metrics['matches']),
+            'median_clicks_in_top': np.median(method_metrics['matches']),
+            'precision': np.mean(precisions),
+            'users_with_hits': int(np.sum(hits))
+        }
     
     # Улучшения относительно рандома
     for method in ['segment', 'global']:
@@ -195,44 +286,19 @@ def calculate_precision_at_k_all_methods(clicked_df: pd.DataFrame,
     """
     Расчет Precision@K для всех трех методов
     """
-    segment_tops = recommendation_systems['segment_tops']
-    global_top = recommendation_systems['global_top']
-    all_articles = recommendation_systems['all_articles']
+    clicked_df = _with_age_group(clicked_df)
+    interactions = build_interaction_matrix(clicked_df, recommendation_systems['all_articles'])
     
     results = []
-    users = clicked_df[['ehr_id', 'gender', 'age_group']].drop_duplicates()
     
     for k in k_values:
-        segment_precisions = []
-        global_precisions = []
-        random_precisions = []
+        user_metrics = compute_user_metrics(clicked_df, recommendation_systems, k, interactions)
         
-        for _, user_row in users.iterrows():
-            user_id = user_row['ehr_id']
-            gender = user_row['gender']
-            age_grp = user_row['age_group']
-            
-            user_clicks = set(clicked_df[clicked_df['ehr_id'] == user_id]['article_id'].unique())
-            
-            # Сегментные рекомендации
-            segment_recs = segment_tops.get((gender, age_grp), [])[:k]
-            if segment_recs:
-                segment_precision = len(set(segment_recs) & user_clicks) / k
-                segment_precisions.append(segment_precision)
-            
-            # Глобальный топ
-            global_recs = global_top[:k]
-            if global_recs:
-                global_precision = len(set(global_recs) & user_clicks) / k
-                global_precisions.append(global_precision)
-            
-            # Рандомные рекомендации (усредняем)
-            random_precision_iter = []
-            for _ in range(100):
-                random_recs = random.sample(all_articles, min(k, len(all_articles)))
-                random_precision = len(set(random_recs) & user_clicks) / k
-                random_precision_iter.append(random_precision)
-            random_precisions.append(np.mean(random_precision_iter))
+        # Как и раньше, делим на k, а не на фактическую длину списка
+        segment = user_metrics['segment']
+        segment_precisions = segment['matches'][segment['n_recs'] > 0] / k
+        global_precisions = user_metrics['global']['matches'][user_metrics['global']['n_recs'] > 0] / k
+        random_precisions = user_metrics['random']['matches'] / k
         
         results.append({
             'K': k,
@@ -251,110 +317,140 @@ def analyze_coverage_all_methods(clicked_df: pd.DataFrame,
                                  recommendation_systems: Dict,
                                  n_recommendations: int = 10) -> Dict:
     """
-    Сравнение покрытия каталога для всех методов
+    Сравнение покрытия каталога для всех методов.
+
+    Считается по матрицам выдачи (rec_sys_common/metrics.py); для рандома —
+    точное ожидание вместо симуляции: каждый сегмент выбирает K статей из N
+    без возвращения, статья не попадает ни в один из S сегментов с
+    вероятностью (1 − K/N)^S.
     """
-    segment_tops = recommendation_systems['segment_tops']
-    global_top = recommendation_systems['global_top'][:n_recommendations]
-    all_articles = set(recommendation_systems['all_articles'])
-    n_articles = len(all_articles)
-    
-    # 1. Покрытие сегментными топами
-    segment_articles = set()
-    for articles_list in segment_tops.values():
-        segment_articles.update(articles_list[:n_recommendations])
-    segment_coverage = len(segment_articles) / n_articles
-    
-    # 2. Покрытие глобальным топом
-    global_coverage = len(set(global_top)) / n_articles
-    
-    # 3. Покрытие рандомом (симуляция)
-    n_segments = len(segment_tops)  # Количество сегментов
-    simulated_coverage = []
-    
-    for _ in range(100):
-        random_articles = set()
-        # Симулируем рандомные рекомендации для каждого сегмента
-        for _ in range(n_segments):
-            random_sample = random.sample(list(all_articles), 
-                                        min(n_recommendations, n_articles))
-            random_articles.update(random_sample)
-        simulated_coverage.append(len(random_articles) / n_articles)
-    
-    # Дополнительные метрики разнообразия
-    # Gini коэффициент для оценки неравномерности распределения
-    def calculate_gini(article_counts):
-        sorted_counts = sorted(article_counts)
-        n = len(sorted_counts)
-        cumsum = np.cumsum(sorted_counts)
-        return (2 * np.sum((np.arange(1, n+1) * sorted_counts))) / (n * np.sum(sorted_counts)) - (n + 1) / n
-    
-    # Подсчет частот для сегментных топов
-    segment_freq = {}
-    for articles_list in segment_tops.values():
-        for article in articles_list[:n_recommendations]:
-            segment_freq[article] = segment_freq.get(article, 0) + 1
-    
-    segment_gini = calculate_gini(list(segment_freq.values())) if segment_freq else 0
+    article_index = pd.Index(pd.unique(np.asarray(recommendation_systems['all_articles'])))
+    n_articles = len(article_index)
+    segment_rows = _top_lists_rows(list(recommendation_systems['segment_tops'].values()),
+                                   article_index, n_recommendations)
+    global_rows = _top_lists_rows([recommendation_systems['global_top']], article_index, n_recommendations)
+    
+    # 1–2. Покрытие сегментными топами и глобальным топом
+    segment_counts = recommendation_counts(segment_rows, n_articles)
+    segment_coverage = catalog_coverage(segment_rows, n_articles)
+    global_coverage = catalog_coverage(global_rows, n_articles)
+    
+    # 3. Покрытие рандомом (ожидание)
+    n_segments = len(segment_rows)
+    n_draws = min(n_recommendations, n_articles)
+    random_coverage = 1 - (1 - n_draws / n_articles) ** n_segments if n_articles else 0.0
+    
+    # Gini по частотам статей, попавших в сегментные топы
+    segment_gini = gini_index(segment_counts[segment_counts > 0])
+    
+    # Новизна: −log2 доли пользователей, кликнувших статью; у рандома — среднее по каталогу
+    user_codes = pd.factorize(clicked_df['ehr_id'])[0]
+    item_codes = article_index.get_indexer(clicked_df['article_id'])
+    known = item_codes >= 0
+    n_users = int(user_codes.max()) + 1 if len(user_codes) else 0
+    pairs = np.unique(user_codes[known].astype(np.int64) * n_articles + item_codes[known])
+    popularity = np.bincount(pairs % n_articles, minlength=n_articles)
+    catalog_rows = np.arange(n_articles)[None]
     
     return {
         'segment_coverage': segment_coverage,
         'global_coverage': global_coverage,
-        'random_coverage': np.mean(simulated_coverage),
-        'segment_unique_articles': len(segment_articles),
-        'global_unique_articles': len(set(global_top)),
+        'random_coverage': random_coverage,
+        'segment_unique_articles': int(np.count_nonzero(segment_counts)),
+        'global_unique_articles': int(np.count_nonzero(global_rows >= 0)),
         'segment_gini': segment_gini,
-        'concentration_ratio_segment_vs_random': segment_coverage / np.mean(simulated_coverage),
-        'concentration_ratio_global_vs_random': global_coverage / np.mean(simulated_coverage)
+        'segment_gini_catalog': gini_index(segment_counts),
+        'segment_novelty': float(np.nanmean(novelty(segment_rows, popularity, n_users))) if n_segments else 0.0,
+        'global_novelty': float(novelty(global_rows, popularity, n_users)[0]),
+        'random_novelty': float(novelty(catalog_rows, popularity, n_users)[0]),
+        'concentration_ratio_segment_vs_random': segment_coverage / random_coverage,
+        'concentration_ratio_global_vs_random': global_coverage / random_coverage
     }
 
 
+# Поюзерные попадания (segment, global, вероятность для random), выставляются
+# в каждом воркере пула один раз через initializer
+_BOOTSTRAP_HITS = None
+
+# Сколько бутстрэп-выборок в одном шарде; от этого числа (и seed) зависит
+# результат, но не от количества воркеров
+BOOTSTRAP_SHARD_SIZE = 250
+
+
+def _init_bootstrap_worker(hits: np.ndarray):
+    global _BOOTSTRAP_HITS
+    _BOOTSTRAP_HITS = hits
+
+
+def _bootstrap_shard(args: Tuple) -> np.ndarray:
+    """
+    Hit rate методов на n_resamples бутстрэп-выборках пользователей.
+
+    Выборки — это gather по массиву индексов; рандом на каждой выборке
+    разыгрывается Бернулли с поюзерной вероятностью попадания.
+
+    Returns:
+        Массив (n_resamples, 3): segment, global, random
+    """
+    n_resamples, seed_seq = args
+    hits = _BOOTSTRAP_HITS
+    n_users = hits.shape[1]
+    rng = np.random.default_rng(seed_seq)
+
+    # Ограничиваем размер матрицы индексов ~4M элементов
+    chunk = max(1, min(n_resamples, 4_000_000 // max(n_users, 1)))
+    rates = np.empty((n_resamples, 3))
+    for start in range(0, n_resamples, chunk):
+        size = min(chunk, n_resamples - start)
+        idx = rng.integers(0, n_users, size=(size, n_users))
+        rates[start:start + size, 0] = hits[0][idx].mean(axis=1)
+        rates[start:start + size, 1] = hits[1][idx].mean(axis=1)
+        rates[start:start + size, 2] = (rng.random((size, n_users)) < hits[2][idx]).mean(axis=1)
+    return rates
+
+
 def statistical_significance_test(clicked_df: pd.DataFrame,
                                  recommendation_systems: Dict,
                                  n_recommendations: int = 10,
-                                 n_bootstrap: int = 1000) -> Dict:
+                                 n_bootstrap: int = 1000,
+                                 seed: int = None,
+                                 n_jobs: int = None) -> Dict:
     """
     Bootstrap тест для статистической значимости различий между методами
+
+    Поюзерные попадания считаются один раз, выборки шардятся по процессам.
+    При заданном seed результат воспроизводим независимо от n_jobs.
+    n_jobs=None — по числу ядер, n_jobs=1 — без пула процессов.
     """
-    segment_tops = recommendation_systems['segment_tops']
-    global_top = recommendation_systems['global_top'][:n_recommendations]
-    all_articles = recommendation_systems['all_articles']
-    
-    users = clicked_df[['ehr_id', 'gender', 'age_group']].drop_duplicates()
+    if n_bootstrap < 1:
+        raise ValueError(f"n_bootstrap должно быть не меньше 1, получено {n_bootstrap}")
+    clicked_df = _with_age_group(clicked_df)
+    user_metrics = compute_user_metrics(clicked_df, recommendation_systems, n_recommendations)
+    hits = np.vstack([
+        user_metrics['segment']['hit'],
+        user_metrics['global']['hit'],
+        user_metrics['random']['hit']
+    ])
+    
+    shard_sizes = [min(BOOTSTRAP_SHARD_SIZE, n_bootstrap - start)
+                   for start in range(0, n_bootstrap, BOOTSTRAP_SHARD_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(shard_sizes))
+    tasks = list(zip(shard_sizes, seeds))
+    
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(tasks))
+    if n_jobs <= 1:
+        _init_bootstrap_worker(hits)
+        shards = [_bootstrap_shard(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_bootstrap_worker,
+                                 initargs=(hits,)) as executor:
+            shards = list(executor.map(_bootstrap_shard, tasks))
     
-    segment_hit_rates = []
-    global_hit_rates = []
-    random_hit_rates = []
-    
-    for _ in range(n_bootstrap):
-        # Сэмплируем пользователей с возвратом
-        sampled_users = users.sample(n=len(users), replace=True)
-        
-        segment_hits = 0
-        global_hits = 0
-        random_hits = 0
-        
-        for _, user_row in sampled_users.iterrows():
-            user_clicks = set(clicked_df[clicked_df['ehr_id'] == user_row['ehr_id']]['article_id'])
-            
-            # Сегментные
-            segment_recs = set(segment_tops.get(
-                (user_row['gender'], user_row['age_group']), [])[:n_recommendations])
-            if user_clicks & segment_recs:
-                segment_hits += 1
-            
-            # Глобальные
-            global_recs = set(global_top)
-            if user_clicks & global_recs:
-                global_hits += 1
-            
-            # Рандомные
-            random_recs = set(random.sample(all_articles, min(n_recommendations, len(all_articles))))
-            if user_clicks & random_recs:
-                random_hits += 1
-        
-        segment_hit_rates.append(segment_hits / len(sampled_users))
-        global_hit_rates.append(global_hits / len(sampled_users))
-        random_hit_rates.append(random_hits / len(sampled_users))
+    rates = np.vstack(shards)
+    segment_hit_rates = rates[:, 0]
+    global_hit_rates = rates[:, 1]
+    random_hit_rates = rates[:, 2]
     
     # Считаем различия и p-values
     segment_vs_random = np.array(segment_hit_rates) - np.array(random_hit_rates)
@@ -388,6 +484,7 @@ def print_full_comparison_report(clicked_df: pd.DataFrame,
     """
     Полный отчет сравнения всех трех методов
     """
+    clicked_df = _with_age_group(clicked_df)
     # Подготовка систем рекомендаций
     print("Подготовка систем рекомендаций...")
     rec_systems = prepare_recommendation_systems(clicked_df, n_recommendations)
@@ -464,13 +561,16 @@ def print_full_comparison_report(clicked_df: pd.DataFrame,
     
     print(f"Сегментные топы:")
     print(f"  Покрытие: {coverage['segment_coverage']:.4f} ({coverage['segment_unique_articles']} статей)")
-    print(f"  Gini коэффициент: {coverage['segment_gini']:.4f}")
+    print(f"  Gini коэффициент: {coverage['segment_gini']:.4f} (по всему каталогу: {coverage['segment_gini_catalog']:.4f})")
+    print(f"  Новизна: {coverage['segment_novelty']:.2f} бит")
     
     print(f"\nОбщий топ:")
     print(f"  Покрытие: {coverage['global_coverage']:.4f} ({coverage['global_unique_articles']} статей)")
+    print(f"  Новизна: {coverage['global_novelty']:.2f} бит")
     
-    print(f"\nРандом (симуляция):")
+    print(f"\nРандом (ожидание):")
     print(f"  Покрытие: {coverage['random_coverage']:.4f}")
+    print(f"  Новизна: {coverage['random_novelty']:.2f} бит")
     
     print(f"\nКоэффициенты концентрации (меньше = более сконцентрировано):")
     print(f"  Сегменты/Рандом: {coverage['concentration_ratio_segment_vs_random']:.2f}x")
@@ -546,27 +646,18 @@ def save_recommendations(rec_systems: Dict, output_prefix: str = 'recommendation
 
 # Функции для использования рекомендаций
 def recommend_by_segment(gender: int, age: int, rec_systems: Dict, n: int = 10) -> pd.DataFrame:
-    """Рекомендации на основе сегментации"""
-    group = age_group(age)
-    segment_tops = rec_systems['segment_tops']
-    articles_info = rec_systems['articles_info']
-    
-    ids = segment_tops.get((gender, group), [])[:n]
-    recs = articles_info[articles_info['article_id'].isin(ids)]
-    recs['article_id'] = pd.Categorical(recs['article_id'], categories=ids, ordered=True)
-    recs = recs.sort_values('article_id')
-    return recs[['article_id', 'title', 'url']].reset_index(drop=True)
+    """
+    Рекомендации на основе сегментации: топ сегмента из плотной таблицы
+    (короткий или отсутствующий сегмент добирается топом пола, затем общим)
+    """
+    ids = rec_systems['segment_table'].recommend(gender, age, n)
+    return rec_systems['article_table'].reindex(ids).rename_axis('article_id').reset_index()
 
 
 def recommend_global(rec_systems: Dict, n: int = 10) -> pd.DataFrame:
     """Рекомендации на основе общего топа"""
-    global_top = rec_systems['global_top'][:n]
-    articles_info = rec_systems['articles_info']
-    
-    recs = articles_info[articles_info['article_id'].isin(global_top)]
-    recs['article_id'] = pd.Categorical(recs['article_id'], categories=global_top, ordered=True)
-    recs = recs.sort_values('article_id')
-    return recs[['article_id', 'title', 'url']].reset_index(drop=True)
+    ids = rec_systems['global_top'][:n]
+    return rec_systems['article_table'].reindex(ids).rename_axis('article_id').reset_index()
 
 
 def recommend_random(rec_systems: Dict, n: int = 10) -> pd.DataFrame:
@@ -582,12 +673,12 @@ def recommend_random(rec_systems: Dict, n: int = 10) -> pd.DataFrame:
 # Пример использования
 if __name__ == "__main__":
     # Загружаем данные
-    data = pd.read_excel("../cuprum_3.xlsx", sheet_name="Лист4")
-    data.drop(columns=["esb_ehr_id","patientnet_ehr_id"], inplace=True)
-    data.rename(columns={"пол":"gender", "возраст":"age"}, inplace=True)
-    #data = data[data['tags'] != 'Секс']
-    data['age_group'] = data['age'].apply(age_group)
-    clicked = data[data['action_type'] == 'CLICKED']
+    from rec_sys_common.events import load_compact_events
+    # Компактная таблица (rec_sys_common/events.py): age_group уже посчитан,
+    # строки каталога — category, события — целые массивы
+    events = load_compact_events("../cuprum_3.xlsx", sheet_name="Лист4")
+    #events = events.take((events.frame(['tags'])['tags'] != 'Секс').to_numpy())
+    clicked = events.clicks().frame()
     
     # Строим систему
     print_full_comparison_report(clicked)